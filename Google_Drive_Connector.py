@@ -1,50 +1,105 @@
-from fastapi import FastAPI, Request, UploadFile, File
-from fastapi.responses import RedirectResponse
-from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request as GoogleRequest
-from google.oauth2.credentials import Credentials
-import requests
+from fastapi import FastAPI, Request, Response, UploadFile, File, Depends
+from fastapi.responses import JSONResponse, RedirectResponse
+from starlette.datastructures import Headers
+from pydantic import BaseModel
+from typing import Optional
+from http_client import get_client, lifespan, rate_limits
+from metrics import instrument, metrics_response
+from google_oauth import authorization_url, client_config, exchange_code
+from token_manager import TokenManager, TokenRefreshError, refresh_oauth_token, read_json
+from token_store import TOKEN_DB, DEFAULT_SESSION, SESSION_COOKIE, get_session_id, login_session_id, token_store
+from transfer import TransferError, download_ranges, stream_download, write_chunks
+from drive_index import DRIVE_INDEX_DB, INDEX_FIELDS, drive_index
+from calendar_store import CALENDAR_DB
+from rate_limiter import google_rate_limited
+from datetime import datetime, timezone
+import httpx
+import time
+import logging
+import asyncio
+import hashlib
+import mimetypes
 import json
+import uuid
+import re
 import uvicorn
 import os
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+instrument(app, "drive")
 
 # Google API Configuration
 CLIENT_SECRETS_FILE = "credentials_2.json"
 SCOPES = ["https://www.googleapis.com/auth/drive.file"]
-REDIRECT_URI = "http://localhost:8000/auth/callback"
-TOKEN_FILE = "token.json"
+REDIRECT_URI = os.getenv("DRIVE_REDIRECT_URI", "http://localhost:8000/auth/callback")
+TOKEN_FILE = "token.json"  # Single-user token file of older versions, imported for the default session
+
+# Upload Configuration
+DRIVE_UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024  # Files above this size use the resumable protocol
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Must be a multiple of 256 KiB
+MAX_CHUNK_RETRIES = 5
+
+# Download Configuration
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+DOWNLOAD_DIR = os.getenv("DRIVE_DOWNLOAD_DIR", "downloads")  # Kept apart from the app, its .env and databases
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+PARALLEL_PART_SIZE = 32 * 1024 * 1024  # Byte range fetched by each worker of a parallel download
+PARALLEL_DOWNLOAD_WORKERS = 4
+
+# Sync Configuration
+DRIVE_BATCH_URL = "https://www.googleapis.com/batch/drive/v3"
+DRIVE_BATCH_LIMIT = 100  # Requests Drive accepts in one batch call
+MAX_BATCH_RETRIES = 3
+SYNC_ROOT = os.path.realpath(os.getenv("DRIVE_SYNC_ROOT", "sync"))  # Only directories below this can be synced
+# A synced directory must not hold the app, its .env or its databases: a pull with delete would remove them
+# and a push would upload every user's tokens
+PROTECTED_PATHS = [os.path.realpath(path) for path in (os.path.dirname(os.path.abspath(__file__)), os.getcwd(),
+                                                       TOKEN_DB, DRIVE_INDEX_DB, CALENDAR_DB)]
+SYNC_CONCURRENCY = int(os.getenv("DRIVE_SYNC_CONCURRENCY", "8"))  # Uploads, downloads and listings in flight
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+SYNC_FIELDS = "nextPageToken, files(id, name, mimeType, md5Checksum, size, modifiedTime)"
+
+# Metadata Index Configuration
+DRIVE_CHANGES_URL = "https://www.googleapis.com/drive/v3/changes"
+INDEX_SYNC_INTERVAL = float(os.getenv("DRIVE_INDEX_SYNC_INTERVAL", "30"))  # Index age that triggers a background refresh
+MAX_LIST_LIMIT = 1000
+
+logger = logging.getLogger(__name__)
+
+index_syncs = {}  # session id -> in-flight index refresh shared by concurrent readers
 
 
 # Helper Functions for Token Management
-def save_credentials(credentials_data):
-    with open(TOKEN_FILE, "w") as f:
-        json.dump(credentials_data, f)
+def save_credentials(session_id, credentials_data):
+    token_store.save("drive", session_id, credentials_data)
 
 
-def load_credentials():
-    try:
-        with open(TOKEN_FILE, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return None
+def load_credentials(session_id):
+    credentials_data = token_store.load("drive", session_id)
+    if credentials_data is None and session_id == DEFAULT_SESSION:
+        credentials_data = read_json(TOKEN_FILE)
+        if credentials_data and "access_token" not in credentials_data:
+            credentials_data["access_token"] = credentials_data.pop("token", None)
+    return credentials_data
 
 
-# Refresh Token if Expired
-def get_credentials():
-    credentials_data = load_credentials()
-    if not credentials_data:
-        return None
+async def refresh_credentials(credentials_data):
+    return await refresh_oauth_token(credentials_data["token_uri"], credentials_data["refresh_token"], data={
+        "client_id": credentials_data["client_id"],
+        "client_secret": credentials_data["client_secret"],
+    })
 
-    credentials = Credentials.from_authorized_user_info(credentials_data)
 
-    if credentials.expired and credentials.refresh_token:
-        credentials.refresh(GoogleRequest())
-        credentials_data["token"] = credentials.token
-        save_credentials(credentials_data)
+token_manager = TokenManager("drive", refresh_credentials, load=load_credentials, save=save_credentials)
 
-    return credentials
+
+# Cached Credentials, refreshed in the background before they expire
+async def get_credentials(session_id):
+    try:
+        return await token_manager.get(session_id)
+    except TokenRefreshError:
+        return None
 
 
 # API Root
@@ -53,118 +108,748 @@ async def root():
     return {"message": "Google Drive Connector API is running!"}
 
 
+# Upstream rate-limit budgets as learned from response headers
+@app.get("/rate_limits")
+async def get_rate_limits():
+    return rate_limits()
+
+
+# Route, upstream, token and cache metrics of this process in the Prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response()
+
+
+# Readiness: fails until the OAuth client secrets are in place
+@app.get("/health")
+async def health():
+    if client_config(CLIENT_SECRETS_FILE) is None:
+        return JSONResponse({"status": "unavailable", "missing": [CLIENT_SECRETS_FILE]}, status_code=503)
+    return {"status": "ok"}
+
+
 # Step 1: Login & OAuth Flow
 @app.get("/login", response_class=RedirectResponse)
-async def login():
-    flow = Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES, redirect_uri=REDIRECT_URI)
-    auth_url, _ = flow.authorization_url(prompt="consent")
+async def login(new_session: bool = False, session_id: str = Depends(get_session_id)):
+    # The OAuth state is a one-time nonce; the session it logs in stays on the server until the callback
+    if client_config(CLIENT_SECRETS_FILE) is None:
+        return JSONResponse({"error": f"{CLIENT_SECRETS_FILE} not found. Download it from Google Cloud Console."},
+                            status_code=503)
+    auth_url = await asyncio.to_thread(authorization_url, CLIENT_SECRETS_FILE, SCOPES, REDIRECT_URI, "drive",
+                                       login_session_id(session_id, new_session))
     return RedirectResponse(auth_url)
 
 
 # Step 2: OAuth Callback
 @app.get("/auth/callback")
-async def auth_callback(request: Request):
+async def auth_callback(request: Request, response: Response):
     query_params = dict(request.query_params)
     code = query_params.get("code")
+    state = query_params.get("state")
 
     if not code:
         return {"error": "Missing OAuth authorization code. Please try logging in again."}
-
-    flow = Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES, redirect_uri=REDIRECT_URI)
-    flow.fetch_token(code=code)
-    credentials = flow.credentials
-
-    credentials_data = {
-        "token": credentials.token,
-        "refresh_token": credentials.refresh_token,
-        "token_uri": credentials.token_uri,
-        "client_id": credentials.client_id,
-        "client_secret": credentials.client_secret,
+    login = token_store.finish_login("drive", state)
+    if login is None:
+        return JSONResponse({"error": "Unknown or expired login state. Please try logging in again."}, status_code=400)
+    session_id = login["session_id"]
+
+    credentials_data = await asyncio.to_thread(exchange_code, CLIENT_SECRETS_FILE, SCOPES, REDIRECT_URI,
+                                               code, login.get("code_verifier"))
+    token_manager.set(session_id, credentials_data)
+
+    response.set_cookie(SESSION_COOKIE, session_id, httponly=True)
+    return {"message": "Authentication successful!", "access_token": credentials_data["access_token"],
+            "session_id": session_id}
+
+
+# Helper Functions for Uploads
+def upload_size(file: UploadFile):
+    if file.size is not None:
+        return file.size
+    position = file.file.tell()
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(position)
+    return size
+
+
+def acknowledged_offset(response):
+    # Drive reports the bytes it holds as "Range: bytes=0-<last>"; no header means nothing was stored yet
+    range_header = response.headers.get("Range")
+    if not range_header:
+        return 0
+    return int(range_header.rsplit("-", 1)[1]) + 1
+
+
+async def query_upload_status(session_uri, total_size):
+    response = await get_client().put(session_uri, headers={"Content-Range": f"bytes */{total_size}"})
+    if response.status_code in (200, 201):
+        return total_size, response
+    if response.status_code == 308:
+        return acknowledged_offset(response), None
+    response.raise_for_status()
+    return 0, None
+
+
+def upload_target(file_id):
+    # New files are POSTed to the collection; passing file_id replaces the content of an existing file
+    if file_id:
+        return "PATCH", f"{DRIVE_UPLOAD_URL}/{file_id}"
+    return "POST", DRIVE_UPLOAD_URL
+
+
+async def multipart_upload(file: UploadFile, headers, metadata=None, file_id=None):
+    metadata = metadata or {"name": file.filename}
+    files = {
+        "data": ("metadata", json.dumps(metadata), "application/json"),
+        "file": (file.filename, await file.read()),
     }
-    save_credentials(credentials_data)
-
-    return {"message": "Authentication successful!", "access_token": credentials.token}
+    method, url = upload_target(file_id)
+    return await get_client().request(method, f"{url}?uploadType=multipart", headers=headers, files=files)
+
+
+async def resumable_upload(file: UploadFile, headers, total_size, metadata=None, file_id=None):
+    """ Streams the file to Drive one chunk at a time, resuming from the last acknowledged byte on failure. """
+    client = get_client()
+    method, url = upload_target(file_id)
+    session_response = await client.request(
+        method,
+        f"{url}?uploadType=resumable",
+        headers={
+            **headers,
+            "Content-Type": "application/json; charset=UTF-8",
+            "X-Upload-Content-Type": file.content_type or "application/octet-stream",
+            "X-Upload-Content-Length": str(total_size),
+        },
+        json=metadata or {"name": file.filename},
+    )
+    if session_response.status_code != 200:
+        return session_response
+    session_uri = session_response.headers["Location"]
+
+    offset = 0
+    retries = 0
+    while True:
+        await file.seek(offset)
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if chunk:
+            content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{total_size}"
+        else:
+            content_range = f"bytes */{total_size}"
+        try:
+            response = await client.put(session_uri, headers={"Content-Range": content_range}, content=chunk)
+        except httpx.TransportError:
+            response = None
+
+        if response is not None:
+            if response.status_code in (200, 201):
+                return response
+            if response.status_code == 308:
+                offset = acknowledged_offset(response)
+                retries = 0
+                continue
+            if response.status_code < 500 and response.status_code != 429:
+                return response
+
+        # Transient failure: ask Drive how much it kept and continue from there
+        retries += 1
+        if retries > MAX_CHUNK_RETRIES:
+            return response if response is not None else session_response
+        await asyncio.sleep(min(2 ** retries, 32))
+        try:
+            offset, finished = await query_upload_status(session_uri, total_size)
+        except httpx.HTTPError:
+            continue
+        if finished is not None:
+            return finished
 
 
 # Step 3: Upload File to Google Drive
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    credentials = get_credentials()
+async def upload_file(file: UploadFile = File(...), resumable: Optional[bool] = None,
+                      session_id: str = Depends(get_session_id)):
+    credentials = await get_credentials(session_id)
     if not credentials:
         return {"error": "User not authenticated. Please login first."}
 
-    headers = {"Authorization": f"Bearer {credentials.token}"}
-    metadata = {"name": file.filename}
-    files = {
-        "data": ("metadata", json.dumps(metadata), "application/json"),
-        "file": (file.filename, await file.read()),
-    }
+    headers = {"Authorization": f"Bearer {credentials['access_token']}"}
+    total_size = upload_size(file)
+    if resumable is None:
+        resumable = total_size > RESUMABLE_THRESHOLD
 
-    response = requests.post("https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart", headers=headers,
-                             files=files)
+    if resumable:
+        response = await resumable_upload(file, headers, total_size)
+    else:
+        response = await multipart_upload(file, headers)
 
-    if response.status_code == 200:
+    if response.status_code in (200, 201):
+        await asyncio.to_thread(drive_index.mark_stale, session_id)
         return {"message": "File uploaded successfully!", "file_id": response.json().get("id")}
     else:
         return {"error": "File upload failed", "details": response.text}
 
 
-# Step 4: List Files in Google Drive
+# Helper Functions for the Metadata Index
+async def build_index(session_id, headers):
+    """ Full listing, anchored at a changes token taken first so nothing changed meanwhile is missed. """
+    response = await get_client().get(f"{DRIVE_CHANGES_URL}/startPageToken", headers=headers)
+    response.raise_for_status()
+    start_page_token = response.json()["startPageToken"]
+
+    params = {"q": "trashed = false", "fields": f"nextPageToken, files({INDEX_FIELDS})", "pageSize": 1000}
+    reset = True
+    while True:
+        response = await get_client().get(DRIVE_FILES_URL, headers=headers, params=params)
+        response.raise_for_status()
+        page = response.json()
+        last_page = "nextPageToken" not in page
+        # The token is only stored with the last page, so an interrupted build starts over
+        await asyncio.to_thread(drive_index.apply, session_id, page.get("files", []), (),
+                                start_page_token if last_page else None, reset)
+        reset = False
+        if last_page:
+            return
+        params = {**params, "pageToken": page["nextPageToken"]}
+
+
+async def sync_index(session_id, headers):
+    generation, _ = await asyncio.to_thread(drive_index.freshness, session_id)
+    page_token = await asyncio.to_thread(drive_index.page_token, session_id)
+    params = {"pageToken": page_token, "pageSize": 1000, "includeRemoved": "true",
+              "fields": f"nextPageToken, newStartPageToken, changes(fileId, removed, file({INDEX_FIELDS}))"}
+    while page_token is not None:
+        response = await get_client().get(DRIVE_CHANGES_URL, headers=headers, params=params)
+        if response.status_code in (400, 404, 410):
+            page_token = None  # Token no longer valid: rebuild from a full listing
+            break
+        response.raise_for_status()
+        page = response.json()
+        changes = page.get("changes", [])
+        files = [change["file"] for change in changes if not change.get("removed") and "file" in change]
+        removed = [change["fileId"] for change in changes if change.get("removed")]
+        next_token = page.get("newStartPageToken") or page.get("nextPageToken")
+        await asyncio.to_thread(drive_index.apply, session_id, files, removed, next_token)
+        if "newStartPageToken" in page or not next_token:
+            break
+        params = {**params, "pageToken": next_token}
+    if page_token is None:
+        await build_index(session_id, headers)
+    await asyncio.to_thread(drive_index.mark_synced, session_id, generation, time.time())
+
+
+def index_refresh(session_id, headers):
+    task = index_syncs.get(session_id)
+    if task is None:
+        task = asyncio.ensure_future(sync_index(session_id, headers))
+        index_syncs[session_id] = task
+        task.add_done_callback(lambda done: index_refresh_done(session_id, done))
+    return task
+
+
+def index_refresh_done(session_id, task):
+    index_syncs.pop(session_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Drive index refresh failed", exc_info=task.exception())
+
+
+async def ensure_index(session_id, headers, refresh=False):
+    """ Waits for the first build, a requested refresh or the catch-up after our own writes; otherwise
+    answers from the index and refreshes it in the background once it is older than INDEX_SYNC_INTERVAL. """
+    _, synced_at = await asyncio.to_thread(drive_index.freshness, session_id)  # Shared by every worker
+    if refresh or synced_at is None:
+        await asyncio.shield(index_refresh(session_id, headers))
+    elif time.time() - synced_at > INDEX_SYNC_INTERVAL:
+        index_refresh(session_id, headers)
+
+
+# Step 4: List Files in Google Drive, from the metadata index
 @app.get("/files")
-async def list_files():
-    credentials = get_credentials()
+async def list_files(name: Optional[str] = None, name_contains: Optional[str] = None, parent: Optional[str] = None,
+                     mime_type: Optional[str] = None, fields: str = "id,name,mimeType", order_by: str = "name",
+                     limit: int = 100, offset: int = 0, refresh: bool = False,
+                     session_id: str = Depends(get_session_id)):
+    """
+    Filters combine; fields is a comma separated projection of id, name, mimeType, parents, size,
+    md5Checksum and modifiedTime; order_by takes one of them, prefixed with "-" for descending.
+    """
+    credentials = await get_credentials(session_id)
     if not credentials:
         return {"error": "User not authenticated. Please login first."}
 
-    headers = {"Authorization": f"Bearer {credentials.token}"}
-    response = requests.get("https://www.googleapis.com/drive/v3/files", headers=headers)
-
-    if response.status_code == 200:
-        return {"files": response.json().get("files", [])}
-    else:
-        return {"error": "Failed to retrieve files", "details": response.text}
+    headers = {"Authorization": f"Bearer {credentials['access_token']}"}
+    try:
+        await ensure_index(session_id, headers, refresh)
+    except httpx.HTTPStatusError as e:
+        return {"error": "Failed to retrieve files", "details": e.response.text}
+
+    files = await asyncio.to_thread(
+        drive_index.query, session_id, [field.strip() for field in fields.split(",")], name, name_contains, parent,
+        mime_type, order_by, max(0, min(limit, MAX_LIST_LIMIT)), max(0, offset))
+    return {"files": files}
+
+
+# Helper Functions for Downloads
+async def get_file_metadata(session_id, file_id, headers, name=None, size=None):
+    """ Returns name and size, calling Drive only when neither the caller nor the index knows them. """
+    if not name or size is None:
+        indexed = await asyncio.to_thread(drive_index.get, session_id, file_id, ("name", "size"))
+        if indexed is None:
+            response = await get_client().get(f"{DRIVE_FILES_URL}/{file_id}", headers=headers,
+                                              params={"fields": INDEX_FIELDS})
+            if response.status_code != 200:
+                return None, response
+            indexed = response.json()
+            await asyncio.to_thread(drive_index.apply, session_id, [indexed])
+        name = name or indexed.get("name", "downloaded_file")
+        size = int(indexed.get("size", 0)) if size is None else size
+    return {"name": name, "size": size}, None
+
+
+def local_download_path(file_name):
+    # Never let a remote name escape the download directory
+    name = os.path.basename(file_name.replace("\\", "/"))
+    return os.path.join(DOWNLOAD_DIR, name if name not in ("", ".", "..") else "downloaded_file")
+
+
+def drive_auth(session_id):
+    # Looked up per range so parallel downloads survive a token refresh
+    async def auth(expired):
+        credentials = await (token_manager.refresh(session_id) if expired else token_manager.get(session_id))
+        return {"Authorization": f"Bearer {credentials['access_token']}"}
+    return auth
 
 
 # Step 5: Download File from Google Drive
 @app.get("/download/{file_id}")
-async def download_file(file_id: str):
-    credentials = get_credentials()
+async def download_file(file_id: str, request: Request, mode: str = "disk", parallel: bool = False,
+                        name: Optional[str] = None, size: Optional[int] = None,
+                        session_id: str = Depends(get_session_id)):
+    """
+    mode=stream pipes the file to the client and honours the Range header; mode=disk saves it under
+    DOWNLOAD_DIR, optionally as resumable parallel ranged fetches. Passing name and size skips the metadata call.
+    """
+    credentials = await get_credentials(session_id)
     if not credentials:
         return {"error": "User not authenticated. Please login first."}
 
-    headers = {"Authorization": f"Bearer {credentials.token}"}
-    metadata_response = requests.get(f"https://www.googleapis.com/drive/v3/files/{file_id}", headers=headers)
+    headers = {"Authorization": f"Bearer {credentials['access_token']}"}
+    media_url = f"{DRIVE_FILES_URL}/{file_id}?alt=media"
+
+    if mode == "stream":
+        file_name = name or (await asyncio.to_thread(drive_index.get, session_id, file_id, ("name",)) or {}).get("name")
+        return await stream_download(media_url, headers, request.headers.get("range"), file_name)
 
-    if metadata_response.status_code != 200:
+    metadata, metadata_response = await get_file_metadata(session_id, file_id, headers, name, size)
+    if metadata is None:
         return {"error": "Failed to get file metadata", "details": metadata_response.text}
 
-    file_name = metadata_response.json().get("name", "downloaded_file")
-    response = requests.get(f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media", headers=headers)
+    file_name = metadata["name"]
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    path = local_download_path(file_name)
 
-    if response.status_code == 200:
-        with open(file_name, "wb") as f:
-            f.write(response.content)
+    if parallel and metadata["size"] > PARALLEL_PART_SIZE:
+        try:
+            await download_ranges(media_url, path, metadata["size"], drive_auth(session_id),
+                                  part_size=PARALLEL_PART_SIZE, workers=PARALLEL_DOWNLOAD_WORKERS)
+        except (TransferError, TokenRefreshError) as e:
+            return {"error": "File download failed", "details": str(e)}
         return {"message": "File downloaded successfully!", "file_name": file_name}
-    else:
-        return {"error": "File download failed", "details": response.text}
+
+    async with get_client().stream("GET", media_url, headers=headers) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return {"error": "File download failed", "details": response.text}
+        await write_chunks(response.aiter_bytes(DOWNLOAD_CHUNK_SIZE), path)
+    return {"message": "File downloaded successfully!", "file_name": file_name}
 
 
 # Step 6: Delete File from Google Drive
 @app.delete("/delete/{file_id}")
-async def delete_file(file_id: str):
-    credentials = get_credentials()
+async def delete_file(file_id: str, session_id: str = Depends(get_session_id)):
+    credentials = await get_credentials(session_id)
     if not credentials:
         return {"error": "User not authenticated. Please login first."}
 
-    headers = {"Authorization": f"Bearer {credentials.token}"}
-    response = requests.delete(f"https://www.googleapis.com/drive/v3/files/{file_id}", headers=headers)
+    headers = {"Authorization": f"Bearer {credentials['access_token']}"}
+    response = await get_client().delete(f"{DRIVE_FILES_URL}/{file_id}", headers=headers)
 
     if response.status_code == 204:
+        await asyncio.to_thread(drive_index.remove, session_id, file_id)
         return {"message": "File deleted successfully!"}
     else:
         return {"error": "File deletion failed", "details": response.text}
 
 
+# Helper Functions for Folder Sync
+class SyncRequest(BaseModel):
+    local_path: str  # Relative to DRIVE_SYNC_ROOT
+    folder_id: str
+    direction: str = "push"  # push mirrors the local directory to Drive, pull mirrors Drive locally
+    delete: bool = False  # Remove what exists only on the destination side
+    dry_run: bool = False
+
+
+def sync_directory(local_path):
+    """ Absolute directory for local_path, or None when it leaves SYNC_ROOT or contains the app or its data. """
+    path = os.path.realpath(os.path.join(SYNC_ROOT, local_path))
+    if os.path.commonpath([SYNC_ROOT, path]) != SYNC_ROOT:
+        return None
+    if any(os.path.commonpath([path, protected]) == path for protected in PROTECTED_PATHS):
+        return None
+    return path
+
+
+def contained_path(root, path):
+    """ Local path of a sync-relative path, or None when it resolves (symlinks included) outside root. """
+    root = os.path.realpath(root)
+    target = os.path.realpath(os.path.join(root, *path.split("/")))
+    if os.path.commonpath([root, target]) != root:
+        return None
+    return target
+
+
+def join_path(directory, name):
+    return f"{directory}/{name}" if directory else name
+
+
+def parent_path(path):
+    return path.rpartition("/")[0]
+
+
+def rfc3339(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def parse_rfc3339(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_local(root):
+    """ Files (relative path -> size and mtime) and directories below root, with "/" separators. """
+    files, folders = {}, set()
+    for directory, _, names in os.walk(root):
+        relative = os.path.relpath(directory, root)
+        relative = "" if relative == "." else relative.replace(os.sep, "/")
+        if relative:
+            folders.add(relative)
+        for name in names:
+            if name.endswith((".part", ".part.json")):
+                continue  # Downloads still in progress
+            stat = os.stat(os.path.join(directory, name))
+            files[join_path(relative, name)] = {"size": stat.st_size, "mtime": stat.st_mtime}
+    return files, folders
+
+
+async def list_folder(headers, folder_id):
+    children, params = [], {"q": f"'{folder_id}' in parents and trashed = false", "fields": SYNC_FIELDS,
+                            "pageSize": 1000}
+    while True:
+        response = await get_client().get(DRIVE_FILES_URL, headers=headers, params=params)
+        response.raise_for_status()
+        page = response.json()
+        children.extend(page.get("files", []))
+        if not page.get("nextPageToken"):
+            return children
+        params = {**params, "pageToken": page["nextPageToken"]}
+
+
+async def scan_remote(headers, folder_id):
+    """ Files (relative path -> metadata) and folders (relative path -> id) in the tree below folder_id. """
+    files, folders = {}, {"": folder_id}
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+    async def walk(directory, directory_id):
+        async with semaphore:
+            children = await list_folder(headers, directory_id)
+        subfolders = []
+        for child in children:
+            path = join_path(directory, child["name"])
+            if (any(char in child["name"] for char in "/\\:") or child["name"] in ("", ".", "..")
+                    or path in files or path in folders):
+                continue  # Names that can't be mapped to a path safely on every OS, and duplicates after the first
+            if child["mimeType"] == FOLDER_MIME_TYPE:
+                folders[path] = child["id"]
+                subfolders.append((path, child["id"]))
+            else:
+                files[path] = child
+        await asyncio.gather(*(walk(path, child_id) for path, child_id in subfolders))
+
+    await walk("", folder_id)
+    return files, folders
+
+
+def compare_files(root, local_files, remote_files):
+    """
+    Splits files present on both sides into changed, unchanged and touched (same content but a different
+    modified time, fixed up without a transfer so the next run can skip hashing them). Blocking.
+    """
+    changed, unchanged, touched = [], [], []
+    for path, local in local_files.items():
+        remote = remote_files.get(path)
+        if remote is None or "md5Checksum" not in remote:
+            continue  # New files, and Google Docs which have no binary content to compare
+        if int(remote.get("size", -1)) != local["size"]:
+            changed.append(path)
+        elif abs(parse_rfc3339(remote["modifiedTime"]) - local["mtime"]) < 1:
+            unchanged.append(path)
+        elif file_md5(os.path.join(root, path)) == remote["md5Checksum"]:
+            touched.append(path)
+        else:
+            changed.append(path)
+    return changed, unchanged, touched
+
+
+async def post_drive_batch(headers, requests):
+    boundary = f"batch_{uuid.uuid4().hex}"
+    parts = []
+    for index, (method, path, body) in enumerate(requests):
+        part = (f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <item{index}>\r\n\r\n"
+                f"{method} {path} HTTP/1.1\r\n")
+        if body is not None:
+            part += f"Content-Type: application/json; charset=UTF-8\r\n\r\n{json.dumps(body)}\r\n"
+        else:
+            part += "\r\n"
+        parts.append(part)
+    payload = "".join(parts) + f"--{boundary}--\r\n"
+    response = await get_client().post(DRIVE_BATCH_URL, content=payload.encode(), headers={
+        **headers, "Content-Type": f"multipart/mixed; boundary={boundary}"})
+    if response.status_code != 200:
+        return [(response.status_code, response.text)] * len(requests)
+
+    # Each part wraps an HTTP response: part headers, status line and headers, then the JSON body
+    results = [(500, "Missing from batch response")] * len(requests)
+    content_type = response.headers.get("Content-Type", "")
+    if "boundary=" not in content_type:
+        error = f"Drive batch response is not multipart (Content-Type: {content_type or 'none'})"
+        return [(502, error)] * len(requests)
+    response_boundary = content_type.split("boundary=", 1)[1].split(";", 1)[0].strip().strip('"')
+    for part in response.text.replace("\r\n", "\n").split(f"--{response_boundary}"):
+        item = re.search(r"Content-ID:\s*<response-item(\d+)>", part, re.IGNORECASE)
+        status = re.search(r"^HTTP/[\d.]+ (\d{3})", part, re.MULTILINE)
+        if not item or not status:
+            continue
+        sections = part.split("\n\n", 2)
+        body = sections[2].strip() if len(sections) > 2 else ""
+        try:
+            body = json.loads(body) if body else None
+        except ValueError:
+            pass
+        results[int(item.group(1))] = (int(status.group(1)), body)
+    return results
+
+
+async def drive_batch(headers, requests):
+    """
+    Sends (method, path, body) requests through the Drive batch endpoint, DRIVE_BATCH_LIMIT per call,
+    and returns (status, body) for each in order. Throttled items (429, or 403 with a rate-limit reason) and
+    server errors are retried; other 403s are permission errors and returned as they are.
+    """
+    results = [None] * len(requests)
+    pending = list(range(len(requests)))
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+    async def send(indexes):
+        async with semaphore:
+            for index, result in zip(indexes, await post_drive_batch(headers, [requests[i] for i in indexes])):
+                results[index] = result
+
+    for attempt in range(MAX_BATCH_RETRIES + 1):
+        chunks = [pending[i:i + DRIVE_BATCH_LIMIT] for i in range(0, len(pending), DRIVE_BATCH_LIMIT)]
+        await asyncio.gather(*(send(chunk) for chunk in chunks))
+        pending = [i for i in pending if results[i][0] == 429 or results[i][0] >= 500
+                   or (results[i][0] == 403 and google_rate_limited(results[i][1]))]
+        if not pending or attempt == MAX_BATCH_RETRIES:
+            break
+        await asyncio.sleep(2 ** attempt)
+    return results
+
+
+async def upload_local(session_id, root, path, size, mtime, parent_id=None, file_id=None):
+    headers = await drive_auth(session_id)(False)
+    metadata = {"modifiedTime": rfc3339(mtime)}
+    if file_id is None:
+        metadata.update(name=path.rpartition("/")[2], parents=[parent_id])
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    with open(os.path.join(root, path), "rb") as f:
+        file = UploadFile(f, size=size, filename=metadata.get("name"), headers=Headers({"content-type": content_type}))
+        if size > RESUMABLE_THRESHOLD:
+            response = await resumable_upload(file, headers, size, metadata=metadata, file_id=file_id)
+        else:
+            response = await multipart_upload(file, headers, metadata=metadata, file_id=file_id)
+    if response.status_code not in (200, 201):
+        raise RuntimeError(f"Upload failed: {response.status_code} {response.text}")
+
+
+async def download_remote(session_id, root, path, remote):
+    """ Downloads into place, checks the MD5 Drive reports and gives the file the remote modified time. """
+    target = contained_path(root, path)
+    if target is None:
+        raise RuntimeError("Refusing to write outside the sync directory")
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    media_url = f"{DRIVE_FILES_URL}/{remote['id']}?alt=media"
+    size = int(remote.get("size", 0))
+
+    if size > PARALLEL_PART_SIZE:
+        await download_ranges(media_url, target, size, drive_auth(session_id),
+                              part_size=PARALLEL_PART_SIZE, workers=PARALLEL_DOWNLOAD_WORKERS)
+        if await asyncio.to_thread(file_md5, target) != remote["md5Checksum"]:
+            os.remove(target)
+            raise RuntimeError("MD5 mismatch after download")
+    else:
+        headers = await drive_auth(session_id)(False)
+        digest = hashlib.md5()
+        async with get_client().stream("GET", media_url, headers=headers) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise RuntimeError(f"Download failed: {response.status_code} {response.text}")
+            await write_chunks(response.aiter_bytes(DOWNLOAD_CHUNK_SIZE), f"{target}.part", digest)
+        if digest.hexdigest() != remote["md5Checksum"]:
+            os.remove(f"{target}.part")
+            raise RuntimeError("MD5 mismatch after download")
+        os.replace(f"{target}.part", target)
+
+    modified = parse_rfc3339(remote["modifiedTime"])
+    os.utime(target, (modified, modified))
+
+
+async def run_transfers(jobs):
+    """ Runs (path, coroutine function) jobs with bounded concurrency; returns the failures. """
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+    async def run(path, job):
+        async with semaphore:
+            try:
+                await job()
+            except Exception as e:
+                return {"path": path, "error": str(e)}
+
+    results = await asyncio.gather(*(run(path, job) for path, job in jobs))
+    return [result for result in results if result]
+
+
+async def push_folder(session_id, headers, root, request, local_files, local_folders, remote_files, remote_folders):
+    changed, unchanged, touched = await asyncio.to_thread(compare_files, root, local_files, remote_files)
+    created = [path for path in local_files if path not in remote_files]
+    new_folders = sorted((path for path in local_folders if path not in remote_folders), key=lambda p: p.count("/"))
+    stale_folders = {path for path in remote_folders if path and path not in local_folders}
+    # Deleting a folder removes its contents, so only the top-most stale entries are sent
+    deleted = [path for path in remote_files if path not in local_files and parent_path(path) not in stale_folders]
+    deleted += [path for path in stale_folders if parent_path(path) not in stale_folders]
+    if not request.delete:
+        deleted = []
+    summary = {"created": created, "updated": changed, "deleted": deleted, "folders_created": new_folders,
+               "unchanged": len(unchanged) + len(touched)}
+    if request.dry_run:
+        return summary, []
+
+    failures = []
+    # Folders go through the batch endpoint one depth level at a time so parents exist first
+    depth_levels = {}
+    for path in new_folders:
+        depth_levels.setdefault(path.count("/"), []).append(path)
+    for level in sorted(depth_levels):
+        paths = [path for path in depth_levels[level] if parent_path(path) in remote_folders]
+        results = await drive_batch(headers, [
+            ("POST", "/drive/v3/files?fields=id", {"name": path.rpartition("/")[2], "mimeType": FOLDER_MIME_TYPE,
+                                                   "parents": [remote_folders[parent_path(path)]]})
+            for path in paths
+        ])
+        for path, (status, body) in zip(paths, results):
+            if status == 200:
+                remote_folders[path] = body["id"]
+            else:
+                failures.append({"path": path, "error": f"Folder creation failed: {status} {body}"})
+
+    failures += [{"path": path, "error": "Parent folder could not be created"}
+                 for path in created if parent_path(path) not in remote_folders]
+    jobs = [
+        (path, lambda path=path: upload_local(session_id, root, path, local_files[path]["size"],
+                                              local_files[path]["mtime"], parent_id=remote_folders[parent_path(path)]))
+        for path in created if parent_path(path) in remote_folders
+    ]
+    jobs += [
+        (path, lambda path=path: upload_local(session_id, root, path, local_files[path]["size"],
+                                              local_files[path]["mtime"], file_id=remote_files[path]["id"]))
+        for path in changed
+    ]
+    failures += await run_transfers(jobs)
+
+    batch = [("PATCH", f"/drive/v3/files/{remote_files[path]['id']}?fields=id",
+              {"modifiedTime": rfc3339(local_files[path]["mtime"])}) for path in touched]
+    batch_paths = list(touched)
+    for path in deleted:
+        file_id = remote_files[path]["id"] if path in remote_files else remote_folders[path]
+        batch.append(("DELETE", f"/drive/v3/files/{file_id}", None))
+        batch_paths.append(path)
+    for path, (status, body) in zip(batch_paths, await drive_batch(headers, batch)):
+        if status not in (200, 204):
+            failures.append({"path": path, "error": f"{status} {body}"})
+    await asyncio.to_thread(drive_index.mark_stale, session_id)  # The next listing catches up on these changes first
+    return summary, failures
+
+
+async def pull_folder(session_id, root, request, local_files, remote_files):
+    changed, unchanged, touched = await asyncio.to_thread(compare_files, root, local_files, remote_files)
+    downloadable = {path for path, remote in remote_files.items() if "md5Checksum" in remote}
+    created = [path for path in downloadable if path not in local_files]
+    deleted = [path for path in local_files if path not in remote_files] if request.delete else []
+    summary = {"created": created, "updated": changed, "deleted": deleted, "unchanged": len(unchanged) + len(touched),
+               "skipped": sorted(set(remote_files) - downloadable)}  # Google Docs have no downloadable content
+    if request.dry_run:
+        return summary, []
+
+    for path in touched:
+        modified = parse_rfc3339(remote_files[path]["modifiedTime"])
+        os.utime(os.path.join(root, path), (modified, modified))
+    failures = await run_transfers([
+        (path, lambda path=path: download_remote(session_id, root, path, remote_files[path]))
+        for path in created + changed
+    ])
+    for path in deleted:
+        os.remove(os.path.join(root, path))
+    return summary, failures
+
+
+# Step 7: Sync a local directory with a Drive folder, transferring only what differs
+@app.post("/sync")
+async def sync_folder(request: SyncRequest, session_id: str = Depends(get_session_id)):
+    credentials = await get_credentials(session_id)
+    if not credentials:
+        return {"error": "User not authenticated. Please login first."}
+    root = sync_directory(request.local_path)
+    if root is None:
+        return {"error": "local_path must stay inside DRIVE_SYNC_ROOT and not contain the app or its databases"}
+    if request.direction not in ("push", "pull"):
+        return {"error": "direction must be push or pull"}
+    if request.direction == "push" and not os.path.isdir(root):
+        return {"error": "Local directory not found", "local_path": request.local_path}
+    os.makedirs(root, exist_ok=True)
+
+    headers = {"Authorization": f"Bearer {credentials['access_token']}"}
+    try:
+        (local_files, local_folders), (remote_files, remote_folders) = await asyncio.gather(
+            asyncio.to_thread(scan_local, root), scan_remote(headers, request.folder_id))
+    except httpx.HTTPStatusError as e:
+        return {"error": "Failed to list Drive folder", "details": e.response.text}
+
+    if request.direction == "push":
+        summary, failures = await push_folder(session_id, headers, root, request, local_files, local_folders,
+                                              remote_files, remote_folders)
+    else:
+        summary, failures = await pull_folder(session_id, root, request, local_files, remote_files)
+    return {"message": "Dry run" if request.dry_run else "Sync complete", "direction": request.direction,
+            **summary, "failed": failures}
+
+
 # Run FastAPI server
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -1,81 +1,227 @@
 import uvicorn
-import requests
+import time
 import json
+import uuid
+import base64
+import asyncio
+import hashlib
 import os
+from typing import List, Optional
+from pydantic import BaseModel
 from fastapi import HTTPException
-from fastapi import FastAPI, Depends, Request
-from fastapi.responses import RedirectResponse
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request as GoogleRequest
-from google.auth.exceptions import RefreshError
+from fastapi import FastAPI, Depends, Request, Response
+from fastapi.responses import JSONResponse, RedirectResponse
+from http_client import get_client, lifespan, rate_limits
+from metrics import instrument, metrics_response
+from google_oauth import authorization_url, client_config, exchange_code
+from token_manager import TokenManager, TokenRefreshError, refresh_oauth_token, read_json
+from token_store import DEFAULT_SESSION, SESSION_COOKIE, get_session_id, login_session_id, token_store
+from calendar_store import calendar_store
+from rate_limiter import google_rate_limited, retry_after_seconds
 
 # Constants
 CLIENT_SECRETS_FILE = "credentials.json"
 SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
-REDIRECT_URI = "http://localhost:8000/auth/callback"
-CREDENTIALS_FILE = "session.json"  # File to store tokens
+REDIRECT_URI = os.getenv("MEET_REDIRECT_URI", "http://localhost:8000/auth/callback")
+CREDENTIALS_FILE = "session.json"  # Single-user token file of older versions, imported for the default session
+EVENTS_URL = "https://www.googleapis.com/calendar/v3/calendars/primary/events"
+SYNC_INTERVAL = float(os.getenv("CALENDAR_SYNC_INTERVAL", "30"))  # Minimum seconds between delta syncs per session
+DEFAULT_TIME_ZONE = "Asia/Kolkata"
+BATCH_CONCURRENCY = int(os.getenv("MEET_BATCH_CONCURRENCY", "10"))  # Event inserts in flight per batch request
+MAX_INSERT_RETRIES = 3
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+instrument(app, "meet")
 
 @app.get("/")
 async def root():
     return {"message": "Google Meet Connector API is running!"}
 
-# Load credentials file
-if not os.path.exists(CLIENT_SECRETS_FILE):
-    raise FileNotFoundError("credentials.json not found. Download it from Google Cloud Console.")
+
+# Upstream rate-limit budgets as learned from response headers
+@app.get("/rate_limits")
+async def get_rate_limits():
+    return rate_limits()
+
+
+# Route, upstream, token and cache metrics of this process in the Prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response()
+
+
+# Readiness: fails until the OAuth client secrets are in place
+@app.get("/health")
+async def health():
+    if client_config(CLIENT_SECRETS_FILE) is None:
+        return JSONResponse({"status": "unavailable", "missing": [CLIENT_SECRETS_FILE]}, status_code=503)
+    return {"status": "ok"}
 
 # Function to load saved credentials
-def load_credentials():
-    if os.path.exists(CREDENTIALS_FILE):
-        with open(CREDENTIALS_FILE, "r") as f:
-            return json.load(f)
-    return {}
+def load_credentials(session_id):
+    data = token_store.load("meet", session_id)
+    if data is None and session_id == DEFAULT_SESSION:
+        data = read_json(CREDENTIALS_FILE)
+        if data and "access_token" not in data:
+            data["access_token"] = data.pop("token", None)
+    return data
 
 # Function to save credentials
-def save_credentials(data):
-    with open(CREDENTIALS_FILE, "w") as f:
-        json.dump(data, f)
+def save_credentials(session_id, data):
+    token_store.save("meet", session_id, data)
+
+# Function to refresh an expiring access token
+async def refresh_credentials(data):
+    return await refresh_oauth_token(data["token_uri"], data["refresh_token"], data={
+        "client_id": data["client_id"],
+        "client_secret": data["client_secret"],
+    })
+
+# Credentials are cached in memory and refreshed in the background before they expire
+token_manager = TokenManager("meet", refresh_credentials, load=load_credentials, save=save_credentials)
+
+
+# Incremental calendar sync state
+calendar_syncs = {}  # session id -> in-flight sync task shared by concurrent readers
+last_synced = {}  # session id -> monotonic time of the last successful sync
+
+
+# Pulls changed events into the calendar store; a full sync only happens without a valid sync token
+async def sync_calendar(session_id, headers):
+    sync_token = await asyncio.to_thread(calendar_store.sync_token, session_id)
+    reset = sync_token is None
+    params = {"singleEvents": "true", "maxResults": 2500}
+    if sync_token:
+        params["syncToken"] = sync_token
+
+    while True:
+        response = await get_client().get(EVENTS_URL, headers=headers, params=params)
+        if response.status_code == 410:
+            # Sync token expired: start over with a full sync
+            params = {"singleEvents": "true", "maxResults": 2500}
+            reset = True
+            continue
+        response.raise_for_status()
+        page = response.json()
+        await asyncio.to_thread(calendar_store.apply, session_id, page.get("items", []),
+                                page.get("nextSyncToken"), reset)
+        reset = False
+        if "nextPageToken" not in page:
+            break
+        params = {**params, "pageToken": page["nextPageToken"]}
+
+    last_synced[session_id] = time.monotonic()
+
+
+async def refresh_calendar(session_id, headers):
+    task = calendar_syncs.get(session_id)
+    if task is None:
+        task = asyncio.ensure_future(sync_calendar(session_id, headers))
+        calendar_syncs[session_id] = task
+        task.add_done_callback(lambda _: calendar_syncs.pop(session_id, None))
+    await asyncio.shield(task)
+
+
+class MeetingSpec(BaseModel):
+    summary: str
+    start: str
+    end: str
+    time_zone: str = DEFAULT_TIME_ZONE
+    description: Optional[str] = None
+    attendees: List[str] = []
+    key: Optional[str] = None  # Caller supplied idempotency key; derived from the spec when omitted
+
+
+class BatchMeetingsRequest(BaseModel):
+    meetings: List[MeetingSpec]
+
+
+# The same spec always maps to the same event id and conference request id, so a retried
+# insert is answered with 409 by Calendar instead of creating a second meeting
+def meeting_key(session_id, spec):
+    fields = spec.model_dump(exclude={"key"}) if spec.key is None else {"key": spec.key}
+    payload = json.dumps({"session_id": session_id, **fields}, sort_keys=True)
+    digest = hashlib.sha256(payload.encode()).digest()
+    event_id = base64.b32hexencode(digest).decode().rstrip("=").lower()  # Event ids only allow a-v and 0-9
+    return digest.hex(), event_id
+
+
+def event_body(spec, request_id, event_id=None):
+    event = {
+        "summary": spec.summary,
+        "start": {"dateTime": spec.start, "timeZone": spec.time_zone},
+        "end": {"dateTime": spec.end, "timeZone": spec.time_zone},
+        "conferenceData": {"createRequest": {"requestId": request_id}},
+    }
+    if event_id:
+        event["id"] = event_id
+    if spec.description:
+        event["description"] = spec.description
+    if spec.attendees:
+        event["attendees"] = [{"email": email} for email in spec.attendees]
+    return event
+
+
+async def insert_meeting(headers, spec, session_id):
+    """ Inserts one meeting; an event that already exists under its key is returned instead of duplicated. """
+    request_id, event_id = meeting_key(session_id, spec)
+    result = {"key": request_id, "event_id": event_id}
+    for attempt in range(MAX_INSERT_RETRIES + 1):
+        response = await get_client().post(
+            f"{EVENTS_URL}?conferenceDataVersion=1",
+            json=event_body(spec, request_id, event_id),
+            headers=headers
+        )
+        if response.status_code == 409:
+            response = await get_client().get(f"{EVENTS_URL}/{event_id}", headers=headers)
+            if response.status_code == 200:
+                return {**result, "status": "existing", "event": response.json()}
+        if response.status_code == 200:
+            return {**result, "status": "created", "event": response.json()}
+        # Calendar reports rate limiting as 403 rateLimitExceeded as well as 429; other 403s are denials
+        throttled = response.status_code == 429 or (response.status_code == 403 and google_rate_limited(response.text))
+        if not (throttled or response.status_code in (500, 503)) or attempt == MAX_INSERT_RETRIES:
+            break
+        await asyncio.sleep(retry_after_seconds(response, 2 ** attempt))
+    return {**result, "status": "failed", "error": response.text}
 
 
 # Step 1: Login Route
 @app.get("/login", response_class=RedirectResponse)
-async def login():
-    """ Redirects user to Google OAuth 2.0 consent screen. """
-    flow = Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES, redirect_uri=REDIRECT_URI)
-    auth_url, _ = flow.authorization_url(prompt="consent")
+async def login(new_session: bool = False, session_id: str = Depends(get_session_id)):
+    """ Redirects user to Google OAuth 2.0 consent screen with a one-time state bound to the session. """
+    if client_config(CLIENT_SECRETS_FILE) is None:
+        return JSONResponse({"error": f"{CLIENT_SECRETS_FILE} not found. Download it from Google Cloud Console."},
+                            status_code=503)
+    auth_url = await asyncio.to_thread(authorization_url, CLIENT_SECRETS_FILE, SCOPES, REDIRECT_URI, "meet",
+                                       login_session_id(session_id, new_session))
     return RedirectResponse(auth_url)
 
 
 # Step 2: OAuth Callback
 @app.get("/auth/callback")
-async def auth_callback(request: Request):
+async def auth_callback(request: Request, response: Response):
     try:
-        query_params = dict(request.query_params)
         query_params = dict(request.query_params)
         code = query_params.get("code")
+        state = query_params.get("state")
 
         if not code:
             return {"error": "Missing OAuth authorization code. Please try logging in again."}
+        login = token_store.finish_login("meet", state)
+        if login is None:
+            return JSONResponse({"error": "Unknown or expired login state. Please try logging in again."},
+                                status_code=400)
+        session_id = login["session_id"]
 
-        flow = Flow.from_client_secrets_file(CLIENT_SECRETS_FILE, scopes=SCOPES, redirect_uri=REDIRECT_URI)
-        # flow.fetch_token(code=query_params.get("code"))
-        flow.fetch_token(code=code)
-        credentials = flow.credentials
-
-        # Save credentials to file
-        credentials_data = {
-            "token": credentials.token,
-            "refresh_token": credentials.refresh_token,
-            "token_uri": credentials.token_uri,
-            "client_id": credentials.client_id,
-            "client_secret": credentials.client_secret,
-        }
-        save_credentials(credentials_data)
+        credentials_data = await asyncio.to_thread(exchange_code, CLIENT_SECRETS_FILE, SCOPES, REDIRECT_URI,
+                                                   code, login.get("code_verifier"))
+        token_manager.set(session_id, credentials_data)
 
+        response.set_cookie(SESSION_COOKIE, session_id, httponly=True)
         return {"message": "Authentication successful!",
-                "access_token": credentials.token}
+                "access_token": credentials_data["access_token"],
+                "session_id": session_id}
 
     except Exception as e:
         return {"error": "Authentication failed", "details": str(e)}
@@ -83,72 +229,107 @@ async def auth_callback(request: Request):
 
 # Step 3: Generate Google Meet Link
 @app.post("/create_meeting")
-async def create_meeting():
+async def create_meeting(spec: Optional[MeetingSpec] = None, session_id: str = Depends(get_session_id)):
     try:
-        credentials_data = load_credentials()
+        credentials_data = await token_manager.get(session_id)
         if not credentials_data:
             return {"error": "User not authenticated. Please login first."}
 
-        credentials = Credentials.from_authorized_user_info(credentials_data)
-
-        # Refresh the token if expired
-        if credentials.expired and credentials.refresh_token:
-            credentials.refresh(GoogleRequest())
-            credentials_data["token"] = credentials.token
-            save_credentials(credentials_data)
-
-        event_data = {
-            "summary": "Google Meet AI Meeting",
-            "start": {"dateTime": "2025-03-26T10:00:00", "timeZone": "Asia/Kolkata"},
-            "end": {"dateTime": "2025-03-26T11:00:00", "timeZone": "Asia/Kolkata"},
-            "conferenceData": {"createRequest": {"requestId": "unique-meet-id"}},
-        }
-
-        headers = {"Authorization": f"Bearer {credentials.token}", "Content-Type": "application/json"}
-        response = requests.post(
-            "https://www.googleapis.com/calendar/v3/calendars/primary/events?conferenceDataVersion=1",
-            json=event_data,
-            headers=headers
-        )
-
-        response_json = response.json()
+        headers = {"Authorization": f"Bearer {credentials_data['access_token']}", "Content-Type": "application/json"}
+        if spec is not None:
+            result = await insert_meeting(headers, spec, session_id)
+            if result["status"] == "failed":
+                return {"error": result["error"]}
+            response_json = result["event"]
+        else:
+            default_spec = MeetingSpec(summary="Google Meet AI Meeting",
+                                       start="2025-03-26T10:00:00", end="2025-03-26T11:00:00")
+            # No spec means no identity to derive a key from, so every call gets a fresh conference
+            response = await get_client().post(
+                f"{EVENTS_URL}?conferenceDataVersion=1",
+                json=event_body(default_spec, uuid.uuid4().hex),
+                headers=headers
+            )
+            response_json = response.json()
+            if response.status_code != 200:
+                response_json = {}
+
+        if response_json:
+            await asyncio.to_thread(calendar_store.apply, session_id, [response_json])
         meet_link = response_json.get("hangoutLink", "Meeting link not generated")
         return {"message": "Meeting Created", "meet_link": meet_link}
 
-    except RefreshError:
+    except TokenRefreshError:
         return {"error": "Token expired, please re-authenticate."}
     except Exception as e:
         return {"error": str(e)}
 
 
-# Step 4: Retrieve Google Meet Events
-@app.get("/meetings")
-async def get_meetings():
+# Step 3b: Create many meetings at once; safe to retry as a whole
+@app.post("/meetings/batch")
+async def create_meetings(batch: BatchMeetingsRequest, session_id: str = Depends(get_session_id)):
     try:
-        credentials_data = load_credentials()
+        credentials_data = await token_manager.get(session_id)
         if not credentials_data:
             return {"error": "User not authenticated. Please login first."}
 
-        credentials = Credentials.from_authorized_user_info(credentials_data)
+        headers = {"Authorization": f"Bearer {credentials_data['access_token']}", "Content-Type": "application/json"}
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def insert(spec):
+            async with semaphore:
+                try:
+                    return await insert_meeting(headers, spec, session_id)
+                except Exception as e:
+                    request_id, event_id = meeting_key(session_id, spec)
+                    return {"key": request_id, "event_id": event_id, "status": "failed", "error": str(e)}
+
+        results = await asyncio.gather(*(insert(spec) for spec in batch.meetings))
+        events = []
+        for result in results:
+            if "event" in result:
+                event = result.pop("event")
+                result["meet_link"] = event.get("hangoutLink")
+                events.append(event)
+        await asyncio.to_thread(calendar_store.apply, session_id, events)
+
+        counts = {status: sum(result["status"] == status for result in results)
+                  for status in ("created", "existing", "failed")}
+        return {"message": "Meetings Created", **counts, "meetings": results}
+
+    except TokenRefreshError:
+        return {"error": "Token expired, please re-authenticate."}
+    except Exception as e:
+        return {"error": str(e)}
 
-        # Refresh the token if expired
-        if credentials.expired and credentials.refresh_token:
-            credentials.refresh(GoogleRequest())
-            credentials_data["token"] = credentials.token
-            save_credentials(credentials_data)
 
-        headers = {"Authorization": f"Bearer {credentials.token}"}
-        response = requests.get(
-            "https://www.googleapis.com/calendar/v3/calendars/primary/events",
-            headers=headers
-        )
+# Meet events of a session from the local store, after a delta sync if the last one is older than SYNC_INTERVAL;
+# None when the session has no login. Shared with the unified meetings feed.
+async def stored_meetings(session_id, time_min=None, time_max=None, refresh=True):
+    credentials_data = await token_manager.get(session_id)
+    if not credentials_data:
+        return None
+
+    headers = {"Authorization": f"Bearer {credentials_data['access_token']}"}
+    if refresh and time.monotonic() - last_synced.get(session_id, float("-inf")) > SYNC_INTERVAL:
+        await refresh_calendar(session_id, headers)
+    return await asyncio.to_thread(calendar_store.query, session_id, time_min, time_max, True)
+
+
+# Step 4: Retrieve Google Meet Events
+@app.get("/meetings")
+async def get_meetings(time_min: Optional[str] = None, time_max: Optional[str] = None, refresh: bool = True,
+                       session_id: str = Depends(get_session_id)):
+    """ Serves Meet events from the local store, after a delta sync if the last one is older than SYNC_INTERVAL. """
+    try:
+        meetings = await stored_meetings(session_id, time_min, time_max, refresh)
+        if meetings is None:
+            return {"error": "User not authenticated. Please login first."}
 
-        response_json = response.json()
-        events = response_json.get("items", [])
-        meet_links = [event["hangoutLink"] for event in events if "hangoutLink" in event]
-        return {"message": "Meetings Retrieved", "meet_links": meet_links}
+        meet_links = [meeting["hangout_link"] for meeting in meetings]
+        return {"message": "Meetings Retrieved", "meet_links": meet_links, "meetings": meetings}
 
-    except RefreshError:
+    except TokenRefreshError:
         return {"error": "Token expired, please re-authenticate."}
     except Exception as e:
         return {"error": str(e)}
@@ -1,42 +1,217 @@
-from fastapi import FastAPI, Request
-import requests
+from fastapi import FastAPI, Request, Response, Depends
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from pydantic import BaseModel
+from typing import List, Optional
 import os
+import re
+import json
+import time
+import asyncio
+import secrets
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from http_client import get_client, lifespan, rate_limits
+from metrics import instrument, metrics_response
+from token_manager import TokenManager, TokenRefreshError, refresh_oauth_token
+from token_store import SESSION_COOKIE, get_session_id, login_session_id, token_store
 
 load_dotenv()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+instrument(app, "teams")
 
 @app.get("/")
-def home():
+async def home():
     return {"message": "Welcome to the Microsoft Teams Connector API!"}
 
+
+# Upstream rate-limit budgets as learned from response headers
+@app.get("/rate_limits")
+async def get_rate_limits():
+    return rate_limits()
+
+
+# Route, upstream, token and cache metrics of this process in the Prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response()
+
 # Microsoft Azure Credentials
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 TENANT_ID = os.getenv("TENANT_ID")
-REDIRECT_URI = "http://localhost:8000/auth/callback"
+REDIRECT_URI = os.getenv("TEAMS_REDIRECT_URI", "http://localhost:8000/auth/callback")
 AUTH_URL = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/authorize"
 TOKEN_URL = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
 GRAPH_API_URL = "https://graph.microsoft.com/v1.0"
+SCOPE = "User.Read Chat.ReadWrite Presence.Read Presence.Read.All Calendars.Read offline_access"
+NOT_AUTHENTICATED = {"error": "User not authenticated. Please login first."}
+GRAPH_BATCH_LIMIT = 20  # Graph accepts at most 20 requests per $batch
+CALENDAR_PAGE_SIZE = 100
+CALENDAR_FIELDS = "id,subject,start,end,isOnlineMeeting,onlineMeeting,webLink"
+MAX_BATCH_RETRIES = 3
+
+# Presence Configuration
+PRESENCE_BATCH_LIMIT = 650  # ids per getPresencesByUserId call and per presence subscription
+PRESENCE_CONCURRENCY = 4
+PRESENCE_MAX_AGE = float(os.getenv("PRESENCE_MAX_AGE", "30"))  # seconds a polled entry is served without refetch
+PRESENCE_SUBSCRIPTION_MINUTES = 55  # Graph caps presence subscriptions at one hour
+PRESENCE_NOTIFICATION_URL = os.getenv("PRESENCE_NOTIFICATION_URL")
+# Must be the same in every worker so any of them can verify a notification
+PRESENCE_CLIENT_STATE = os.getenv("PRESENCE_CLIENT_STATE") or secrets.token_urlsafe(16)
+# A notification reaches only one worker, so with several workers subscribed entries still expire after max_age
+PRESENCE_TRUST_SUBSCRIPTIONS = int(os.getenv("WEB_CONCURRENCY", "1")) <= 1
+
+presence_table = {}  # user id -> (presence, monotonic time it was fetched or notified)
+presence_inflight = {}  # user id -> future resolved once the batch fetching it finishes
+presence_subscriptions = {}  # subscription id -> {"session_id": ..., "ids": [...]}
+watched_until = {}  # user id -> monotonic expiry of the subscription keeping its entry current
+background_tasks = set()
+
+# Tokens stay in memory and are refreshed in the background before they expire
+async def refresh_user_token(token_data):
+    return await refresh_oauth_token(TOKEN_URL, token_data["refresh_token"], data={
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+        "scope": SCOPE,
+    })
+
+# Per-session tokens, shared with other workers through the token store
+user_tokens = TokenManager("teams", refresh_user_token, load=token_store.loader("teams"),
+                           save=token_store.saver("teams"))
+
+# Readiness: fails while the Azure app registration is not configured
+@app.get("/health")
+async def health():
+    missing = [name for name, value in (("CLIENT_ID", CLIENT_ID), ("CLIENT_SECRET", CLIENT_SECRET),
+                                        ("TENANT_ID", TENANT_ID)) if not value]
+    if missing:
+        return JSONResponse({"status": "unavailable", "missing": missing}, status_code=503)
+    return {"status": "ok"}
+
+async def graph_headers(session_id):
+    try:
+        access_token = await user_tokens.access_token(session_id)
+    except TokenRefreshError:
+        access_token = None
+    if not access_token:
+        return None
+    return {"Authorization": f"Bearer {access_token}"}
 
-user_tokens = {}
+# Sends Graph requests ({"method", "url", optional "body"}, url relative to GRAPH_API_URL)
+# as $batch POSTs and returns the sub-responses in request order
+async def graph_batch(headers, batch_requests):
+    responses = [None] * len(batch_requests)
+    pending = list(range(len(batch_requests)))
+
+    for attempt in range(MAX_BATCH_RETRIES + 1):
+        chunks = [pending[i:i + GRAPH_BATCH_LIMIT] for i in range(0, len(pending), GRAPH_BATCH_LIMIT)]
+        for i in pending:
+            responses[i] = None
+        await asyncio.gather(*(post_batch(headers, batch_requests, chunk, responses) for chunk in chunks))
+
+        # Only throttled sub-requests are sent again, after the longest Retry-After among them
+        pending = [i for i in pending if responses[i]["status"] == 429]
+        if not pending or attempt == MAX_BATCH_RETRIES:
+            break
+        await asyncio.sleep(max(retry_after(responses[i]) for i in pending))
+
+    return responses
+
+def retry_after(sub_response):
+    # Header names keep whatever case the batch or the sub-response used
+    headers = {name.lower(): value for name, value in (sub_response.get("headers") or {}).items()}
+    try:
+        return float(headers.get("retry-after", 1))
+    except ValueError:
+        return 1.0
+
+async def post_batch(headers, batch_requests, indexes, responses):
+    payload = {"requests": []}
+    for i in indexes:
+        sub_request = {"id": str(i), "method": batch_requests[i]["method"], "url": batch_requests[i]["url"]}
+        if "body" in batch_requests[i]:
+            sub_request["body"] = batch_requests[i]["body"]
+            sub_request["headers"] = {"Content-Type": "application/json"}
+        payload["requests"].append(sub_request)
+
+    response = await get_client().post(f"{GRAPH_API_URL}/$batch", headers=headers, json=payload)
+    if response.status_code != 200:
+        # The whole batch was rejected (e.g. throttled or unauthorized); report it on every sub-request
+        for i in indexes:
+            responses[i] = {"id": str(i), "status": response.status_code, "headers": dict(response.headers),
+                            "body": response.text}
+        return
+    for sub_response in response.json().get("responses", []):
+        responses[int(sub_response["id"])] = sub_response
+    for i in indexes:
+        if responses[i] is None:
+            # Graph left this sub-request out of the batch response; report it as failed rather than retrying
+            responses[i] = {"id": str(i), "status": 502, "headers": {},
+                            "body": {"error": {"code": "missingResponse",
+                                               "message": "No response for this request in the $batch reply"}}}
+
+# Yields the items of a Graph collection, fetching the next page only when the previous one is consumed.
+# Headers are looked up per page so the token is refreshed during long listings.
+async def graph_pages(session_id, url, params=None):
+    while url:
+        headers = await graph_headers(session_id)
+        if headers is None:
+            yield NOT_AUTHENTICATED
+            return
+        response = await get_client().get(url, headers=headers, params=params)
+        if response.status_code != 200:
+            yield {"error": "Graph request failed", "status": response.status_code, "details": response.text}
+            return
+        page = response.json()
+        for item in page.get("value", []):
+            yield item
+        url = page.get("@odata.nextLink")
+        params = None  # nextLink already carries the query
+
+# Events of the user's calendar overlapping [start, end), earliest first, with times in UTC.
+# Items are yielded like graph_pages, errors included; used by the unified meetings feed.
+def calendar_view(session_id, start, end):
+    return graph_pages(session_id, f"{GRAPH_API_URL}/me/calendarView", {
+        "startDateTime": start,
+        "endDateTime": end,
+        "$orderby": "start/dateTime",
+        "$top": CALENDAR_PAGE_SIZE,
+        "$select": CALENDAR_FIELDS,
+    })
+
+def odata_params(top=None, select=None):
+    params = {}
+    if top:
+        params["$top"] = top
+    if select:
+        params["$select"] = select
+    return params
+
+async def ndjson(items):
+    async for item in items:
+        yield json.dumps(item) + "\n"
 
 # Step 1: Redirect user to Microsoft Login
 @app.get("/login")
-def login():
+async def login(new_session: bool = False, session_id: str = Depends(get_session_id)):
+    state = token_store.begin_login("teams", login_session_id(session_id, new_session))
     auth_redirect_url = (
         f"{AUTH_URL}?client_id={CLIENT_ID}&response_type=code&redirect_uri={REDIRECT_URI}"
-        f"&scope=User.Read Chat.ReadWrite Presence.Read Calendars.Read offline_access"
+        f"&scope={SCOPE}&state={state}"
     )
     return {"message": "Click the link to login", "url": auth_redirect_url}
 
 # Step 2: Handle OAuth Callback & Get Access Token
 @app.get("/auth/callback")
-def auth_callback(request: Request):
+async def auth_callback(request: Request, response: Response):
     code = request.query_params.get("code")
     if not code:
         return {"error": "Authorization code not found"}
+    login = token_store.finish_login("teams", request.query_params.get("state"))
+    if login is None:
+        return JSONResponse({"error": "Unknown or expired login state"}, status_code=400)
+    session_id = login["session_id"]
 
     data = {
         "client_id": CLIENT_ID,
@@ -44,45 +219,278 @@ def auth_callback(request: Request):
         "grant_type": "authorization_code",
         "code": code,
         "redirect_uri": REDIRECT_URI,
-        "scope": "User.Read Chat.ReadWrite Presence.Read Calendars.Read offline_access"
+        "scope": SCOPE
     }
 
-    response = requests.post(TOKEN_URL, data=data)
-    if response.status_code == 200:
-        token_data = response.json()
-        user_tokens["access_token"] = token_data["access_token"]
-        return {"message": "Authentication successful", "access_token": token_data["access_token"]}
+    token_response = await get_client().post(TOKEN_URL, data=data)
+    if token_response.status_code == 200:
+        token_data = token_response.json()
+        user_tokens.set(session_id, {
+            "access_token": token_data["access_token"],
+            "refresh_token": token_data.get("refresh_token"),
+            "expires_at": time.time() + int(token_data.get("expires_in", 3600)),
+        })
+        response.set_cookie(SESSION_COOKIE, session_id, httponly=True)
+        return {"message": "Authentication successful", "access_token": token_data["access_token"],
+                "session_id": session_id}
     else:
-        return {"error": "Failed to authenticate", "details": response.json()}
+        return {"error": "Failed to authenticate", "details": token_response.json()}
 
 # Step 3: Fetch User Profile
 @app.get("/me")
-def get_user():
-    headers = {"Authorization": f"Bearer {user_tokens.get('access_token')}"}
-    response = requests.get(f"{GRAPH_API_URL}/me", headers=headers)
+async def get_user(session_id: str = Depends(get_session_id)):
+    headers = await graph_headers(session_id)
+    if headers is None:
+        return NOT_AUTHENTICATED
+    response = await get_client().get(f"{GRAPH_API_URL}/me", headers=headers)
     return response.json()
 
 # Step 4: Get User Presence (Online/Busy/Away)
 @app.get("/me/presence")
-def get_user_presence():
-    headers = {"Authorization": f"Bearer {user_tokens.get('access_token')}"}
-    response = requests.get(f"{GRAPH_API_URL}/me/presence", headers=headers)
+async def get_user_presence(session_id: str = Depends(get_session_id)):
+    headers = await graph_headers(session_id)
+    if headers is None:
+        return NOT_AUTHENTICATED
+    response = await get_client().get(f"{GRAPH_API_URL}/me/presence", headers=headers)
     return response.json()
 
 # Step 5: Fetch User Chats
 @app.get("/me/chats")
-def get_user_chats():
-    headers = {"Authorization": f"Bearer {user_tokens.get('access_token')}"}
-    response = requests.get(f"{GRAPH_API_URL}/me/chats", headers=headers)
+async def get_user_chats(top: Optional[int] = None, select: Optional[str] = None,
+                         session_id: str = Depends(get_session_id)):
+    headers = await graph_headers(session_id)
+    if headers is None:
+        return NOT_AUTHENTICATED
+    response = await get_client().get(f"{GRAPH_API_URL}/me/chats", headers=headers, params=odata_params(top, select))
     return response.json()
 
+# Step 5a: Stream every Chat as NDJSON, following @odata.nextLink page by page
+@app.get("/me/chats/stream")
+async def stream_user_chats(top: Optional[int] = None, select: Optional[str] = None,
+                            session_id: str = Depends(get_session_id)):
+    pages = graph_pages(session_id, f"{GRAPH_API_URL}/me/chats", odata_params(top, select))
+    return StreamingResponse(ndjson(pages), media_type="application/x-ndjson")
+
+# Step 5c: Stream every Message of a Chat as NDJSON
+@app.get("/chats/{chat_id}/messages/stream")
+async def stream_chat_messages(chat_id: str, top: Optional[int] = None, select: Optional[str] = None,
+                               session_id: str = Depends(get_session_id)):
+    pages = graph_pages(session_id, f"{GRAPH_API_URL}/chats/{chat_id}/messages", odata_params(top, select))
+    return StreamingResponse(ndjson(pages), media_type="application/x-ndjson")
+
+# Step 5b: Profile, Presence and Chats in one Graph round trip
+@app.get("/me/overview")
+async def get_user_overview(session_id: str = Depends(get_session_id)):
+    headers = await graph_headers(session_id)
+    if headers is None:
+        return NOT_AUTHENTICATED
+    me, presence, chats = await graph_batch(headers, [
+        {"method": "GET", "url": "/me"},
+        {"method": "GET", "url": "/me/presence"},
+        {"method": "GET", "url": "/me/chats"},
+    ])
+    return {"me": me["body"], "presence": presence["body"], "chats": chats["body"]}
+
 # Step 6: Send Message to a Chat
 @app.post("/send_message/{chat_id}")
-def send_message(chat_id: str, message: str):
-    headers = {
-        "Authorization": f"Bearer {user_tokens.get('access_token')}",
-        "Content-Type": "application/json"
-    }
+async def send_message(chat_id: str, message: str, session_id: str = Depends(get_session_id)):
+    headers = await graph_headers(session_id)
+    if headers is None:
+        return NOT_AUTHENTICATED
     data = {"body": {"content": message}}
-    response = requests.post(f"{GRAPH_API_URL}/me/chats/{chat_id}/messages", headers=headers, json=data)
+    response = await get_client().post(f"{GRAPH_API_URL}/me/chats/{chat_id}/messages", headers=headers, json=data)
     return response.json()
+
+# format of request body for sending one message to many chats
+class BroadcastMessageRequest(BaseModel):
+    chat_ids: List[str]
+    message: str
+
+# Step 6b: Send the same Message to many Chats, 20 per Graph $batch
+@app.post("/send_message")
+async def send_message_to_chats(request: BroadcastMessageRequest, session_id: str = Depends(get_session_id)):
+    headers = await graph_headers(session_id)
+    if headers is None:
+        return NOT_AUTHENTICATED
+    data = {"body": {"content": request.message}}
+    responses = await graph_batch(headers, [
+        {"method": "POST", "url": f"/me/chats/{chat_id}/messages", "body": data} for chat_id in request.chat_ids
+    ])
+    return {"results": [
+        {"chat_id": chat_id, "status": response["status"], "body": response.get("body")}
+        for chat_id, response in zip(request.chat_ids, responses)
+    ]}
+
+# Presence subsystem: many users' presence served from an in-memory table, refreshed in bulk
+# through getPresencesByUserId and kept current by change notifications where subscribed
+def presence_is_fresh(user_id, now, max_age):
+    entry = presence_table.get(user_id)
+    if entry is None:
+        return False
+    return now - entry[1] <= max_age or (PRESENCE_TRUST_SUBSCRIPTIONS and watched_until.get(user_id, 0) > now)
+
+async def refresh_presences(headers, ids):
+    loop = asyncio.get_running_loop()
+    ids = list(dict.fromkeys(ids))  # A repeated id would otherwise register, and resolve, its future twice
+    waiting = [presence_inflight[user_id] for user_id in ids if user_id in presence_inflight]
+    mine = [user_id for user_id in ids if user_id not in presence_inflight]
+    for user_id in mine:
+        presence_inflight[user_id] = loop.create_future()
+
+    semaphore = asyncio.Semaphore(PRESENCE_CONCURRENCY)
+
+    async def fetch_batch(batch):
+        async with semaphore:
+            response = await get_client().post(f"{GRAPH_API_URL}/communications/getPresencesByUserId",
+                                               headers=headers, json={"ids": batch})
+        if response.status_code == 200:
+            fetched_at = time.monotonic()
+            for presence in response.json().get("value", []):
+                presence_table[presence["id"]] = (presence, fetched_at)
+
+    try:
+        batches = [mine[i:i + PRESENCE_BATCH_LIMIT] for i in range(0, len(mine), PRESENCE_BATCH_LIMIT)]
+        await asyncio.gather(*(fetch_batch(batch) for batch in batches), return_exceptions=True)
+    finally:
+        for user_id in mine:
+            future = presence_inflight.pop(user_id, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+    if waiting:
+        await asyncio.gather(*waiting)
+
+# format of request body for bulk presence reads
+class PresenceRequest(BaseModel):
+    ids: List[str]
+    max_age: Optional[float] = None
+
+# Step 7: Presence for many Users, served from the presence table
+@app.post("/presence")
+async def get_presences(request: PresenceRequest, session_id: str = Depends(get_session_id)):
+    headers = await graph_headers(session_id)
+    if headers is None:
+        return NOT_AUTHENTICATED
+    max_age = PRESENCE_MAX_AGE if request.max_age is None else request.max_age
+    now = time.monotonic()
+    stale = [user_id for user_id in dict.fromkeys(request.ids) if not presence_is_fresh(user_id, now, max_age)]
+    if stale:
+        await refresh_presences(headers, stale)
+
+    presences, missing = [], []
+    for user_id in request.ids:
+        entry = presence_table.get(user_id)
+        if entry is None:
+            missing.append(user_id)
+        else:
+            presences.append(entry[0])
+    return {"presences": presences, "missing": missing, "fetched": len(stale)}
+
+# format of request body for presence change subscriptions
+class PresenceSubscriptionRequest(BaseModel):
+    ids: List[str]
+    notification_url: Optional[str] = None
+
+def subscription_expiry():
+    expires = datetime.now(timezone.utc) + timedelta(minutes=PRESENCE_SUBSCRIPTION_MINUTES)
+    return expires.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+
+async def renew_presence_subscription(subscription_id):
+    # Renews shortly before Graph expires the subscription; stops once it is deleted or renewal fails
+    while subscription_id in presence_subscriptions:
+        await asyncio.sleep((PRESENCE_SUBSCRIPTION_MINUTES - 5) * 60)
+        subscription = presence_subscriptions.get(subscription_id)
+        headers = await graph_headers(subscription["session_id"]) if subscription else None
+        if headers is None:
+            break
+        response = await get_client().patch(f"{GRAPH_API_URL}/subscriptions/{subscription_id}", headers=headers,
+                                            json={"expirationDateTime": subscription_expiry()})
+        if response.status_code != 200:
+            break
+        watch_until = time.monotonic() + PRESENCE_SUBSCRIPTION_MINUTES * 60
+        for user_id in subscription["ids"]:
+            watched_until[user_id] = watch_until
+    presence_subscriptions.pop(subscription_id, None)
+
+def run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+# Step 8: Subscribe to Presence changes so subscribed entries stay current without polling
+@app.post("/presence/subscribe")
+async def subscribe_presences(request: PresenceSubscriptionRequest, session_id: str = Depends(get_session_id)):
+    headers = await graph_headers(session_id)
+    if headers is None:
+        return NOT_AUTHENTICATED
+    notification_url = request.notification_url or PRESENCE_NOTIFICATION_URL
+    if not notification_url:
+        return {"error": "No notification_url given and PRESENCE_NOTIFICATION_URL is not set"}
+
+    ids = list(dict.fromkeys(request.ids))
+    results = []
+    for i in range(0, len(ids), PRESENCE_BATCH_LIMIT):
+        batch = ids[i:i + PRESENCE_BATCH_LIMIT]
+        id_filter = ",".join(f"'{user_id}'" for user_id in batch)
+        response = await get_client().post(f"{GRAPH_API_URL}/subscriptions", headers=headers, json={
+            "changeType": "updated",
+            "notificationUrl": notification_url,
+            "resource": f"/communications/presences?$filter=id in ({id_filter})",
+            "expirationDateTime": subscription_expiry(),
+            "clientState": PRESENCE_CLIENT_STATE,
+        })
+        if response.status_code != 201:
+            results.append({"error": "Subscription failed", "status": response.status_code, "details": response.text})
+            continue
+        subscription_id = response.json()["id"]
+        presence_subscriptions[subscription_id] = {"session_id": session_id, "ids": batch}
+        watch_until = time.monotonic() + PRESENCE_SUBSCRIPTION_MINUTES * 60
+        for user_id in batch:
+            watched_until[user_id] = watch_until
+        run_in_background(renew_presence_subscription(subscription_id))
+        results.append({"subscription_id": subscription_id, "users": len(batch)})
+
+    # Prime the table so subscribed users can be read right away
+    await refresh_presences(headers, ids)
+    return {"subscriptions": results}
+
+@app.delete("/presence/subscriptions/{subscription_id}")
+async def unsubscribe_presences(subscription_id: str, session_id: str = Depends(get_session_id)):
+    headers = await graph_headers(session_id)
+    if headers is None:
+        return NOT_AUTHENTICATED
+    subscription = presence_subscriptions.pop(subscription_id, None)
+    for user_id in (subscription or {}).get("ids", []):
+        watched_until.pop(user_id, None)
+    response = await get_client().delete(f"{GRAPH_API_URL}/subscriptions/{subscription_id}", headers=headers)
+    return {"deleted": response.status_code == 204}
+
+# Step 9: Graph change notifications for Presence (also answers the subscription validation handshake)
+@app.post("/presence/notifications")
+async def presence_notifications(request: Request, validationToken: Optional[str] = None):
+    if validationToken is not None:
+        return PlainTextResponse(validationToken)
+
+    payload = await request.json()
+    now = time.monotonic()
+    changed = {}  # session id -> user ids whose notification carried no presence data
+    for notification in payload.get("value", []):
+        if notification.get("clientState") != PRESENCE_CLIENT_STATE:
+            continue
+        match = re.search(r"presences\('([^']+)'\)", notification.get("resource", ""))
+        if not match:
+            continue
+        user_id = match.group(1)
+        resource_data = notification.get("resourceData") or {}
+        if "availability" in resource_data:
+            presence_table[user_id] = ({**resource_data, "id": user_id}, now)
+            continue
+        subscription = presence_subscriptions.get(notification.get("subscriptionId"))
+        if subscription:
+            presence_table.pop(user_id, None)
+            changed.setdefault(subscription["session_id"], []).append(user_id)
+
+    for session_id, ids in changed.items():
+        headers = await graph_headers(session_id)
+        if headers is not None:
+            run_in_background(refresh_presences(headers, list(dict.fromkeys(ids))))
+    return Response(status_code=202)
@@ -1,21 +1,109 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
 import os
+import json
+import asyncio
+from collections import OrderedDict
 from dotenv import load_dotenv
+from http_client import get_client, lifespan, rate_limits
+from rate_limiter import upstream_limiter
+from metrics import instrument, metrics_response, track_cache
+from response_cache import InvalidationLog, ResponseCache
 
 load_dotenv()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+instrument(app, "trello")
 
 TRELLO_KEY = os.getenv("TRELLO_API_KEY")
 TRELLO_TOKEN = os.getenv("TRELLO_TOKEN")
 BASE_URL = "https://api.trello.com/1"
+CACHE_TTL = float(os.getenv("TRELLO_CACHE_TTL", "30"))  # seconds before a cached read is revalidated
+CACHE_MAX_ENTRIES = int(os.getenv("TRELLO_CACHE_MAX_ENTRIES", "2048"))
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))  # Set by the gateway (and read by uvicorn) for worker pools
+
+# Pacing and 429 retries are left to the shared client's RateLimitedTransport, which sizes the
+# token's budget from Trello's x-rate-limit-api-token-* headers. Until the first of those arrive it
+# paces at the documented 100 requests per 10 s per token, so a bulk create does not start with a burst.
+TOKEN_LIMIT = int(os.getenv("TRELLO_TOKEN_LIMIT", "100"))
+LIMIT_WINDOW = 10
+upstream_limiter.document_limit("api.trello.com", TOKEN_LIMIT, LIMIT_WINDOW)
+BULK_CONCURRENCY = int(os.getenv("TRELLO_BULK_CONCURRENCY", "20"))
+SNAPSHOT_CONCURRENCY = int(os.getenv("TRELLO_SNAPSHOT_CONCURRENCY", "8"))
+LIST_BOARDS_MAX = int(os.getenv("TRELLO_LIST_BOARDS_MAX", "10000"))
+
+# Attributes a board snapshot carries unless the caller asks for others
+DEFAULT_LIST_FIELDS = "name,pos,closed,idBoard"
+DEFAULT_CARD_FIELDS = "name,desc,idList,pos,due,labels,idMembers"
+
+list_boards = OrderedDict()  # list id -> board id (LRU), so a new card can invalidate its board's cached snapshot
+
+
+def remember_board(list_id, board_id):
+    list_boards[list_id] = board_id
+    list_boards.move_to_end(list_id)
+    while len(list_boards) > LIST_BOARDS_MAX:
+        list_boards.popitem(last=False)
+
+
+def list_dependents(path):
+    # A list's cards are also part of its board's snapshot, when this worker knows the board
+    if path.startswith("/lists/") and path.endswith("/cards"):
+        board_id = list_boards.get(path[len("/lists/"):-len("/cards")])
+        if board_id is not None:
+            return [f"/boards/{board_id}/lists"]
+    return []
+
+
+# Read cache shared by the board, list and card endpoints. With several workers, invalidations go
+# through the shared log so a card created on one worker is not served stale by another.
+read_cache = ResponseCache(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, dependents=list_dependents,
+                           shared=InvalidationLog("trello") if WORKERS > 1 else None)
+track_cache("trello", read_cache)
+
+async def cached_get(path, params=None):
+    """ GETs a Trello resource through the read cache; identical concurrent reads share one call. """
+    params = params or {}
+    query = {"key": TRELLO_KEY, "token": TRELLO_TOKEN, **params}
+
+    async def load(headers):
+        response = await get_client().get(f"{BASE_URL}{path}", params=query, headers=headers)
+        if response.status_code == 200:
+            return 200, response.json(), response.headers.get("ETag")
+        if response.status_code == 304:
+            return 304, None, None
+        return response.status_code, response.text, None
+
+    status_code, data = await read_cache.get(ResponseCache.make_key(path, params), load)
+    if status_code != 200:
+        raise HTTPException(status_code=status_code, detail=data)
+    return data
 
 @app.get("/")
 async def root():
     return {"message": "Trello Connector API is running"}
 
+
+# Upstream rate-limit budgets as learned from response headers
+@app.get("/rate_limits")
+async def get_rate_limits():
+    return rate_limits()
+
+
+# Route, upstream, token and cache metrics of this process in the Prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response()
+
+# Readiness: fails while the Trello credentials are not configured
+@app.get("/health")
+async def health():
+    missing = [name for name, value in (("TRELLO_API_KEY", TRELLO_KEY), ("TRELLO_TOKEN", TRELLO_TOKEN)) if not value]
+    if missing:
+        return JSONResponse({"status": "unavailable", "missing": missing}, status_code=503)
+    return {"status": "ok"}
+
 # format of request body in create card
 class CardCreateRequest(BaseModel):
     name: str
@@ -24,49 +112,173 @@ class CardCreateRequest(BaseModel):
 
 @app.get("/boards")
 async def get_boards():
-    url = f"{BASE_URL}/members/me/boards"
-    params = {"key": TRELLO_KEY, "token": TRELLO_TOKEN}
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, params=params)
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail=response.text)
-    return response.json()
+    return await cached_get("/members/me/boards")
 
 
 @app.get("/lists/{board_id}")
 async def get_lists(board_id: str):
-    url = f"{BASE_URL}/boards/{board_id}/lists"
-    params = {"key": TRELLO_KEY, "token": TRELLO_TOKEN}
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, params=params)
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail=response.text)
-    return response.json()
+    return await cached_get(f"/boards/{board_id}/lists")
 
 
-@app.post("/cards")
-async def create_card(request: CardCreateRequest):
+async def post_card(card: CardCreateRequest):
+    """ Creates one card; the transport paces it within the token's budget and retries 429s. """
     url = f"{BASE_URL}/cards"
     params = {
         "key": TRELLO_KEY,
         "token": TRELLO_TOKEN,
-        "idList": request.idList,
-        "name": request.name,
-        "desc": request.desc,
+        "idList": card.idList,
+        "name": card.name,
+        "desc": card.desc,
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, params=params)
+    response = await get_client().post(url, params=params)
+
+    if response.status_code == 200:
+        await read_cache.invalidate(f"/lists/{card.idList}/cards")  # Its board's snapshot goes with it
+    return response
+
+
+@app.post("/cards")
+async def create_card(request: CardCreateRequest):
+    response = await post_card(request)
     if response.status_code != 200:
         raise HTTPException(status_code=response.status_code, detail=response.text)
     return response.json()
 
 
+async def read_bulk_cards(http_request: Request):
+    """ Yields raw card objects from a JSON array body or, line by line, from an NDJSON stream. """
+    content_type = http_request.headers.get("content-type", "")
+    if "ndjson" not in content_type:
+        body = await http_request.json()
+        if not isinstance(body, list):
+            raise ValueError("expected a JSON array of cards")
+        for item in body:
+            yield item
+        return
+
+    buffer = b""
+    async for chunk in http_request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if buffer.strip():
+        yield json.loads(buffer)
+
+
+@app.post("/cards/bulk")
+async def create_cards_bulk(http_request: Request):
+    """
+    Creates many cards concurrently under the Trello rate limits. Accepts a JSON array of
+    CardCreateRequest objects or an application/x-ndjson stream of them, and streams one NDJSON
+    result line per card as it completes.
+    """
+    results = asyncio.Queue()
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def create(index, item):
+        try:
+            card = CardCreateRequest(**item)
+            response = await post_card(card)
+        except (ValidationError, TypeError) as e:
+            await results.put({"index": index, "status": 422, "error": str(e)})
+            return
+        except Exception as e:
+            await results.put({"index": index, "status": 502, "error": str(e)})
+            return
+        finally:
+            semaphore.release()
+        if response.status_code == 200:
+            await results.put({"index": index, "status": 200, "card": response.json()})
+        else:
+            await results.put({"index": index, "status": response.status_code, "error": response.text})
+
+    async def produce():
+        # Cards are created while the body is still arriving; reading pauses at BULK_CONCURRENCY in flight
+        tasks = set()
+        try:
+            try:
+                index = 0
+                async for item in read_bulk_cards(http_request):
+                    await semaphore.acquire()
+                    task = asyncio.create_task(create(index, item))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    index += 1
+            except (ValueError, TypeError) as e:
+                await results.put({"index": None, "status": 400, "error": f"Invalid request body: {e}"})
+            except Exception as e:  # e.g. the client disconnecting mid-body; cards already started still finish
+                await results.put({"index": None, "status": 400, "error": f"Request body not read: {e!r}"})
+            finally:
+                body_read.set()
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+        finally:
+            results.put_nowait(None)  # Always ends stream(), whatever stopped the producer
+
+    async def stream():
+        try:
+            while (result := await results.get()) is not None:
+                yield json.dumps(result) + "\n"
+        finally:
+            producer.cancel()
+
+    body_read = asyncio.Event()
+    producer = asyncio.create_task(produce())
+    # The body must be consumed before the response starts, because StreamingResponse reads the same
+    # receive channel to watch for client disconnects
+    await body_read.wait()
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+async def fetch_snapshot_fanout(board_id, list_fields, card_fields):
+    """ Fallback for boards the nested query can't serve: lists first, then their cards concurrently. """
+    lists = await cached_get(f"/boards/{board_id}/lists", {"fields": list_fields})
+    semaphore = asyncio.Semaphore(SNAPSHOT_CONCURRENCY)
+
+    async def fetch_cards(trello_list):
+        async with semaphore:
+            cards = await cached_get(f"/lists/{trello_list['id']}/cards", {"fields": card_fields})
+        return {**trello_list, "cards": cards}
+
+    return await asyncio.gather(*(fetch_cards(trello_list) for trello_list in lists))
+
+
+@app.get("/boards/{board_id}/snapshot")
+async def get_board_snapshot(board_id: str, nested: bool = True,
+                             list_fields: str = DEFAULT_LIST_FIELDS, card_fields: str = DEFAULT_CARD_FIELDS):
+    """
+    Returns a board's open lists with their cards nested, projected to list_fields/card_fields.
+    Normally a single upstream call using Trello's nested resources; nested=false (or a failing
+    nested query) fans out per list with bounded concurrency instead. Throttling and upstream
+    errors are raised rather than answered with more calls.
+    """
+    if "idBoard" not in list_fields.split(","):
+        list_fields += ",idBoard"
+    lists = None
+    if nested:
+        try:
+            lists = await cached_get(f"/boards/{board_id}/lists", {
+                "filter": "open",
+                "fields": list_fields,
+                "cards": "open",
+                "card_fields": card_fields,
+            })
+        except HTTPException as e:
+            if e.status_code in (401, 404, 429) or e.status_code >= 500:
+                raise
+    if lists is None:
+        lists = await fetch_snapshot_fanout(board_id, list_fields, card_fields)
+
+    for trello_list in lists:
+        remember_board(trello_list["id"], board_id)
+    return {"id": board_id, "lists": lists}
+
+
 @app.get("/cards/{list_id}")
 async def get_cards_from_list(list_id: str):
-    url = f"{BASE_URL}/lists/{list_id}/cards"
-    params = {"key": TRELLO_KEY, "token": TRELLO_TOKEN}
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, params=params)
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail=response.text)
-    return response.json()
+    return await cached_get(f"/lists/{list_id}/cards")
@@ -1,48 +1,101 @@
 import os
+import time
 import base64
-from fastapi import FastAPI, Request, HTTPException
+from typing import Optional
+from urllib.parse import quote
+from fastapi import FastAPI, Request, HTTPException, Depends
 from fastapi.responses import RedirectResponse, JSONResponse
-import requests
 from dotenv import load_dotenv
+from http_client import get_client, lifespan, rate_limits
+from metrics import instrument, metrics_response
+from token_manager import TokenManager, TokenRefreshError, refresh_oauth_token
+from token_store import SESSION_COOKIE, get_session_id, login_session_id, token_store
+from transfer import TransferError, download_ranges, stream_download
 
 load_dotenv()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+instrument(app, "zoom")
 
 @app.get("/")
 async def root():
     return {"message": "Zoom Connector API is running!"}
 
+
+# Upstream rate-limit budgets as learned from response headers
+@app.get("/rate_limits")
+async def get_rate_limits():
+    return rate_limits()
+
+
+# Route, upstream, token and cache metrics of this process in the Prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response()
+
 ZOOM_CLIENT_ID = os.getenv("ZOOM_CLIENT_ID")
 ZOOM_CLIENT_SECRET = os.getenv("ZOOM_CLIENT_SECRET")
 ZOOM_REDIRECT_URI = os.getenv("ZOOM_REDIRECT_URI")
 
-if not all([ZOOM_CLIENT_ID, ZOOM_CLIENT_SECRET, ZOOM_REDIRECT_URI]):
-    raise Exception("Please set ZOOM_CLIENT_ID, ZOOM_CLIENT_SECRET, and ZOOM_REDIRECT_URI in your environment.")
+ZOOM_SETTINGS = {"ZOOM_CLIENT_ID": ZOOM_CLIENT_ID, "ZOOM_CLIENT_SECRET": ZOOM_CLIENT_SECRET,
+                 "ZOOM_REDIRECT_URI": ZOOM_REDIRECT_URI}
+MISSING_SETTINGS = [name for name, value in ZOOM_SETTINGS.items() if not value]
+
+
+def require_zoom_config():
+    # Missing settings fail the health check and the OAuth routes instead of the import
+    if MISSING_SETTINGS:
+        raise HTTPException(status_code=503, detail=f"Please set {', '.join(MISSING_SETTINGS)} in your environment.")
+
+
+@app.get("/health")
+async def health():
+    if MISSING_SETTINGS:
+        return JSONResponse({"status": "unavailable", "missing": MISSING_SETTINGS}, status_code=503)
+    return {"status": "ok"}
 
 # Zoom endpoints
 ZOOM_AUTHORIZE_URL = "https://zoom.us/oauth/authorize"
 ZOOM_TOKEN_URL = "https://zoom.us/oauth/token"
+ZOOM_API_URL = "https://api.zoom.us/v2"
 
-zoom_tokens = {}
+# Recording downloads
+RECORDINGS_DIR = os.getenv("ZOOM_RECORDINGS_DIR", "recordings")
+RECORDINGS_PAGE_SIZE = 300  # Zoom's maximum
+MEETINGS_PAGE_SIZE = 300
+
+async def refresh_zoom_token(token_data):
+    # Zoom rotates the refresh token on every refresh; the manager keeps the new one
+    return await refresh_oauth_token(ZOOM_TOKEN_URL, token_data["refresh_token"],
+                                     auth=(ZOOM_CLIENT_ID, ZOOM_CLIENT_SECRET))
+
+# Per-session tokens, refreshed in the background and shared with other workers through the token store
+zoom_tokens = TokenManager("zoom", refresh_zoom_token, load=token_store.loader("zoom"), save=token_store.saver("zoom"))
 
 @app.get("/zoom/login")
-def zoom_login():
+async def zoom_login(new_session: bool = False, session_id: str = Depends(get_session_id)):
     from urllib.parse import urlencode
+    require_zoom_config()
     params = {
         "response_type": "code",
         "client_id": ZOOM_CLIENT_ID,
         "redirect_uri": ZOOM_REDIRECT_URI,
+        "state": token_store.begin_login("zoom", login_session_id(session_id, new_session)),
     }
     auth_url = f"{ZOOM_AUTHORIZE_URL}?{urlencode(params)}"
     return RedirectResponse(auth_url)
 
 
 @app.get("/zoom/callback")
-def zoom_callback(request: Request):
+async def zoom_callback(request: Request):
+    require_zoom_config()
     code = request.query_params.get("code")
     if not code:
         raise HTTPException(status_code=400, detail="Missing authorization code.")
+    login = token_store.finish_login("zoom", request.query_params.get("state"))
+    if login is None:
+        raise HTTPException(status_code=400, detail="Unknown or expired login state.")
+    session_id = login["session_id"]
 
     # Basic Auth header with base64-encoded client_id:client_secret
     credentials = f"{ZOOM_CLIENT_ID}:{ZOOM_CLIENT_SECRET}"
@@ -55,19 +108,27 @@ def zoom_callback(request: Request):
         "code": code,
         "redirect_uri": ZOOM_REDIRECT_URI
     }
-    token_response = requests.post(ZOOM_TOKEN_URL, headers=headers, data=data)
+    token_response = await get_client().post(ZOOM_TOKEN_URL, headers=headers, data=data)
     if token_response.status_code != 200:
         raise HTTPException(status_code=token_response.status_code, detail=token_response.text)
 
     token_data = token_response.json()
-    # Save tokens (for demo, in-memory)
-    zoom_tokens["access_token"] = token_data.get("access_token")
-    zoom_tokens["refresh_token"] = token_data.get("refresh_token")
-    return JSONResponse({"message": "Zoom authentication successful!", "token_data": token_data})
+    zoom_tokens.set(session_id, {
+        "access_token": token_data.get("access_token"),
+        "refresh_token": token_data.get("refresh_token"),
+        "expires_at": time.time() + int(token_data.get("expires_in", 3600)),
+    })
+    response = JSONResponse({"message": "Zoom authentication successful!", "token_data": token_data,
+                             "session_id": session_id})
+    response.set_cookie(SESSION_COOKIE, session_id, httponly=True)
+    return response
 
 @app.post("/zoom/meeting")
-def create_zoom_meeting():
-    access_token = zoom_tokens.get("access_token")
+async def create_zoom_meeting(session_id: str = Depends(get_session_id)):
+    try:
+        access_token = await zoom_tokens.access_token(session_id)
+    except TokenRefreshError:
+        raise HTTPException(status_code=401, detail="Zoom session expired. Please log in again.")
     if not access_token:
         raise HTTPException(status_code=401, detail="User not authenticated with Zoom. Please log in first.")
 
@@ -86,11 +147,128 @@ def create_zoom_meeting():
         "timezone": "UTC",
         "agenda": "Meeting scheduled via Zoom connector for Digital Twin"
     }
-    response = requests.post(meeting_url, headers=headers, json=payload)
+    response = await get_client().post(meeting_url, headers=headers, json=payload)
     if response.status_code not in [200, 201]:
         raise HTTPException(status_code=response.status_code, detail=response.text)
     return JSONResponse(response.json())
 
+async def zoom_headers(session_id):
+    try:
+        access_token = await zoom_tokens.access_token(session_id)
+    except TokenRefreshError:
+        raise HTTPException(status_code=401, detail="Zoom session expired. Please log in again.")
+    if not access_token:
+        raise HTTPException(status_code=401, detail="User not authenticated with Zoom. Please log in first.")
+    return {"Authorization": f"Bearer {access_token}"}
+
+
+def zoom_auth(session_id):
+    # Looked up per range so a multi-GB download outlives the one-hour access token
+    async def auth(expired):
+        token_data = await (zoom_tokens.refresh(session_id) if expired else zoom_tokens.get(session_id))
+        return {"Authorization": f"Bearer {token_data['access_token']}"}
+    return auth
+
+
+def meeting_path_id(meeting_id):
+    # Meeting UUIDs starting with "/" or containing "//" must be double encoded
+    if meeting_id.startswith("/") or "//" in meeting_id:
+        return quote(quote(meeting_id, safe=""), safe="")
+    return quote(meeting_id, safe="")
+
+
+async def scheduled_meetings(session_id, from_date=None, to_date=None):
+    """ The user's scheduled meetings, optionally between from_date and to_date (YYYY-MM-DD), all pages. """
+    headers = await zoom_headers(session_id)
+    params = {"type": "scheduled", "page_size": MEETINGS_PAGE_SIZE}
+    if from_date:
+        params["from"] = from_date
+    if to_date:
+        params["to"] = to_date
+
+    meetings = []
+    while True:
+        response = await get_client().get(f"{ZOOM_API_URL}/users/me/meetings", headers=headers, params=params)
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+        page = response.json()
+        meetings += page.get("meetings", [])
+        if not page.get("next_page_token"):
+            return meetings
+        params["next_page_token"] = page["next_page_token"]
+
+
+@app.get("/zoom/recordings")
+async def list_zoom_recordings(from_date: Optional[str] = None, to_date: Optional[str] = None,
+                               session_id: str = Depends(get_session_id)):
+    """ Cloud recordings of the user between from_date and to_date (YYYY-MM-DD), all pages. """
+    headers = await zoom_headers(session_id)
+    params = {"page_size": RECORDINGS_PAGE_SIZE}
+    if from_date:
+        params["from"] = from_date
+    if to_date:
+        params["to"] = to_date
+
+    meetings = []
+    while True:
+        response = await get_client().get(f"{ZOOM_API_URL}/users/me/recordings", headers=headers, params=params)
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+        page = response.json()
+        for meeting in page.get("meetings", []):
+            meetings.append({
+                "uuid": meeting.get("uuid"),
+                "topic": meeting.get("topic"),
+                "start_time": meeting.get("start_time"),
+                "total_size": meeting.get("total_size"),
+                "recording_files": [
+                    {key: recording.get(key) for key in
+                     ("id", "recording_type", "file_type", "file_extension", "file_size", "status")}
+                    for recording in meeting.get("recording_files", [])
+                ],
+            })
+        if not page.get("next_page_token"):
+            break
+        params["next_page_token"] = page["next_page_token"]
+    return JSONResponse({"meetings": meetings})
+
+
+@app.get("/zoom/recordings/download")
+async def download_zoom_recording(meeting_id: str, file_id: str, request: Request, mode: str = "disk",
+                                  sha256: Optional[str] = None, session_id: str = Depends(get_session_id)):
+    """
+    mode=stream pipes the recording to the client and honours the Range header; mode=disk saves it under
+    RECORDINGS_DIR as resumable parallel ranges. Zoom publishes no checksums, so disk downloads are checked
+    against the listed file size and report their sha256; pass sha256 to verify a known digest.
+    """
+    headers = await zoom_headers(session_id)
+    response = await get_client().get(f"{ZOOM_API_URL}/meetings/{meeting_path_id(meeting_id)}/recordings",
+                                      headers=headers)
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+    recording = next((f for f in response.json().get("recording_files", []) if f.get("id") == file_id), None)
+    if recording is None or not recording.get("download_url"):
+        raise HTTPException(status_code=404, detail="Recording file not found.")
+
+    file_name = f"{file_id}.{(recording.get('file_extension') or 'mp4').lower()}"
+    if mode == "stream":
+        result = await stream_download(recording["download_url"], headers, request.headers.get("range"), file_name)
+        if isinstance(result, dict):
+            raise HTTPException(status_code=502, detail=result["details"])
+        return result
+
+    os.makedirs(RECORDINGS_DIR, exist_ok=True)
+    path = os.path.join(RECORDINGS_DIR, os.path.basename(file_name))
+    try:
+        result = await download_ranges(recording["download_url"], path, int(recording["file_size"]),
+                                       zoom_auth(session_id), expected_sha256=sha256)
+    except TokenRefreshError:
+        raise HTTPException(status_code=401, detail="Zoom session expired. Please log in again.")
+    except TransferError as e:
+        raise HTTPException(status_code=502, detail=f"Recording download failed, retry to resume: {e}")
+    return JSONResponse({"message": "Recording downloaded", "path": path, **result})
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8000, reload=True)
@@ -0,0 +1,374 @@
+import os
+import uuid
+import random
+import asyncio
+import argparse
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+# Local stand-ins for the Google, Graph, Trello and Zoom endpoints the connectors call.
+# Run the connectors with UPSTREAM_OVERRIDES="*=http://127.0.0.1:<port>" to send every upstream call here;
+# the Host header still names the real upstream, so next-page links point back at it and are overridden too.
+# Every response waits LATENCY (+/- JITTER) and a REJECT_RATE share of them is answered 429 instead.
+
+LATENCY = float(os.getenv("MOCK_LATENCY_MS", "50")) / 1000
+JITTER = float(os.getenv("MOCK_JITTER_MS", "10")) / 1000
+PAGE_SIZE = int(os.getenv("MOCK_PAGE_SIZE", "100"))  # Items per page of every collection
+PAGES = int(os.getenv("MOCK_PAGES", "3"))  # Pages per collection
+PADDING = int(os.getenv("MOCK_PADDING_BYTES", "0"))  # Extra bytes of text on every item, to grow payloads
+FILE_SIZE = int(os.getenv("MOCK_FILE_SIZE", str(1024 * 1024)))  # Size of Drive files and Zoom recordings
+REJECT_RATE = float(os.getenv("MOCK_429_RATE", "0"))
+RETRY_AFTER = os.getenv("MOCK_RETRY_AFTER", "1")
+TOKEN_PATHS = ("/token", "/oauth/token")  # Token endpoints are never delayed or throttled
+
+app = FastAPI()
+events = {}  # event id -> event inserted through the Calendar stand-in, so retried inserts conflict
+
+
+@app.middleware("http")
+async def simulate_upstream(request: Request, call_next):
+    if request.url.path.endswith(TOKEN_PATHS):
+        return await call_next(request)
+    await asyncio.sleep(max(0.0, LATENCY + random.uniform(-JITTER, JITTER)))
+    if REJECT_RATE and random.random() < REJECT_RATE:
+        return JSONResponse({"error": {"code": 429, "message": "Rate limit exceeded"}}, status_code=429,
+                            headers={"Retry-After": RETRY_AFTER})
+    return await call_next(request)
+
+
+def padding():
+    return "x" * PADDING
+
+
+def page_items(request, param, make_item):
+    """ One page of a collection addressed by an integer page token; returns the items and the next token. """
+    page = int(request.query_params.get(param) or 0)
+    items = [make_item(page * PAGE_SIZE + i) for i in range(PAGE_SIZE)]
+    return items, str(page + 1) if page + 1 < PAGES else None
+
+
+def next_link(request, param, token):
+    # Absolute link on the upstream the caller thinks it is talking to
+    query = {**request.query_params, param: token}
+    url = request.url.replace(scheme="https", netloc=request.headers["host"]).include_query_params(**query)
+    return str(url)
+
+
+_content = {}
+
+
+def content_response(request, media_type):
+    """ FILE_SIZE bytes, or the requested byte range of them. """
+    if FILE_SIZE not in _content:
+        _content[FILE_SIZE] = os.urandom(min(FILE_SIZE, 1024 * 1024)) * (FILE_SIZE // (1024 * 1024) + 1)
+    body = memoryview(_content[FILE_SIZE])[:FILE_SIZE]
+    range_header = request.headers.get("range")
+    if not range_header:
+        return Response(bytes(body), media_type=media_type, headers={"Accept-Ranges": "bytes"})
+    start, _, end = range_header.removeprefix("bytes=").partition("-")
+    start, end = int(start), min(int(end) if end else FILE_SIZE - 1, FILE_SIZE - 1)
+    return Response(bytes(body[start:end + 1]), status_code=206, media_type=media_type,
+                    headers={"Accept-Ranges": "bytes", "Content-Range": f"bytes {start}-{end}/{FILE_SIZE}"})
+
+
+def token_response():
+    return {"access_token": uuid.uuid4().hex, "refresh_token": uuid.uuid4().hex, "expires_in": 3600,
+            "token_type": "Bearer"}
+
+
+# Google: OAuth, Drive and Calendar
+@app.post("/token")
+async def google_token():
+    return token_response()
+
+
+def drive_file(n, file_id=None):
+    return {"id": file_id or f"file-{n}", "name": f"file-{n}.bin", "mimeType": "application/octet-stream",
+            "parents": ["root"], "size": str(FILE_SIZE), "md5Checksum": f"{n:032x}",
+            "modifiedTime": "2025-01-01T00:00:00.000Z", "description": padding()}
+
+
+@app.get("/drive/v3/changes/startPageToken")
+async def drive_start_page_token():
+    return {"startPageToken": "1"}
+
+
+@app.get("/drive/v3/changes")
+async def drive_changes():
+    return {"changes": [], "newStartPageToken": "1"}
+
+
+@app.get("/drive/v3/files")
+async def drive_files(request: Request):
+    files, token = page_items(request, "pageToken", drive_file)
+    return {"files": files, **({"nextPageToken": token} if token else {})}
+
+
+@app.get("/drive/v3/files/{file_id}")
+async def drive_file_get(file_id: str, request: Request):
+    if request.query_params.get("alt") == "media":
+        return content_response(request, "application/octet-stream")
+    return drive_file(abs(hash(file_id)) % 10 ** 6, file_id)
+
+
+@app.delete("/drive/v3/files/{file_id}")
+async def drive_file_delete(file_id: str):
+    return Response(status_code=204)
+
+
+@app.post("/upload/drive/v3/files")
+@app.patch("/upload/drive/v3/files/{file_id}")
+async def drive_upload(request: Request, file_id: str = None):
+    await request.body()
+    file_id = file_id or uuid.uuid4().hex
+    if request.query_params.get("uploadType") == "resumable":
+        location = f"https://{request.headers['host']}/upload/drive/v3/files?upload_id={file_id}"
+        return Response(status_code=200, headers={"Location": location})
+    return {"id": file_id, "name": "upload.bin"}
+
+
+@app.put("/upload/drive/v3/files")
+async def drive_upload_chunk(request: Request):
+    await request.body()
+    return {"id": request.query_params.get("upload_id"), "name": "upload.bin"}
+
+
+def calendar_event(n, event_id=None):
+    return {"id": event_id or f"event{n}", "status": "confirmed", "summary": f"Meeting {n}",
+            "description": padding(), "hangoutLink": f"https://meet.google.com/abc-{n:04d}-xyz",
+            "start": {"dateTime": f"2025-01-{n % 28 + 1:02d}T10:00:00Z"},
+            "end": {"dateTime": f"2025-01-{n % 28 + 1:02d}T11:00:00Z"}}
+
+
+@app.get("/calendar/v3/calendars/primary/events")
+async def calendar_events(request: Request):
+    if request.query_params.get("syncToken"):
+        return {"items": [], "nextSyncToken": "sync-1"}  # Nothing changed since the full sync
+    items, token = page_items(request, "pageToken", calendar_event)
+    return {"items": items, **({"nextPageToken": token} if token else {"nextSyncToken": "sync-1"})}
+
+
+@app.post("/calendar/v3/calendars/primary/events")
+async def calendar_insert(request: Request):
+    body = await request.json()
+    event_id = body.get("id") or uuid.uuid4().hex
+    if event_id in events:
+        return JSONResponse({"error": {"code": 409, "message": "The requested identifier already exists."}},
+                            status_code=409)
+    events[event_id] = {**body, "id": event_id, "status": "confirmed",
+                        "hangoutLink": f"https://meet.google.com/{event_id[:10]}"}
+    return events[event_id]
+
+
+@app.get("/calendar/v3/calendars/primary/events/{event_id}")
+async def calendar_get(event_id: str):
+    if event_id not in events:
+        return JSONResponse({"error": {"code": 404, "message": "Not Found"}}, status_code=404)
+    return events[event_id]
+
+
+# Microsoft Graph
+@app.post("/{tenant}/oauth2/v2.0/token")
+async def graph_token(tenant: str):
+    return token_response()
+
+
+def graph_user(n=0):
+    return {"id": f"user-{n}", "displayName": f"User {n}", "mail": f"user{n}@example.com", "jobTitle": padding()}
+
+
+def graph_presence(user_id="user-0"):
+    return {"id": user_id, "availability": "Available", "activity": "Available"}
+
+
+def graph_chat(n):
+    return {"id": f"chat-{n}", "topic": f"Chat {n}", "chatType": "group", "createdDateTime": "2025-01-01T00:00:00Z",
+            "description": padding()}
+
+
+def graph_message(n):
+    return {"id": f"message-{n}", "createdDateTime": "2025-01-01T00:00:00Z",
+            "body": {"contentType": "text", "content": f"Message {n} {padding()}"}}
+
+
+def graph_collection(request, make_item):
+    items, token = page_items(request, "$skiptoken", make_item)
+    return {"value": items, **({"@odata.nextLink": next_link(request, "$skiptoken", token)} if token else {})}
+
+
+@app.get("/v1.0/me")
+async def graph_me():
+    return graph_user()
+
+
+@app.get("/v1.0/me/presence")
+async def graph_me_presence():
+    return graph_presence()
+
+
+@app.get("/v1.0/me/chats")
+async def graph_chats(request: Request):
+    return graph_collection(request, graph_chat)
+
+
+@app.get("/v1.0/chats/{chat_id}/messages")
+async def graph_messages(chat_id: str, request: Request):
+    return graph_collection(request, graph_message)
+
+
+def graph_event(n):
+    day = f"2025-01-{n % 28 + 1:02d}"
+    return {"id": f"teams-event-{n}", "subject": f"Teams meeting {n}", "isOnlineMeeting": True,
+            "start": {"dateTime": f"{day}T09:00:00.0000000", "timeZone": "UTC"},
+            "end": {"dateTime": f"{day}T09:30:00.0000000", "timeZone": "UTC"},
+            "onlineMeeting": {"joinUrl": f"https://teams.microsoft.com/l/meetup-join/{n}"}, "webLink": padding()}
+
+
+@app.get("/v1.0/me/calendarView")
+async def graph_calendar_view(request: Request):
+    return graph_collection(request, graph_event)
+
+
+@app.post("/v1.0/me/chats/{chat_id}/messages")
+async def graph_send(chat_id: str, request: Request):
+    return JSONResponse({**graph_message(0), "id": uuid.uuid4().hex, "body": (await request.json()).get("body")},
+                        status_code=201)
+
+
+@app.post("/v1.0/communications/getPresencesByUserId")
+async def graph_presences(request: Request):
+    return {"value": [graph_presence(user_id) for user_id in (await request.json()).get("ids", [])]}
+
+
+@app.post("/v1.0/$batch")
+async def graph_batch(request: Request):
+    def answer(sub_request):
+        url = sub_request["url"].split("?")[0]
+        if sub_request["method"] == "POST" and url.endswith("/messages"):
+            return 201, {**graph_message(0), "id": uuid.uuid4().hex}
+        if url == "/me":
+            return 200, graph_user()
+        if url == "/me/presence":
+            return 200, graph_presence()
+        if url == "/me/chats":
+            return 200, {"value": [graph_chat(n) for n in range(PAGE_SIZE)]}
+        return 404, {"error": {"code": "NotFound", "message": url}}
+
+    responses = []
+    for sub_request in (await request.json()).get("requests", []):
+        status, body = answer(sub_request)
+        responses.append({"id": sub_request["id"], "status": status, "headers": {}, "body": body})
+    return {"responses": responses}
+
+
+# Trello
+def trello_card(n, list_id="list-0"):
+    return {"id": f"card-{n}", "name": f"Card {n}", "desc": padding(), "idList": list_id, "pos": n,
+            "due": None, "labels": [], "idMembers": []}
+
+
+def trello_list(n, board_id="board-0", cards=False):
+    trello_list = {"id": f"list-{n}", "name": f"List {n}", "pos": n, "closed": False, "idBoard": board_id}
+    if cards:
+        trello_list["cards"] = [trello_card(n * PAGE_SIZE + i, trello_list["id"]) for i in range(PAGE_SIZE)]
+    return trello_list
+
+
+@app.get("/1/members/me/boards")
+async def trello_boards():
+    return [{"id": f"board-{n}", "name": f"Board {n}", "desc": padding(), "closed": False} for n in range(PAGE_SIZE)]
+
+
+@app.get("/1/boards/{board_id}/lists")
+async def trello_lists(board_id: str, request: Request):
+    nested = request.query_params.get("cards") == "open"
+    return [trello_list(n, board_id, nested) for n in range(PAGES)]
+
+
+@app.get("/1/lists/{list_id}/cards")
+async def trello_cards(list_id: str):
+    return [trello_card(n, list_id) for n in range(PAGE_SIZE)]
+
+
+@app.post("/1/cards")
+async def trello_create_card(request: Request):
+    params = request.query_params
+    return {**trello_card(0, params.get("idList")), "id": uuid.uuid4().hex, "name": params.get("name"),
+            "desc": params.get("desc")}
+
+
+# Zoom
+@app.post("/oauth/token")
+async def zoom_token():
+    return token_response()
+
+
+def zoom_meeting(n):
+    return {"id": 10 ** 9 + n, "uuid": f"meeting-{n}", "topic": f"Meeting {n}", "type": 2,
+            "start_time": f"2025-01-{n % 28 + 1:02d}T10:00:00Z", "duration": 30, "timezone": "UTC",
+            "agenda": padding(), "join_url": f"https://zoom.us/j/{10 ** 9 + n}"}
+
+
+def zoom_recording_files(host, meeting_id):
+    return [{"id": f"{meeting_id}-rec-{n}", "recording_type": "shared_screen_with_speaker_view", "file_type": "MP4",
+             "file_extension": "MP4", "file_size": FILE_SIZE, "status": "completed",
+             "download_url": f"https://{host.replace('api.', '', 1)}/rec/download/{meeting_id}-rec-{n}"}
+            for n in range(2)]
+
+
+def zoom_page(request, key, make_item):
+    items, token = page_items(request, "next_page_token", make_item)
+    return {key: items, "page_size": PAGE_SIZE, "next_page_token": token or ""}
+
+
+@app.post("/v2/users/me/meetings")
+async def zoom_create_meeting(request: Request):
+    return JSONResponse({**zoom_meeting(0), **(await request.json()), "id": random.randrange(10 ** 10)},
+                        status_code=201)
+
+
+@app.get("/v2/users/me/meetings")
+async def zoom_meetings(request: Request):
+    return zoom_page(request, "meetings", zoom_meeting)
+
+
+@app.get("/v2/users/me/recordings")
+async def zoom_recordings(request: Request):
+    host = request.headers["host"]
+    return zoom_page(request, "meetings", lambda n: {
+        **zoom_meeting(n), "total_size": 2 * FILE_SIZE, "recording_files": zoom_recording_files(host, f"meeting-{n}")})
+
+
+@app.get("/v2/meetings/{meeting_id}/recordings")
+async def zoom_meeting_recordings(meeting_id: str, request: Request):
+    return {"uuid": meeting_id, "recording_files": zoom_recording_files(request.headers["host"], meeting_id)}
+
+
+@app.get("/rec/download/{file_id}")
+async def zoom_download(file_id: str, request: Request):
+    return content_response(request, "video/mp4")
+
+
+def main():
+    global LATENCY, JITTER, PAGE_SIZE, PAGES, PADDING, FILE_SIZE, REJECT_RATE, RETRY_AFTER
+    parser = argparse.ArgumentParser(description="Local stand-ins for the upstream APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=LATENCY * 1000)
+    parser.add_argument("--jitter-ms", type=float, default=JITTER * 1000)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--pages", type=int, default=PAGES)
+    parser.add_argument("--padding-bytes", type=int, default=PADDING)
+    parser.add_argument("--file-size", type=int, default=FILE_SIZE)
+    parser.add_argument("--429-rate", dest="reject_rate", type=float, default=REJECT_RATE)
+    parser.add_argument("--retry-after", default=RETRY_AFTER)
+    args = parser.parse_args()
+    LATENCY, JITTER = args.latency_ms / 1000, args.jitter_ms / 1000
+    PAGE_SIZE, PAGES, PADDING, FILE_SIZE = args.page_size, max(1, args.pages), args.padding_bytes, args.file_size
+    REJECT_RATE, RETRY_AFTER = args.reject_rate, args.retry_after
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+import os
+import sys
+import json
+import math
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+import httpx
+
+# Load driver for the connectors. Starts the upstream stand-ins (mock_upstreams.py) and the gateway with
+# every upstream call overridden to them, seeds tokens for one session, then runs each scenario with a fixed
+# number of requests at a fixed concurrency. Throughput, latency percentiles and the gateway's peak memory
+# are printed and stored as JSON, optionally next to a baseline run for comparison.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+SESSION_ID = "bench"
+STARTUP_TIMEOUT = 30
+RSS_SAMPLE_INTERVAL = 0.05
+
+sys.path.insert(0, REPO_ROOT)
+
+
+def meeting_spec(i):
+    return {"summary": f"Bench meeting {i}", "start": "2025-03-26T10:00:00", "end": "2025-03-26T11:00:00",
+            "key": f"{time.time_ns()}-{i}"}
+
+
+# name -> function of the request number returning the request to send (method, gateway path, httpx kwargs).
+# OAuth login/callback, Drive folder sync and the presence webhook routes need a browser, a local tree or a
+# public URL and are left out.
+SCENARIOS = {
+    "drive.files": lambda i: ("GET", "/drive/files", {"params": {"limit": 100, "offset": i % 200}}),
+    "drive.download.stream": lambda i: ("GET", f"/drive/download/file-{i % 300}", {"params": {"mode": "stream"}}),
+    "drive.download.disk": lambda i: ("GET", f"/drive/download/file-{i % 100}", {}),
+    "drive.upload": lambda i: ("POST", "/drive/upload", {"files": {"file": (f"upload-{i}.bin", b"x" * 65536)}}),
+    "drive.delete": lambda i: ("DELETE", f"/drive/delete/upload-{i}", {}),
+    "meet.meetings": lambda i: ("GET", "/meet/meetings", {}),
+    "meet.create": lambda i: ("POST", "/meet/create_meeting", {"json": meeting_spec(i)}),
+    "meet.batch": lambda i: ("POST", "/meet/meetings/batch",
+                             {"json": {"meetings": [meeting_spec(f"{i}-{n}") for n in range(10)]}}),
+    "teams.me": lambda i: ("GET", "/teams/me", {}),
+    "teams.me.presence": lambda i: ("GET", "/teams/me/presence", {}),
+    "teams.chats": lambda i: ("GET", "/teams/me/chats", {}),
+    "teams.chats.stream": lambda i: ("GET", "/teams/me/chats/stream", {}),
+    "teams.messages.stream": lambda i: ("GET", f"/teams/chats/chat-{i % 10}/messages/stream", {}),
+    "teams.overview": lambda i: ("GET", "/teams/me/overview", {}),
+    "teams.send": lambda i: ("POST", f"/teams/send_message/chat-{i % 10}", {"params": {"message": f"ping {i}"}}),
+    "teams.broadcast": lambda i: ("POST", "/teams/send_message",
+                                  {"json": {"chat_ids": [f"chat-{n}" for n in range(20)], "message": f"ping {i}"}}),
+    "teams.presence": lambda i: ("POST", "/teams/presence",
+                                 {"json": {"ids": [f"user-{i * 50 + n}" for n in range(50)], "max_age": 0}}),
+    "trello.boards": lambda i: ("GET", "/trello/boards", {}),
+    "trello.lists": lambda i: ("GET", f"/trello/lists/board-{i % 10}", {}),
+    "trello.cards": lambda i: ("GET", f"/trello/cards/list-{i % 10}", {}),
+    "trello.snapshot": lambda i: ("GET", f"/trello/boards/board-{i % 10}/snapshot", {}),
+    "trello.create": lambda i: ("POST", "/trello/cards", {"json": {"idList": "list-0", "name": f"Card {i}"}}),
+    "trello.bulk": lambda i: ("POST", "/trello/cards/bulk",
+                              {"json": [{"idList": "list-0", "name": f"Card {i}-{n}"} for n in range(20)]}),
+    "zoom.meeting": lambda i: ("POST", "/zoom/zoom/meeting", {}),
+    "zoom.recordings": lambda i: ("GET", "/zoom/zoom/recordings", {}),
+    "zoom.download.stream": lambda i: ("GET", "/zoom/zoom/recordings/download",
+                                       {"params": {"meeting_id": "meeting-0", "file_id": "meeting-0-rec-0",
+                                                   "mode": "stream"}}),
+    "feed.meetings": lambda i: ("GET", "/feed/meetings",
+                                {"params": {"time_min": "2025-01-01T00:00:00Z", "time_max": "2025-02-01T00:00:00Z"}}),
+    "zoom.download.disk": lambda i: ("GET", "/zoom/zoom/recordings/download",
+                                     {"params": {"meeting_id": f"meeting-{i % 100}",
+                                                 "file_id": f"meeting-{i % 100}-rec-0"}}),
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def seed_tokens(token_db):
+    """ Long-lived tokens for every OAuth provider, so no login is needed and no refresh happens mid-run. """
+    from token_store import TokenStore
+    store = TokenStore(token_db)
+    expires_at = time.time() + 86400
+    google = {"access_token": "bench", "refresh_token": "bench", "expires_at": expires_at,
+              "token_uri": "https://oauth2.googleapis.com/token", "client_id": "bench", "client_secret": "bench"}
+    for provider, data in (("drive", google), ("meet", google),
+                           ("teams", {"access_token": "bench", "refresh_token": "bench", "expires_at": expires_at}),
+                           ("zoom", {"access_token": "bench", "refresh_token": "bench", "expires_at": expires_at})):
+        store.save(provider, SESSION_ID, data)
+
+
+def process_tree(pid):
+    """ pid and its descendants (the gateway's workers), read from /proc. """
+    pids, index = [pid], 0
+    while index < len(pids):
+        try:
+            for task in os.listdir(f"/proc/{pids[index]}/task"):
+                with open(f"/proc/{pids[index]}/task/{task}/children") as f:
+                    pids += [int(child) for child in f.read().split()]
+        except OSError:
+            pass
+        index += 1
+    return pids
+
+
+def tree_rss_mb(pid):
+    """ Resident memory of the process tree in MiB, or None where /proc is not available. """
+    total = None
+    for process in process_tree(pid):
+        try:
+            with open(f"/proc/{process}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total = (total or 0) + int(line.split()[1]) / 1024
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    """ Tracks the peak resident memory of the gateway while a scenario runs. """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = None
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            rss = await asyncio.to_thread(tree_rss_mb, self.pid)
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self.peak = None
+        self._task = asyncio.ensure_future(self._sample())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._task.cancel()
+
+
+def percentile(sorted_values, fraction):
+    # Nearest rank
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def is_error(response):
+    # Several connectors report failures as 200 with an "error" field
+    if response.status_code >= 400:
+        return True
+    if response.headers.get("content-type", "").startswith("application/json"):
+        try:
+            body = response.json()
+        except ValueError:
+            return True
+        return isinstance(body, dict) and "error" in body
+    return False
+
+
+async def run_scenario(client, name, requests, concurrency, pid):
+    make_request = SCENARIOS[name]
+    latencies, status_codes, errors = [], {}, 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            method, path, kwargs = make_request(i)
+            started = time.perf_counter()
+            try:
+                async with client.stream(method, path, **kwargs) as response:
+                    await response.aread()
+                status = str(response.status_code)
+                errors += is_error(response)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+            status_codes[status] = status_codes.get(status, 0) + 1
+
+    with RssSampler(pid) as sampler:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "status_codes": status_codes,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p95": round(percentile(latencies, 0.95), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "mean": round(sum(latencies) / len(latencies), 2),
+            "max": round(latencies[-1], 2),
+        },
+        "peak_rss_mb": round(sampler.peak, 1) if sampler.peak is not None else None,
+    }
+
+
+async def wait_until_up(url, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} exited with code {process.returncode}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not start within {STARTUP_TIMEOUT}s")
+
+
+def start_mock(args, port, log):
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_upstreams.py"), "--port", str(port),
+               "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+               "--page-size", str(args.page_size), "--pages", str(args.pages),
+               "--padding-bytes", str(args.padding_bytes), "--file-size", str(args.file_size),
+               "--429-rate", str(args.rate_429), "--retry-after", str(args.retry_after)]
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+
+def start_gateway(args, port, mock_port, work_dir, log):
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])),
+        "UPSTREAM_OVERRIDES": f"*=http://127.0.0.1:{mock_port}",
+        "GATEWAY_PORT": str(port),
+        "WEB_CONCURRENCY": str(args.workers),
+        "TOKEN_DB": os.path.join(work_dir, "tokens.db"),
+        "CALENDAR_DB": os.path.join(work_dir, "calendar.db"),
+        "DRIVE_INDEX_DB": os.path.join(work_dir, "drive_index.db"),
+        "ZOOM_RECORDINGS_DIR": os.path.join(work_dir, "recordings"),
+        "TRELLO_API_KEY": "bench",
+        "TRELLO_TOKEN": "bench",
+        "ZOOM_CLIENT_ID": "bench",
+        "ZOOM_CLIENT_SECRET": "bench",
+        "CLIENT_ID": "bench",
+        "CLIENT_SECRET": "bench",
+        "TENANT_ID": "bench",
+    }
+    # The working directory catches everything the connectors write relative to it, e.g. Drive downloads
+    return subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, "gateway.py")], cwd=work_dir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    baseline_scenarios = (baseline or {}).get("scenarios", {})
+    print(f"{'scenario':24} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'rss MiB':>8}")
+    for name, result in results["scenarios"].items():
+        latency = result["latency_ms"]
+        print(f"{name:24} {result['throughput_rps']:>9} {latency['p50']:>9} {latency['p95']:>9} {latency['p99']:>9}"
+              f" {result['errors']:>7} {result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-':>8}")
+        before = baseline_scenarios.get(name)
+        if before:
+            changes = [f"{key} {change(before['latency_ms'][key], latency[key])}" for key in ("p50", "p95", "p99")]
+            print(f"{'  vs baseline':24} {change(before['throughput_rps'], result['throughput_rps']):>9} "
+                  + " ".join(f"{value:>9}" for value in changes))
+    print(f"peak gateway RSS: {results['peak_rss_mb']} MiB")
+
+
+def change(before, after):
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.0f}%"
+
+
+async def main(args):
+    names = [name.strip() for name in args.scenarios.split(",")] if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(unknown)}")
+
+    with tempfile.TemporaryDirectory(prefix="connector-bench-") as work_dir:
+        seed_tokens(os.path.join(work_dir, "tokens.db"))
+        mock_port, gateway_port = free_port(), free_port()
+        with open(os.path.join(work_dir, "mock.log"), "w") as mock_log, \
+                open(os.path.join(work_dir, "gateway.log"), "w") as gateway_log:
+            mock = start_mock(args, mock_port, mock_log)
+            gateway = start_gateway(args, gateway_port, mock_port, work_dir, gateway_log)
+            try:
+                await wait_until_up(f"http://127.0.0.1:{mock_port}/", mock)
+                await wait_until_up(f"http://127.0.0.1:{gateway_port}/", gateway)
+                results = await run_all(args, names, gateway_port, gateway.pid)
+            except Exception:
+                gateway_log.flush()
+                with open(gateway_log.name) as f:
+                    sys.stderr.write(f.read()[-4000:])
+                raise
+            finally:
+                for process in (gateway, mock):
+                    process.terminate()
+                    try:
+                        process.wait(timeout=10)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = os.path.join(args.output_dir, f"{stamp}{'-' + args.label if args.label else ''}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print(f"results written to {path}")
+
+
+async def run_all(args, names, port, pid):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", headers={"X-Session-Id": SESSION_ID},
+                                 limits=limits, timeout=args.timeout) as client:
+        scenarios = {}
+        for name in names:
+            # Warm-up: imports the connector and fills per-session state such as the Drive index
+            await run_scenario(client, name, min(args.concurrency, args.requests), args.concurrency, pid)
+            scenarios[name] = await run_scenario(client, name, args.requests, args.concurrency, pid)
+            print(f"{name}: {scenarios[name]['throughput_rps']} req/s, p99 {scenarios[name]['latency_ms']['p99']} ms",
+                  file=sys.stderr)
+        peaks = [result["peak_rss_mb"] for result in scenarios.values() if result["peak_rss_mb"] is not None]
+        return {
+            "label": args.label,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output_dir", "baseline")},
+            "scenarios": scenarios,
+            "peak_rss_mb": max(peaks) if peaks else None,
+        }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the connectors against local upstream stand-ins")
+    parser.add_argument("--scenarios", help="Comma separated scenario names (default: all)")
+    parser.add_argument("--list", action="store_true", help="List the scenarios and exit")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1, help="Gateway worker processes")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--latency-ms", type=float, default=50, help="Upstream response delay")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--page-size", type=int, default=100, help="Items per upstream page")
+    parser.add_argument("--pages", type=int, default=3, help="Pages per upstream collection")
+    parser.add_argument("--padding-bytes", type=int, default=0, help="Extra bytes per upstream item")
+    parser.add_argument("--file-size", type=int, default=1024 * 1024, help="Bytes per downloaded file")
+    parser.add_argument("--429-rate", dest="rate_429", type=float, default=0, help="Share of upstream calls throttled")
+    parser.add_argument("--retry-after", default="1", help="Retry-After sent with injected 429s")
+    parser.add_argument("--label", help="Suffix for the results file, e.g. a branch name")
+    parser.add_argument("--output-dir", default=RESULTS_DIR)
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.list:
+        print("\n".join(SCENARIOS))
+    else:
+        asyncio.run(main(arguments))
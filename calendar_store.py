@@ -0,0 +1,106 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+# Local copy of each session's calendar events, kept current with Calendar API sync tokens.
+# Events are indexed by start time so range queries don't grow with calendar size.
+
+CALENDAR_DB = os.getenv("CALENDAR_DB", "calendar.db")
+
+
+def utc_timestamp(value):
+    """ Normalises an RFC 3339 date-time or an all-day date to a sortable UTC string. """
+    if not value:
+        return None
+    if len(value) == 10:  # All-day events only carry a date
+        value += "T00:00:00+00:00"
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def event_time(boundary):
+    boundary = boundary or {}
+    return utc_timestamp(boundary.get("dateTime") or boundary.get("date"))
+
+
+class CalendarStore:
+    """ SQLite table of calendar events per session plus the sync token to continue from. """
+
+    def __init__(self, path=CALENDAR_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                " session_id TEXT NOT NULL, event_id TEXT NOT NULL, start TEXT, end TEXT, summary TEXT,"
+                " hangout_link TEXT, data TEXT NOT NULL, PRIMARY KEY (session_id, event_id))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS events_by_start ON events (session_id, start)")
+            connection.execute("CREATE INDEX IF NOT EXISTS events_by_end ON events (session_id, end)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sync_state (session_id TEXT PRIMARY KEY, sync_token TEXT)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def sync_token(self, session_id):
+        row = self._connection().execute(
+            "SELECT sync_token FROM sync_state WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def apply(self, session_id, events, sync_token=None, reset=False):
+        """ Upserts events (dropping cancelled ones) in one transaction; reset clears the session first. """
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN")
+            if reset:
+                connection.execute("DELETE FROM events WHERE session_id = ?", (session_id,))
+                connection.execute("DELETE FROM sync_state WHERE session_id = ?", (session_id,))
+            for event in events:
+                if event.get("status") == "cancelled":
+                    connection.execute(
+                        "DELETE FROM events WHERE session_id = ? AND event_id = ?", (session_id, event["id"])
+                    )
+                    continue
+                connection.execute(
+                    "INSERT OR REPLACE INTO events (session_id, event_id, start, end, summary, hangout_link, data)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (session_id, event["id"], event_time(event.get("start")), event_time(event.get("end")),
+                     event.get("summary"), event.get("hangoutLink"), json.dumps(event)),
+                )
+            if sync_token:
+                connection.execute(
+                    "INSERT OR REPLACE INTO sync_state (session_id, sync_token) VALUES (?, ?)", (session_id, sync_token)
+                )
+
+    def query(self, session_id, time_min=None, time_max=None, meet_only=False):
+        """ Events overlapping [time_min, time_max) ordered by start, in a compact form. """
+        sql = "SELECT event_id, summary, start, end, hangout_link FROM events WHERE session_id = ?"
+        params = [session_id]
+        if time_min:
+            sql += " AND end > ?"
+            params.append(utc_timestamp(time_min))
+        if time_max:
+            sql += " AND start < ?"
+            params.append(utc_timestamp(time_max))
+        if meet_only:
+            sql += " AND hangout_link IS NOT NULL"
+        sql += " ORDER BY start"
+        return [
+            {"id": event_id, "summary": summary, "start": start, "end": end, "hangout_link": hangout_link}
+            for event_id, summary, start, end, hangout_link in self._connection().execute(sql, params)
+        ]
+
+
+calendar_store = CalendarStore()
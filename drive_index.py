@@ -0,0 +1,178 @@
+import os
+import json
+import sqlite3
+import threading
+
+# Local index of each session's Drive file metadata, kept current with the Changes API.
+# Listing and lookups are answered here instead of calling Drive on every request.
+
+DRIVE_INDEX_DB = os.getenv("DRIVE_INDEX_DB", "drive_index.db")
+INDEX_FIELDS = "id, name, mimeType, parents, size, md5Checksum, modifiedTime, trashed"
+
+# API field name -> column, for projection and ordering
+COLUMNS = {
+    "id": "file_id",
+    "name": "name",
+    "mimeType": "mime_type",
+    "parents": "parents",
+    "size": "size",
+    "md5Checksum": "md5",
+    "modifiedTime": "modified_time",
+}
+
+
+class DriveIndex:
+    """ SQLite table of file metadata per session plus the Changes API page token to continue from. """
+
+    def __init__(self, path=DRIVE_INDEX_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " session_id TEXT NOT NULL, file_id TEXT NOT NULL, name TEXT, mime_type TEXT, parents TEXT,"
+                " size INTEGER, md5 TEXT, modified_time TEXT, PRIMARY KEY (session_id, file_id))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS files_by_name ON files (session_id, name)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_parents ("
+                " session_id TEXT NOT NULL, parent_id TEXT NOT NULL, file_id TEXT NOT NULL,"
+                " PRIMARY KEY (session_id, parent_id, file_id))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS index_state (session_id TEXT PRIMARY KEY, page_token TEXT)"
+            )
+            # When each session's index last caught up, shared by every worker; generation counts writes since
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS index_freshness ("
+                " session_id TEXT PRIMARY KEY, generation INTEGER NOT NULL, synced_at REAL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def page_token(self, session_id):
+        row = self._connection().execute(
+            "SELECT page_token FROM index_state WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _remove(self, connection, session_id, file_id):
+        connection.execute("DELETE FROM files WHERE session_id = ? AND file_id = ?", (session_id, file_id))
+        connection.execute("DELETE FROM file_parents WHERE session_id = ? AND file_id = ?", (session_id, file_id))
+
+    def apply(self, session_id, files, removed=(), page_token=None, reset=False):
+        """ Upserts files and drops removed or trashed ones in one transaction; reset clears the session first. """
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN")
+            if reset:
+                connection.execute("DELETE FROM files WHERE session_id = ?", (session_id,))
+                connection.execute("DELETE FROM file_parents WHERE session_id = ?", (session_id,))
+                connection.execute("DELETE FROM index_state WHERE session_id = ?", (session_id,))
+            for file_id in removed:
+                self._remove(connection, session_id, file_id)
+            for file in files:
+                self._remove(connection, session_id, file["id"])
+                if file.get("trashed"):
+                    continue
+                parents = file.get("parents", [])
+                connection.execute(
+                    "INSERT INTO files (session_id, file_id, name, mime_type, parents, size, md5, modified_time)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (session_id, file["id"], file.get("name"), file.get("mimeType"), json.dumps(parents),
+                     int(file["size"]) if "size" in file else None, file.get("md5Checksum"), file.get("modifiedTime")),
+                )
+                connection.executemany(
+                    "INSERT OR IGNORE INTO file_parents (session_id, parent_id, file_id) VALUES (?, ?, ?)",
+                    [(session_id, parent_id, file["id"]) for parent_id in parents],
+                )
+            if page_token:
+                connection.execute(
+                    "INSERT OR REPLACE INTO index_state (session_id, page_token) VALUES (?, ?)", (session_id, page_token)
+                )
+
+    def freshness(self, session_id):
+        """ (generation, synced_at) for the session; synced_at is None until a refresh has caught up. """
+        row = self._connection().execute(
+            "SELECT generation, synced_at FROM index_freshness WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return (row[0], row[1]) if row else (0, None)
+
+    def mark_synced(self, session_id, generation, synced_at):
+        """ Records a refresh that started at generation, unless a write has marked the index stale since. """
+        self._connection().execute(
+            "INSERT INTO index_freshness (session_id, generation, synced_at) VALUES (?, ?, ?)"
+            " ON CONFLICT (session_id) DO UPDATE SET synced_at = excluded.synced_at"
+            " WHERE generation = excluded.generation",
+            (session_id, generation, synced_at),
+        )
+
+    def mark_stale(self, session_id):
+        """ After our own writes to Drive: every worker catches up before answering from the index again. """
+        self._connection().execute(
+            "INSERT INTO index_freshness (session_id, generation, synced_at) VALUES (?, 1, NULL)"
+            " ON CONFLICT (session_id) DO UPDATE SET generation = generation + 1, synced_at = NULL",
+            (session_id,),
+        )
+
+    def remove(self, session_id, file_id):
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN")
+            self._remove(connection, session_id, file_id)
+
+    @staticmethod
+    def _row(row, fields):
+        file = {}
+        for field, value in zip(fields, row):
+            if value is None:
+                continue
+            if field == "parents":
+                value = json.loads(value)
+            elif field == "size":
+                value = str(value)  # Drive reports sizes as strings
+            file[field] = value
+        return file
+
+    def get(self, session_id, file_id, fields=tuple(COLUMNS)):
+        columns = ", ".join(COLUMNS[field] for field in fields)
+        row = self._connection().execute(
+            f"SELECT {columns} FROM files WHERE session_id = ? AND file_id = ?", (session_id, file_id)
+        ).fetchone()
+        return self._row(row, fields) if row else None
+
+    def query(self, session_id, fields=tuple(COLUMNS), name=None, name_contains=None, parent=None, mime_type=None,
+              order_by="name", limit=100, offset=0):
+        """ Files matching every given filter, projected to fields (API names) and ordered by one of them. """
+        fields = [field for field in fields if field in COLUMNS] or list(COLUMNS)
+        sql = f"SELECT {', '.join('f.' + COLUMNS[field] for field in fields)} FROM files f"
+        params = []
+        if parent:
+            sql += " JOIN file_parents p ON p.session_id = f.session_id AND p.file_id = f.file_id AND p.parent_id = ?"
+            params.append(parent)
+        sql += " WHERE f.session_id = ?"
+        params.append(session_id)
+        if name:
+            sql += " AND f.name = ?"
+            params.append(name)
+        if name_contains:
+            sql += " AND f.name LIKE ? ESCAPE '\\'"
+            escaped = name_contains.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+        if mime_type:
+            sql += " AND f.mime_type = ?"
+            params.append(mime_type)
+        descending = order_by.startswith("-")
+        sql += f" ORDER BY f.{COLUMNS.get(order_by.lstrip('-'), 'name')}{' DESC' if descending else ''}, f.file_id"
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        return [self._row(row, fields) for row in self._connection().execute(sql, params)]
+
+
+drive_index = DriveIndex()
@@ -0,0 +1,95 @@
+import os
+import asyncio
+import secrets
+import importlib
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from http_client import lifespan, rate_limits
+from metrics import metrics_response
+
+# One process (or one pool of workers) serving every connector under its own prefix.
+# Connectors are imported on their first request. Mounted apps never see lifespan events,
+# so the gateway runs the shared one: the pooled HTTP client and the token flush at shutdown.
+
+GATEWAY_HOST = os.getenv("GATEWAY_HOST", "127.0.0.1")
+GATEWAY_PORT = int(os.getenv("GATEWAY_PORT", "8000"))
+GATEWAY_BASE_URL = os.getenv("GATEWAY_BASE_URL", f"http://localhost:{GATEWAY_PORT}")  # Public URL for OAuth redirects
+GATEWAY_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# prefix -> (module, redirect URI variable, callback path inside the connector)
+CONNECTORS = {
+    "drive": ("Google_Drive_Connector", "DRIVE_REDIRECT_URI", "/auth/callback"),
+    "meet": ("Google_meet_Connector", "MEET_REDIRECT_URI", "/auth/callback"),
+    "teams": ("Microsoft_teams_Connector", "TEAMS_REDIRECT_URI", "/auth/callback"),
+    "trello": ("Trello_Connector", None, None),
+    "zoom": ("Zoom_Connector", "ZOOM_REDIRECT_URI", "/zoom/callback"),
+    "feed": ("meetings_feed", None, None),  # Meetings of Meet, Zoom and Teams merged into one stream
+}
+ENABLED_CONNECTORS = [name.strip() for name in os.getenv("GATEWAY_CONNECTORS", ",".join(CONNECTORS)).split(",")
+                      if name.strip() in CONNECTORS]
+
+# Each connector must send its provider the callback URL under its prefix
+for prefix, (_, redirect_variable, callback_path) in CONNECTORS.items():
+    if redirect_variable:
+        os.environ.setdefault(redirect_variable, f"{GATEWAY_BASE_URL}/{prefix}{callback_path}")
+
+
+class LazyConnector:
+    """ ASGI app that imports its connector module on the first request and then delegates to its app. """
+
+    def __init__(self, module_name):
+        self.module_name = module_name
+        self.app = None
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        async with self._lock:
+            if self.app is None:
+                # Importing reads config and pulls in SDKs, so keep it off the event loop
+                module = await asyncio.to_thread(importlib.import_module, self.module_name)
+                self.app = module.app
+        return self.app
+
+    async def __call__(self, scope, receive, send):
+        try:
+            app = await self.load()
+        except Exception as e:  # Retried on the next request, e.g. once missing config is provided
+            response = JSONResponse({"error": f"{self.module_name} is unavailable", "details": str(e)},
+                                    status_code=503)
+            await response(scope, receive, send)
+            return
+        await app(scope, receive, send)
+
+
+app = FastAPI(lifespan=lifespan)
+connectors = {prefix: LazyConnector(CONNECTORS[prefix][0]) for prefix in ENABLED_CONNECTORS}
+
+
+@app.get("/")
+async def root():
+    return {"message": "Connector Gateway is running!",
+            "connectors": {f"/{prefix}": connector.app is not None for prefix, connector in connectors.items()}}
+
+
+@app.get("/rate_limits")
+async def get_rate_limits():
+    return rate_limits()
+
+
+# Every connector's metrics: they share this process and its registry
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response()
+
+
+for prefix, connector in connectors.items():
+    app.mount(f"/{prefix}", connector)
+
+
+if __name__ == "__main__":
+    # Workers share tokens and calendar data through SQLite; per-process state is only ever a cache.
+    # Graph notifications can reach any worker, so they must all expect the same clientState.
+    os.environ.setdefault("PRESENCE_CLIENT_STATE", secrets.token_urlsafe(16))
+    os.environ["WEB_CONCURRENCY"] = str(GATEWAY_WORKERS)
+    uvicorn.run("gateway:app", host=GATEWAY_HOST, port=GATEWAY_PORT, workers=GATEWAY_WORKERS)
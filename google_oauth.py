@@ -0,0 +1,60 @@
+import os
+import secrets
+from datetime import timezone
+from token_manager import read_json
+from token_store import token_store
+
+# Google OAuth helpers shared by the Drive and Meet connectors.
+# The client secrets are parsed once per process and google_auth_oauthlib is only imported
+# when a login actually happens, so workers start without touching either.
+
+_client_configs = {}  # secrets file -> parsed client config
+
+
+def client_config(secrets_file):
+    """ Parsed client secrets, or None while the file is missing (checked again on the next call). """
+    config = _client_configs.get(secrets_file)
+    if config is None and os.path.exists(secrets_file):
+        config = read_json(secrets_file)
+        if config:
+            _client_configs[secrets_file] = config
+    return config
+
+
+def build_flow(secrets_file, scopes, redirect_uri, code_verifier=None, autogenerate_code_verifier=False):
+    from google_auth_oauthlib.flow import Flow
+    config = client_config(secrets_file)
+    if config is None:
+        raise FileNotFoundError(f"{secrets_file} not found. Download it from Google Cloud Console.")
+    return Flow.from_client_config(config, scopes=scopes, redirect_uri=redirect_uri, code_verifier=code_verifier,
+                                   autogenerate_code_verifier=autogenerate_code_verifier)
+
+
+def authorization_url(secrets_file, scopes, redirect_uri, provider, session_id):
+    """
+    Consent screen URL for a login of session_id. The PKCE verifier is kept with the one-time login state
+    in the token store, so any worker can finish the login and an abandoned one expires with it. Blocking.
+    """
+    code_verifier = secrets.token_urlsafe(64)
+    state = token_store.begin_login(provider, session_id, {"code_verifier": code_verifier})
+    flow = build_flow(secrets_file, scopes, redirect_uri, code_verifier=code_verifier)
+    auth_url, _ = flow.authorization_url(prompt="consent", state=state)
+    return auth_url
+
+
+def exchange_code(secrets_file, scopes, redirect_uri, code, code_verifier):
+    """ Trades the authorization code for token data in TokenManager form. Blocking; run it in a thread. """
+    flow = build_flow(secrets_file, scopes, redirect_uri, code_verifier=code_verifier)
+    flow.fetch_token(code=code)
+
+    credentials = flow.credentials
+    credentials_data = {
+        "access_token": credentials.token,
+        "refresh_token": credentials.refresh_token,
+        "token_uri": credentials.token_uri,
+        "client_id": credentials.client_id,
+        "client_secret": credentials.client_secret,
+    }
+    if credentials.expiry:
+        credentials_data["expires_at"] = credentials.expiry.replace(tzinfo=timezone.utc).timestamp()
+    return credentials_data
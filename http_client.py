@@ -0,0 +1,120 @@
+import os
+import importlib.util
+from contextlib import asynccontextmanager
+import httpx
+from rate_limiter import RateLimitedTransport, upstream_limiter
+from resilience import ResilientTransport
+from metrics import METRICS_ENABLED, MetricsTransport, track_resilience
+
+# Shared upstream HTTP client used by every connector.
+# One AsyncClient per process keeps TCP/TLS connections alive per upstream host,
+# so handlers no longer pay a handshake (or block the event loop) on every call.
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "500"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "100"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", "60"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "10"))
+
+# HTTP/2 is negotiated via ALPN where the upstream supports it; it needs the optional "h2" package
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true" and importlib.util.find_spec("h2") is not None
+
+# Pace every upstream call by the budget its rate-limit headers advertise (see rate_limiter.py)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+
+# Per-host timeouts, retries, circuit breaking and hedging (see resilience.py)
+RESILIENCE_ENABLED = os.getenv("RESILIENCE_ENABLED", "true").lower() == "true"
+
+# Comma separated host=base URL pairs sending an upstream's calls elsewhere, e.g. "*=http://127.0.0.1:9100"
+# for the benchmark stand-ins in benchmarks/; "*" matches every host
+UPSTREAM_OVERRIDES = dict(item.strip().split("=", 1) for item in os.getenv("UPSTREAM_OVERRIDES", "").split(",")
+                          if "=" in item)
+
+_client = None
+_shutdown_callbacks = []  # Coroutine functions run before the client closes, e.g. flushing pending token writes
+
+
+class OverrideTransport(httpx.AsyncBaseTransport):
+    """ Sends requests for overridden hosts to another base URL, keeping the path, query and Host header. """
+
+    def __init__(self, transport, overrides):
+        self.transport = transport
+        self.overrides = {host: httpx.URL(url) for host, url in overrides.items()}
+
+    async def handle_async_request(self, request):
+        target = self.overrides.get(request.url.host) or self.overrides.get("*")
+        if target is not None:
+            # A copy, so the outer layers still see (and key their budgets and breakers by) the real host
+            url = request.url.copy_with(scheme=target.scheme, host=target.host, port=target.port)
+            request = httpx.Request(request.method, url, headers=request.headers, stream=request.stream,
+                                    extensions=request.extensions)
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def build_client():
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=HTTP_CONNECT_TIMEOUT,
+        read=HTTP_READ_TIMEOUT,
+        write=HTTP_WRITE_TIMEOUT,
+        pool=HTTP_POOL_TIMEOUT,
+    )
+    transport = httpx.AsyncHTTPTransport(http2=HTTP2_ENABLED, limits=limits)
+    if UPSTREAM_OVERRIDES:
+        transport = OverrideTransport(transport, UPSTREAM_OVERRIDES)
+    if RATE_LIMIT_ENABLED:
+        transport = RateLimitedTransport(transport)
+    if RESILIENCE_ENABLED:
+        transport = ResilientTransport(transport)  # Above the limiter, so throttled retries are not seen as failures
+        track_resilience("upstream", transport)
+    if METRICS_ENABLED:
+        transport = MetricsTransport(transport)  # Outermost, timing calls as the handlers see them
+    return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+
+def get_client():
+    """ Returns the process-wide client, creating it on first use outside of the app lifespan. """
+    global _client
+    if _client is None:
+        _client = build_client()
+    return _client
+
+
+def rate_limits():
+    """ Current per-host, per-token budgets, for the /rate_limits endpoints. """
+    return {"enabled": RATE_LIMIT_ENABLED, "budgets": upstream_limiter.snapshot()}
+
+
+def register_shutdown(callback):
+    _shutdown_callbacks.append(callback)
+
+
+async def startup():
+    get_client()
+
+
+async def shutdown():
+    global _client
+    for callback in _shutdown_callbacks:
+        await callback()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import heapq
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+import uvicorn
+from fastapi import FastAPI, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from http_client import lifespan, rate_limits
+from metrics import instrument, metrics_response
+from token_manager import TokenRefreshError
+from token_store import get_session_id
+from calendar_store import utc_timestamp
+import Google_meet_Connector as meet
+import Microsoft_teams_Connector as teams
+import Zoom_Connector as zoom
+
+# One meetings feed over Google Meet, Zoom and Teams. The providers are queried concurrently, each
+# within its own timeout, and their events are merged by start time into one NDJSON stream, so a
+# slow or failing provider delays the feed by at most its timeout and only drops its own events.
+
+FEED_DAYS = int(os.getenv("MEETINGS_FEED_DAYS", "7"))  # Window length when time_max is not given
+SOURCE_TIMEOUT = float(os.getenv("MEETINGS_FEED_TIMEOUT", "5"))  # Seconds each provider gets to answer
+# Per-provider overrides, e.g. "teams=8,zoom=3"
+SOURCE_TIMEOUTS = {
+    source.strip(): float(seconds)
+    for source, seconds in (item.split("=") for item in os.getenv("MEETINGS_FEED_TIMEOUTS", "").split(",") if item)
+}
+
+app = FastAPI(lifespan=lifespan)
+instrument(app, "feed")
+
+
+class NotAuthenticated(Exception):
+    """ The session has not logged in to this provider, or its login has expired. """
+
+
+def feed_event(source, event_id, title, start, end, join_url):
+    return {"source": source, "id": event_id, "title": title, "start": start, "end": end, "join_url": join_url}
+
+
+async def meet_events(session_id, time_min, time_max):
+    # The calendar store answers from its local copy, syncing first when it is due
+    try:
+        meetings = await meet.stored_meetings(session_id, time_min, time_max)
+    except TokenRefreshError:
+        meetings = None
+    if meetings is None:
+        raise NotAuthenticated()
+    return [feed_event("meet", meeting["id"], meeting["summary"], meeting["start"], meeting["end"],
+                       meeting["hangout_link"]) for meeting in meetings]
+
+
+async def zoom_events(session_id, time_min, time_max):
+    try:
+        meetings = await zoom.scheduled_meetings(session_id, time_min[:10], time_max[:10])
+    except HTTPException as e:
+        if e.status_code == 401:
+            raise NotAuthenticated()
+        raise
+    events = []
+    for meeting in meetings:
+        if not meeting.get("start_time"):
+            continue  # Recurring meetings without a fixed time
+        start = utc_timestamp(meeting["start_time"])
+        end = datetime.strptime(start, "%Y-%m-%dT%H:%M:%SZ") + timedelta(minutes=meeting.get("duration", 0))
+        end = end.strftime("%Y-%m-%dT%H:%M:%SZ")
+        if end > time_min and start < time_max:
+            events.append(feed_event("zoom", str(meeting["id"]), meeting.get("topic"), start, end,
+                                     meeting.get("join_url")))
+    events.sort(key=lambda event: event["start"])
+    return events
+
+
+async def teams_events(session_id, time_min, time_max):
+    events = []
+    async for item in teams.calendar_view(session_id, time_min, time_max):
+        if item is teams.NOT_AUTHENTICATED:
+            raise NotAuthenticated()
+        if "error" in item:
+            raise RuntimeError(f"Graph request failed ({item['status']}): {item['details']}")
+        if not item.get("isOnlineMeeting"):
+            continue
+        events.append(feed_event("teams", item["id"], item.get("subject"), utc_timestamp(item["start"]["dateTime"]),
+                                 utc_timestamp(item["end"]["dateTime"]),
+                                 (item.get("onlineMeeting") or {}).get("joinUrl") or item.get("webLink")))
+    return events
+
+
+SOURCES = {"meet": meet_events, "zoom": zoom_events, "teams": teams_events}
+
+
+async def collect(source, session_id, time_min, time_max, timeout):
+    """ One provider's events, oldest first, and a status entry; never raises. """
+    started = time.perf_counter()
+    events = []
+    try:
+        events = await asyncio.wait_for(SOURCES[source](session_id, time_min, time_max), timeout)
+        status = {"status": "ok", "count": len(events)}
+    except asyncio.TimeoutError:
+        status = {"status": "timeout"}
+    except NotAuthenticated:
+        status = {"status": "unauthenticated"}
+    except HTTPException as e:
+        status = {"status": "error", "details": str(e.detail)}
+    except Exception as e:
+        status = {"status": "error", "details": str(e)}
+    status["ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return events, status
+
+
+@app.get("/")
+async def root():
+    return {"message": "Meetings Feed is running!", "sources": list(SOURCES)}
+
+
+# Upstream rate-limit budgets as learned from response headers
+@app.get("/rate_limits")
+async def get_rate_limits():
+    return rate_limits()
+
+
+# Route, upstream, token and cache metrics of this process in the Prometheus text format
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response()
+
+
+@app.get("/meetings")
+async def get_meetings(time_min: Optional[str] = None, time_max: Optional[str] = None, sources: Optional[str] = None,
+                       timeout: Optional[float] = None, session_id: str = Depends(get_session_id)):
+    """
+    Meetings of all providers between time_min and time_max (RFC 3339, default now and FEED_DAYS later)
+    as NDJSON lines of {source, id, title, start, end, join_url} ordered by start, in UTC. The last line
+    is {"sources": {...}} with each provider's status: ok, timeout, unauthenticated or error.
+    sources limits the providers (comma separated); timeout overrides every per-source timeout.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        time_min = utc_timestamp(time_min) or now.strftime("%Y-%m-%dT%H:%M:%SZ")
+        time_max = utc_timestamp(time_max) or (now + timedelta(days=FEED_DAYS)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid time range: {e}")
+    selected = [source.strip() for source in sources.split(",")] if sources else list(SOURCES)
+    unknown = [source for source in selected if source not in SOURCES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown sources: {', '.join(unknown)}")
+
+    results = await asyncio.gather(*(
+        collect(source, session_id, time_min, time_max, timeout or SOURCE_TIMEOUTS.get(source, SOURCE_TIMEOUT))
+        for source in selected
+    ))
+
+    async def stream():
+        for event in heapq.merge(*(events for events, _ in results), key=lambda event: event["start"]):
+            yield json.dumps(event) + "\n"
+        yield json.dumps({"sources": {source: status for source, (_, status) in zip(selected, results)}}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=8000)
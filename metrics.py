@@ -0,0 +1,276 @@
+import os
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import httpx
+from fastapi.responses import PlainTextResponse
+
+# In-process metrics for every connector, rendered in the Prometheus text format on /metrics.
+# Recording is a dict lookup and a few additions, cheap enough to leave on under full load.
+# Each worker keeps its own numbers; with several workers a scrape sees the worker that answered it.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Adds a Server-Timing header splitting each response's time into upstream, token and app work
+SERVER_TIMING_ENABLED = os.getenv("METRICS_SERVER_TIMING", "false").lower() == "true"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_spans = ContextVar("metric_spans", default=None)  # span name -> seconds, for the request being served
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def label_text(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    """ One metric family; samples are kept per tuple of label values. """
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in list(self.values.items()):
+            lines.append(f"{self.name}{label_text(self.labels, values)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *values, amount=1):
+        self.values[values] = self.values.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *values, amount=1):
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def dec(self, *values, amount=1):
+        self.values[values] = self.values.get(values, 0) - amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, seconds, *values):
+        sample = self.values.get(values)
+        if sample is None:
+            # Per-bucket counts (the last one is +Inf), then the sum
+            sample = self.values[values] = [0] * (len(self.buckets) + 1) + [0.0]
+        sample[bisect_left(self.buckets, seconds)] += 1
+        sample[-1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ("le",)
+        for values, sample in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), sample):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{label_text(bucket_labels, values + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text(self.labels, values)} {sample[-1]}")
+            lines.append(f"{self.name}_count{label_text(self.labels, values)} {cumulative}")
+        return lines
+
+
+route_requests = Counter("connector_requests_total", "Requests served, by route and status",
+                         ("connector", "method", "route", "status"))
+route_latency = Histogram("connector_request_duration_seconds", "Time to the response headers, by route",
+                          ("connector", "method", "route"))
+route_in_flight = Gauge("connector_requests_in_flight", "Requests being served", ("connector",))
+response_bytes = Counter("connector_response_bytes_total", "Response body bytes sent, streamed ones included",
+                         ("connector", "route"))
+upstream_requests = Counter("upstream_requests_total", "Upstream calls, by host and status",
+                            ("host", "method", "status"))
+upstream_latency = Histogram("upstream_request_duration_seconds",
+                             "Time to the upstream response headers, including retries and rate-limit pacing",
+                             ("host", "method"))
+upstream_in_flight = Gauge("upstream_requests_in_flight", "Upstream calls waiting for a response", ("host",))
+token_refreshes = Counter("token_refreshes_total", "Token refreshes by outcome", ("provider", "outcome"))
+token_refresh_latency = Histogram("token_refresh_duration_seconds", "Time spent in token refreshes", ("provider",))
+token_load_latency = Histogram("token_load_duration_seconds", "Time reading a stored token", ("provider",))
+transfer_bytes = Counter("transfer_bytes_total", "File bytes moved by the download helpers", ("mode",))
+
+METRICS = [route_requests, route_latency, route_in_flight, response_bytes, upstream_requests, upstream_latency,
+           upstream_in_flight, token_refreshes, token_refresh_latency, token_load_latency, transfer_bytes]
+
+_caches = weakref.WeakValueDictionary()  # name -> ResponseCache whose counters are reported
+_resilience = weakref.WeakValueDictionary()  # name -> ResilientTransport whose breakers are reported
+BREAKER_STATES = {"closed": 0, "half-open": 1, "open": 2}
+
+
+def track_cache(name, cache):
+    _caches[name] = cache
+
+
+def cache_lines():
+    lines = ["# HELP response_cache_requests_total Cache lookups by result",
+             "# TYPE response_cache_requests_total counter"]
+    ratios = ["# HELP response_cache_hit_ratio Share of lookups answered without an upstream call",
+              "# TYPE response_cache_hit_ratio gauge"]
+    for name, cache in list(_caches.items()):
+        results = {"hit": cache.hits, "miss": cache.misses, "coalesced": cache.coalesced,
+                   "revalidated": cache.revalidated}
+        for result, count in results.items():
+            lines.append(f"response_cache_requests_total{label_text(('cache', 'result'), (name, result))} {count}")
+        lookups = cache.hits + cache.misses + cache.coalesced
+        ratio = (cache.hits + cache.coalesced + cache.revalidated) / lookups if lookups else 0
+        ratios.append(f"response_cache_hit_ratio{label_text(('cache',), (name,))} {ratio:.4f}")
+    return lines + ratios
+
+
+def track_resilience(name, transport):
+    _resilience[name] = transport
+
+
+def resilience_lines():
+    states = ["# HELP upstream_circuit_state Circuit breaker per upstream API: 0 closed, 1 half-open, 2 open",
+              "# TYPE upstream_circuit_state gauge"]
+    failures = ["# HELP upstream_consecutive_failures Failures since the last success, per upstream API",
+                "# TYPE upstream_consecutive_failures gauge"]
+    hedged = ["# HELP upstream_hedged_requests_total Duplicate GETs sent after the hedge delay",
+              "# TYPE upstream_hedged_requests_total counter"]
+    for transport in list(_resilience.values()):
+        for upstream, state in transport.snapshot().items():
+            labels = label_text(("upstream",), (upstream,))
+            states.append(f"upstream_circuit_state{labels} {BREAKER_STATES[state['breaker']]}")
+            failures.append(f"upstream_consecutive_failures{labels} {state['failures']}")
+            hedged.append(f"upstream_hedged_requests_total{labels} {state['hedged']}")
+    return states + failures + hedged
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += cache_lines()
+    lines += resilience_lines()
+    return "\n".join(lines) + "\n"
+
+
+def metrics_response():
+    """ Body of the /metrics endpoints. """
+    return PlainTextResponse(render(), media_type=CONTENT_TYPE)
+
+
+def add_span(name, seconds):
+    spans = _spans.get()
+    if spans is not None:
+        spans[name] = spans.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timed(histogram, *values, span=None):
+    """ Observes the block's duration in histogram and, during a traced request, adds it to span. """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, *values)
+        if span:
+            add_span(span, elapsed)
+
+
+def server_timing(spans, total):
+    # Spans are summed durations, so concurrent upstream calls can exceed the total; app is what is left
+    app = max(0.0, total - sum(spans.values()))
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in spans.items()]
+    return ", ".join(entries + [f"app;dur={app * 1000:.1f}", f"total;dur={total * 1000:.1f}"])
+
+
+class MetricsMiddleware:
+    """ ASGI middleware recording per-route latency, status, in-flight requests and response bytes. """
+
+    def __init__(self, app, connector):
+        self.app = app
+        self.connector = connector
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        token = _spans.set({}) if SERVER_TIMING_ENABLED else None
+        state = {"status": 500, "route": None}
+
+        def route():
+            if state["route"] is None:
+                matched = scope.get("route")
+                state["route"] = getattr(matched, "path", None) or "unmatched"  # Unknown paths share one label
+            return state["route"]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                elapsed = time.perf_counter() - started
+                route_latency.observe(elapsed, self.connector, scope["method"], route())
+                if token is not None:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", server_timing(_spans.get(), elapsed).encode())]
+            elif message["type"] == "http.response.body":
+                response_bytes.inc(self.connector, route(), amount=len(message.get("body", b"")))
+            await send(message)
+
+        route_in_flight.inc(self.connector)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route_in_flight.dec(self.connector)
+            route_requests.inc(self.connector, scope["method"], route(), state["status"])
+            if token is not None:
+                _spans.reset(token)
+
+
+def instrument(app, connector):
+    """ Adds the request middleware to a connector app when metrics are enabled. """
+    if METRICS_ENABLED:
+        app.add_middleware(MetricsMiddleware, connector=connector)
+
+
+class MetricsTransport(httpx.AsyncBaseTransport):
+    """ Transport wrapper timing every upstream call by host, as the handler experiences it. """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        host, method = request.url.host, request.method
+        status = "error"
+        upstream_in_flight.inc(host)
+        started = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+            status = response.status_code
+            return response
+        finally:
+            elapsed = time.perf_counter() - started
+            upstream_in_flight.dec(host)
+            upstream_latency.observe(elapsed, host, method)
+            upstream_requests.inc(host, method, status)
+            add_span("upstream", elapsed)
+
+    async def aclose(self):
+        await self.transport.aclose()
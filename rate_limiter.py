@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict, deque
+import httpx
+
+
+def retry_after_seconds(response, default):
+    """ Seconds to wait as advertised by a 429/503 Retry-After header, or default when absent. """
+    value = response.headers.get("Retry-After")
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+GOOGLE_RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+def google_rate_limited(body):
+    """ True when a Google error body (parsed or raw) reports a rate limit, e.g. on a 403 that is not a denial. """
+    if isinstance(body, (str, bytes)):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            return False
+    error = body.get("error") if isinstance(body, dict) else None
+    if not isinstance(error, dict):
+        return False
+    return any(isinstance(item, dict) and item.get("reason") in GOOGLE_RATE_LIMIT_REASONS
+               for item in error.get("errors") or [])
+
+
+class TokenBucket:
+    """
+    Token bucket pacing calls to ``rate`` per second with bursts of up to ``capacity``.
+    Waiters are served in arrival order; ``pause`` stops everyone, e.g. after a 429.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    async def acquire(self, tokens=1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until  # No credit accrues while paused
+
+
+# Upstream-driven limits: every outgoing request is paced by a budget per (host, token) that is
+# sized from the rate-limit headers the upstream returns, or found by AIMD when it only sends 429s.
+
+RATE_LIMIT_HEADROOM = float(os.getenv("RATE_LIMIT_HEADROOM", "0.9"))  # Fraction of the advertised limit to use
+RATE_LIMIT_RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", "3"))  # 429s retried after waiting out Retry-After
+RATE_LIMIT_MAX_BUDGETS = 10000
+MIN_RATE = 0.5  # Requests per second a throttled budget never drops below
+AIMD_DECREASE = 0.5  # Rate multiplier applied on a 429 without rate-limit headers
+AIMD_INCREASE = 1.0  # Requests per second added per second without a 429
+DEFAULT_BACKOFF = 1.0
+SAMPLE_WINDOW = 5.0  # Seconds of send history used to estimate the current rate
+
+
+def rate_limit_headers(headers):
+    """
+    Reads (limit, remaining, window_seconds, sliding) from the header family the upstream uses:
+    Trello's x-rate-limit-api-token-*, or X-RateLimit-* / RateLimit-* (Zoom, Graph and most others).
+    """
+    # Headers that do not parse are ignored rather than failing the request they came with
+    remaining = headers.get("x-rate-limit-api-token-remaining")
+    if remaining is not None:
+        try:
+            interval = float(headers.get("x-rate-limit-api-token-interval-ms", "10000")) / 1000
+            return int(headers.get("x-rate-limit-api-token-max", "0")) or None, int(remaining), interval, True
+        except ValueError:
+            return None, None, None, False
+
+    for prefix in ("x-ratelimit-", "ratelimit-"):
+        remaining = headers.get(f"{prefix}remaining")
+        if remaining is None:
+            continue
+        limit = headers.get(f"{prefix}limit")
+        reset = headers.get(f"{prefix}reset")
+        window = None
+        if reset is not None:
+            try:
+                window = float(reset)
+            except ValueError:
+                window = None  # e.g. an HTTP date; pace on the remaining count alone
+            else:
+                if window > 1e9:  # Epoch timestamp rather than seconds until reset
+                    window -= time.time()
+                window = max(window, 0.0)
+        try:
+            return int(limit) if limit else None, int(remaining), window, False
+        except ValueError:
+            return None, None, None, False  # e.g. Zoom's per-category values we cannot pace on
+    return None, None, None, False
+
+
+class AdaptiveBudget(TokenBucket):
+    """ Token bucket whose rate follows the upstream's advertised budget; unpaced until it learns one. """
+
+    def __init__(self, host, token):
+        super().__init__(rate=None, capacity=1.0)
+        self.host = host
+        self.token = token
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.header_driven = False
+        self.max_rate = None  # Documented limit a seeded budget is paced at until headers say otherwise
+        self.requests = 0
+        self.throttled = 0
+        self._sent = deque()
+        self._increased = time.monotonic()
+
+    async def acquire(self, tokens=1):
+        self.requests += 1
+        now = time.monotonic()
+        self._sent.append(now)
+        while self._sent[0] < now - SAMPLE_WINDOW:
+            self._sent.popleft()
+        if self.rate is not None:
+            await super().acquire(tokens)
+        elif self.paused_until > now:
+            await asyncio.sleep(self.paused_until - now)
+
+    def set_rate(self, rate):
+        if self.rate is not None:
+            self._refill()
+        else:
+            self.tokens, self.updated = 1.0, max(time.monotonic(), self.updated)
+        self.rate = max(MIN_RATE, rate)
+        self.capacity = max(1.0, self.rate / 10)  # At most 100 ms worth of burst
+        self.tokens = min(self.tokens, self.capacity)
+
+    def recent_rate(self):
+        if len(self._sent) < 2:
+            return MIN_RATE
+        return len(self._sent) / max(1.0, self._sent[-1] - self._sent[0])
+
+    def observe(self, response):
+        limit, remaining, window, sliding = rate_limit_headers(response.headers)
+        if remaining is not None:
+            self.limit, self.remaining = limit, remaining
+            self.reset_at = time.time() + window if window is not None and not sliding else None
+
+        if response.status_code == 429:
+            self.throttled += 1
+            self.pause(retry_after_seconds(response, default=window or DEFAULT_BACKOFF))
+            if not self.header_driven:
+                self.set_rate((self.rate or self.recent_rate()) * AIMD_DECREASE)
+                self._increased = time.monotonic()
+            return
+
+        if remaining is not None and window:
+            # Spread what is left of a fixed window until its reset; run a sliding window at its limit
+            self.header_driven = True
+            if sliding and limit:
+                self.set_rate(limit * RATE_LIMIT_HEADROOM / window)
+            else:
+                self.set_rate(remaining * RATE_LIMIT_HEADROOM / window)
+            if remaining == 0:
+                self.pause(window if not sliding else window / 10)
+        elif remaining == 0:
+            self.pause(retry_after_seconds(response, default=DEFAULT_BACKOFF))
+        elif self.rate is not None and not self.header_driven:
+            now = time.monotonic()
+            self.set_rate(min(self.rate + AIMD_INCREASE * (now - self._increased), self.max_rate or float("inf")))
+            self._increased = now
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {
+            "host": self.host,
+            "token": self.token,
+            "rate": round(self.rate, 3) if self.rate is not None else None,
+            "limit": self.limit,
+            "remaining": self.remaining,
+            "reset_in": round(self.reset_at - time.time(), 3) if self.reset_at else None,
+            "paused_for": round(max(0.0, self.paused_until - now), 3),
+            "requests": self.requests,
+            "throttled": self.throttled,
+        }
+
+
+class UpstreamLimiter:
+    """ Budgets keyed by upstream host and a hash of the caller's credentials, LRU bounded. """
+
+    def __init__(self, max_budgets=RATE_LIMIT_MAX_BUDGETS):
+        self.max_budgets = max_budgets
+        self._budgets = OrderedDict()
+        self._documented = {}  # host -> (limit, window) new budgets start from, before any response
+
+    def document_limit(self, host, limit, window):
+        """ Paces new budgets for host at a published per-token limit, so the first calls don't go out in one burst. """
+        self._documented[host] = (limit, window)
+
+    @staticmethod
+    def budget_key(request):
+        credential = request.headers.get("Authorization") or request.url.params.get("token") or ""
+        token = hashlib.sha256(credential.encode()).hexdigest()[:12] if credential else None
+        return request.url.host, token
+
+    def budget(self, request):
+        key = self.budget_key(request)
+        budget = self._budgets.get(key)
+        if budget is None:
+            budget = self._budgets[key] = AdaptiveBudget(*key)
+            if key[0] in self._documented:
+                limit, window = self._documented[key[0]]
+                budget.set_rate(limit * RATE_LIMIT_HEADROOM / window)
+                budget.max_rate = budget.rate
+            while len(self._budgets) > self.max_budgets:
+                self._budgets.popitem(last=False)
+        self._budgets.move_to_end(key)
+        return budget
+
+    def snapshot(self):
+        return [budget.snapshot() for budget in self._budgets.values()]
+
+
+upstream_limiter = UpstreamLimiter()
+
+
+def replayable(request):
+    # Streamed uploads cannot be sent twice; bodies built from bytes, JSON or forms can
+    return isinstance(request.stream, httpx.ByteStream)
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """ Transport wrapper that paces requests through the limiter and retries 429 responses. """
+
+    def __init__(self, transport, limiter=upstream_limiter, retries=RATE_LIMIT_RETRIES):
+        self.transport = transport
+        self.limiter = limiter
+        self.retries = retries
+
+    async def handle_async_request(self, request):
+        budget = self.limiter.budget(request)
+        for attempt in range(self.retries + 1):
+            await budget.acquire()
+            response = await self.transport.handle_async_request(request)
+            budget.observe(response)
+            if response.status_code != 429 or attempt == self.retries or not replayable(request):
+                return response
+            await response.aclose()
+
+    async def aclose(self):
+        await self.transport.aclose()
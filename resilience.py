@@ -0,0 +1,197 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+import httpx
+from rate_limiter import replayable
+
+logger = logging.getLogger(__name__)
+
+# Fault handling for upstream calls, applied by http_client to every connector: per-host read
+# timeouts, jittered retries of idempotent requests, and a circuit breaker and hedged GETs per
+# upstream API (host plus service path, so Drive and Calendar on www.googleapis.com fail apart).
+
+# "host=seconds,host=seconds"; hosts not listed keep the client's HTTP_READ_TIMEOUT
+DEFAULT_HOST_TIMEOUTS = "graph.microsoft.com=30,www.googleapis.com=30,api.trello.com=15,api.zoom.us=30,zoom.us=30"
+HOST_TIMEOUTS = {
+    host.strip(): float(seconds)
+    for host, seconds in (item.split("=") for item in os.getenv("UPSTREAM_TIMEOUTS", DEFAULT_HOST_TIMEOUTS).split(",") if item)
+}
+RETRY_ATTEMPTS = int(os.getenv("UPSTREAM_RETRY_ATTEMPTS", "3"))  # Retries after the first attempt
+RETRY_BASE_DELAY = 0.2
+RETRY_MAX_DELAY = 5.0
+RETRY_STATUS_CODES = (502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))  # Consecutive failures that open a host's breaker
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))  # Seconds before a trial request is let through
+HEDGE_GETS = os.getenv("HEDGE_GETS", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))  # Latency after which a duplicate GET is sent
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05
+LATENCY_SAMPLES = 200
+SERVICE_PATH_WRAPPERS = ("upload", "batch")  # Google's /upload/drive/v3 and /batch/drive/v3 belong to drive
+
+
+class CircuitOpenError(httpx.TransportError):
+    """ The upstream host failed repeatedly and is not being called until its cooldown ends. """
+
+
+def upstream_key(url):
+    """ The API a request goes to: its host and first path segment, e.g. www.googleapis.com/calendar. """
+    segments = [segment for segment in url.path.split("/") if segment]
+    while segments and segments[0] in SERVICE_PATH_WRAPPERS:
+        segments.pop(0)
+    return f"{url.host}/{segments[0]}" if segments else url.host
+
+
+def retry_delay(attempt):
+    # Full jitter keeps clients that failed together from retrying together
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """ Closed until BREAKER_FAILURES consecutive failures, then open for BREAKER_COOLDOWN; one trial call closes it. """
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_started = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        now = time.monotonic()
+        if state == "half-open" and (self.trial_started is None or now - self.trial_started >= self.cooldown):
+            self.trial_started = now  # A trial that never reports back (e.g. cancelled) expires after a cooldown
+            return True
+        return False
+
+    def record(self, success):
+        self.trial_started = None
+        if success:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            return
+        self.consecutive_failures += 1
+        if self.opened_at is not None or self.consecutive_failures >= self.failures:
+            if self.opened_at is None:
+                logger.warning("Circuit opened after %d consecutive failures", self.consecutive_failures)
+            self.opened_at = time.monotonic()
+
+
+class HostState:
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.hedged = 0
+
+    def hedge_delay(self):
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE / 100))
+        return max(HEDGE_MIN_DELAY, ordered[index])
+
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    """ Transport wrapper adding timeouts per host, and retries, circuit breaking and hedging per upstream API. """
+
+    def __init__(self, transport, host_timeouts=HOST_TIMEOUTS, retries=RETRY_ATTEMPTS, hedge=HEDGE_GETS):
+        self.transport = transport
+        self.host_timeouts = host_timeouts
+        self.retries = retries
+        self.hedge = hedge
+        self.hosts = {}  # upstream_key -> HostState
+
+    def host_state(self, key):
+        state = self.hosts.get(key)
+        if state is None:
+            state = self.hosts[key] = HostState()
+        return state
+
+    async def handle_async_request(self, request):
+        key = upstream_key(request.url)
+        host = self.host_state(key)
+        timeout = self.host_timeouts.get(request.url.host)
+        if timeout is not None:
+            request.extensions = {**request.extensions,
+                                  "timeout": {**request.extensions.get("timeout", {}), "read": timeout}}
+        retryable = request.method in IDEMPOTENT_METHODS and replayable(request)
+
+        for attempt in range(self.retries + 1):
+            if not host.breaker.allow():
+                raise CircuitOpenError(f"Circuit open for {key}", request=request)
+            try:
+                response = await self.send(request, host)
+            except httpx.TransportError:
+                host.breaker.record(False)
+                if not retryable or attempt == self.retries:
+                    raise
+            else:
+                failed = response.status_code in RETRY_STATUS_CODES
+                host.breaker.record(not failed)
+                if not failed or not retryable or attempt == self.retries:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(retry_delay(attempt))
+
+    async def send(self, request, host):
+        delay = host.hedge_delay() if self.hedge and request.method == "GET" and replayable(request) else None
+        started = time.monotonic()
+        if delay is None:
+            response = await self.transport.handle_async_request(request)
+        else:
+            response = await self.hedged(request, host, delay)
+        if response.status_code < 500:
+            host.latencies.append(time.monotonic() - started)
+        return response
+
+    async def hedged(self, request, host, delay):
+        """ Sends a duplicate GET if the first has not answered within delay; the first response wins. """
+        first = asyncio.ensure_future(self.transport.handle_async_request(request))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+
+        host.hedged += 1
+        second = asyncio.ensure_future(self.transport.handle_async_request(request))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                        other.add_done_callback(close_response)
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    def snapshot(self):
+        """ Breaker and hedging state per upstream API, reported on /metrics. """
+        return {
+            key: {"breaker": state.breaker.state, "failures": state.breaker.consecutive_failures,
+                  "hedge_after": state.hedge_delay(), "hedged": state.hedged}
+            for key, state in list(self.hosts.items())
+        }
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def close_response(task):
+    # A hedge that loses the race may still deliver a response whose connection must be released
+    if not task.cancelled() and task.exception() is None:
+        asyncio.ensure_future(task.result().aclose())
@@ -0,0 +1,174 @@
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from token_store import TOKEN_DB
+
+# Invalidations are shared through this SQLite file when a connector runs with several workers
+CACHE_DB = os.getenv("CACHE_DB", TOKEN_DB)
+INVALIDATION_RETENTION = 3600  # Seconds a shared invalidation is kept; longer than any cache TTL in use
+
+
+class CacheEntry:
+    __slots__ = ("data", "etag", "expires_at")
+
+    def __init__(self, data, etag, expires_at):
+        self.data = data
+        self.etag = etag
+        self.expires_at = expires_at
+
+
+class InvalidationLog:
+    """
+    Invalidations published by every worker of a connector, in SQLite. Each worker reads the ones it has
+    not seen before answering from its cache, so a write handled by one worker evicts the others' copies.
+    """
+
+    def __init__(self, name, path=CACHE_DB):
+        self.name = name
+        self.path = path
+        self._local = threading.local()
+        self.seen = self._latest()  # Nothing older can be in a cache that starts now
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_invalidations ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT, cache TEXT NOT NULL, path TEXT NOT NULL, at REAL NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def _latest(self):
+        return self._connection().execute("SELECT COALESCE(MAX(seq), 0) FROM cache_invalidations").fetchone()[0]
+
+    def publish(self, path):
+        connection = self._connection()
+        connection.execute("DELETE FROM cache_invalidations WHERE at < ?", (time.time() - INVALIDATION_RETENTION,))
+        connection.execute("INSERT INTO cache_invalidations (cache, path, at) VALUES (?, ?, ?)",
+                           (self.name, path, time.time()))
+
+    def poll(self):
+        """ Paths invalidated by any worker since the last poll. Blocking. """
+        rows = self._connection().execute(
+            "SELECT seq, path FROM cache_invalidations WHERE seq > ? AND cache = ? ORDER BY seq", (self.seen, self.name)
+        ).fetchall()
+        if rows:
+            self.seen = rows[-1][0]
+        return [path for _, path in rows]
+
+
+class ResponseCache:
+    """
+    Size-bounded TTL cache for upstream GET responses.
+
+    Keys are ``(path, params)`` tuples. ``get(key, load)`` calls ``load(headers)``, which must return
+    ``(status_code, data, etag)``, only when the entry is missing or stale; stale entries with an ETag are
+    revalidated with If-None-Match so a 304 just extends their lifetime. Concurrent misses for the same
+    key share one upstream call.
+
+    With an InvalidationLog as ``shared``, invalidations reach every worker's cache. ``dependents(path)``
+    names the other paths whose cached data includes path; they are invalidated along with it.
+    """
+
+    def __init__(self, ttl, max_entries, shared=None, dependents=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared = shared
+        self.dependents = dependents
+        self._entries = OrderedDict()
+        self._inflight = {}
+        # Invalidations are numbered so a load can tell whether its path was invalidated after it started;
+        # a path's number is only kept while some load older than it is still running
+        self._invalidations = 0
+        self._invalidated = {}  # path -> number of its last invalidation
+        self._running = {}  # number a running load started at -> how many loads started there
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(path, params=None):
+        return path, tuple(sorted((params or {}).items()))
+
+    async def get(self, key, load):
+        if self.shared is not None:
+            for path in await asyncio.to_thread(self.shared.poll):
+                self._drop(path)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return 200, entry.data
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key, entry, load))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def _load(self, key, entry, load):
+        started = self._invalidations
+        self._running[started] = self._running.get(started, 0) + 1
+        try:
+            headers = {"If-None-Match": entry.etag} if entry is not None and entry.etag else {}
+            status_code, data, etag = await load(headers)
+
+            if status_code == 304 and entry is not None:
+                self.revalidated += 1
+                status_code, data, etag = 200, entry.data, entry.etag
+            if status_code == 200 and self._invalidated.get(key[0], 0) <= started:
+                self._store(key, CacheEntry(data, etag, time.monotonic() + self.ttl))
+            return status_code, data
+        finally:
+            self._finished(started)
+
+    def _finished(self, started):
+        self._running[started] -= 1
+        if not self._running[started]:
+            del self._running[started]
+        # Invalidations no running load began before are no longer needed
+        if not self._running:
+            self._invalidated.clear()
+        elif started < min(self._running):
+            oldest = min(self._running)
+            for path in [path for path, number in self._invalidated.items() if number <= oldest]:
+                del self._invalidated[path]
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def invalidate(self, path):
+        """ Drops every cached variant of path (and its dependents), here and in the other workers. """
+        self._drop(path)
+        if self.shared is not None:
+            await asyncio.to_thread(self.shared.publish, path)
+
+    def _drop(self, path):
+        # Cached variants go, and in-flight loads are detached so they don't store what they fetched
+        for dropped in [path, *(self.dependents(path) if self.dependents else ())]:
+            self._invalidations += 1
+            if self._running:  # Only a load already running could store stale data
+                self._invalidated[dropped] = self._invalidations
+            for key in [key for key in self._entries if key[0] == dropped]:
+                del self._entries[key]
+            for key in [key for key in self._inflight if key[0] == dropped]:
+                del self._inflight[key]
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import weakref
+from collections import OrderedDict
+from http_client import get_client, register_shutdown
+from metrics import timed, token_load_latency, token_refresh_latency, token_refreshes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KEY = "default"
+REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))  # Refresh this many seconds before expiry
+MIN_VALIDITY = 30  # A token closer than this to expiry is refreshed before it is handed out
+IDLE_TIMEOUT = 3600  # Stop background refreshes for tokens nobody has used for this long
+SAVE_DELAY = 0.2  # Writes requested within this window are coalesced into one
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))  # Sessions kept in memory per provider
+
+
+class TokenRefreshError(Exception):
+    """ The upstream rejected the refresh token; the user has to log in again. """
+
+
+def write_json_atomic(path, data):
+    # Readers see either the old file or the new one, never a partial write
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+async def refresh_oauth_token(token_url, refresh_token, data=None, auth=None):
+    """ Runs a standard refresh_token grant and returns the fields to merge into the stored token. """
+    form = {"grant_type": "refresh_token", "refresh_token": refresh_token, **(data or {})}
+    response = await get_client().post(token_url, data=form, auth=auth)
+    if response.status_code != 200:
+        raise TokenRefreshError(response.text)
+
+    token_data = response.json()
+    refreshed = {"access_token": token_data["access_token"]}
+    if token_data.get("refresh_token"):
+        refreshed["refresh_token"] = token_data["refresh_token"]  # Zoom and Microsoft rotate refresh tokens
+    if token_data.get("expires_in"):
+        refreshed["expires_at"] = time.time() + int(token_data["expires_in"])
+    return refreshed
+
+
+_managers = weakref.WeakSet()
+
+
+async def flush_all():
+    """ Writes every pending token update now; run at shutdown so rotated refresh tokens are not lost. """
+    for manager in list(_managers):
+        await manager.flush(retry=False)
+
+
+register_shutdown(flush_all)
+
+
+class TokenManager:
+    """
+    Keeps OAuth tokens in memory and refreshes them in the background shortly before they expire.
+
+    Tokens are keyed by session id and held in an LRU of ``cache_size`` entries. Token data is a dict
+    holding "access_token" and, when known, "refresh_token" and "expires_at" (epoch seconds) plus any
+    provider specific fields. ``refresh(data)`` returns the fields to merge
+    after a refresh; the optional ``load(key)``/``save(key, data)`` pair persists tokens.
+    """
+
+    def __init__(self, name, refresh, load=None, save=None, margin=REFRESH_MARGIN, cache_size=TOKEN_CACHE_SIZE):
+        self.name = name
+        self._refresh = refresh
+        self._load = load
+        self._save = save
+        self.margin = margin
+        self.cache_size = cache_size
+        self._tokens = OrderedDict()
+        self._last_used = {}
+        self._refreshing = {}  # key -> in-flight refresh task shared by all callers
+        self._timers = {}  # key -> background refresh task
+        self._pending_saves = {}
+        self._save_task = None
+        _managers.add(self)
+
+    async def get(self, key=DEFAULT_KEY):
+        data = self._tokens.get(key)
+        if data is not None:
+            self._tokens.move_to_end(key)
+        elif self._load is not None:
+            with timed(token_load_latency, self.name, span="token_load"):
+                data = self._load(key)
+            if data:
+                self._remember(key, data)
+                self._schedule_refresh(key)
+        if not data:
+            return None
+
+        self._last_used[key] = time.monotonic()
+        if data.get("refresh_token") and data.get("expires_at", 0) - time.time() < MIN_VALIDITY:
+            data = await self.refresh(key)
+        return data
+
+    async def access_token(self, key=DEFAULT_KEY):
+        data = await self.get(key)
+        return data["access_token"] if data else None
+
+    def set(self, key, data):
+        self._remember(key, data)
+        self._last_used[key] = time.monotonic()
+        self._schedule_save(key, data)
+        self._schedule_refresh(key)
+
+    async def refresh(self, key=DEFAULT_KEY):
+        """ Refreshes the token for key; concurrent callers share a single upstream refresh. """
+        task = self._refreshing.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._do_refresh(key))
+            self._refreshing[key] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _do_refresh(self, key):
+        data = self._tokens.get(key)
+        stored = self._load_stored(key)
+        if stored and stored.get("expires_at", 0) > (data or {}).get("expires_at", 0):
+            # Another worker already refreshed this session; reuse its (possibly rotated) tokens
+            data = stored
+            if data["expires_at"] - time.time() >= MIN_VALIDITY:
+                token_refreshes.inc(self.name, "reused")
+                self._remember(key, data)
+                self._schedule_refresh(key)
+                return data
+        if not data or not data.get("refresh_token"):
+            raise TokenRefreshError(f"No {self.name} refresh token available")
+
+        outcome = "error"
+        try:
+            with timed(token_refresh_latency, self.name, span="token_refresh"):
+                refreshed = await self._refresh(data)
+            outcome = "refreshed"
+        except TokenRefreshError:
+            outcome = "rejected"
+            raise
+        finally:
+            token_refreshes.inc(self.name, outcome)
+        data = {**data, **refreshed}
+        self.set(key, data)
+        return data
+
+    def _load_stored(self, key):
+        if self._load is None:
+            return None
+        try:
+            with timed(token_load_latency, self.name, span="token_load"):
+                return self._load(key)
+        except Exception:
+            logger.warning("Could not read stored %s token", self.name, exc_info=True)
+            return None
+
+    def _remember(self, key, data):
+        self._tokens[key] = data
+        self._tokens.move_to_end(key)
+        while len(self._tokens) > self.cache_size:
+            evicted, _ = self._tokens.popitem(last=False)
+            self._last_used.pop(evicted, None)
+            timer = self._timers.pop(evicted, None)
+            if timer is not None:
+                timer.cancel()
+
+    def _schedule_refresh(self, key):
+        data = self._tokens.get(key)
+        timer = self._timers.pop(key, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        if not data or not data.get("refresh_token") or "expires_at" not in data:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+
+        delay = max(0.0, data["expires_at"] - self.margin - time.time())
+        self._timers[key] = loop.create_task(self._refresh_later(key, delay))
+
+    async def _refresh_later(self, key, delay):
+        await asyncio.sleep(delay)
+        if time.monotonic() - self._last_used.get(key, 0) > IDLE_TIMEOUT:
+            return  # Idle token: the next get() refreshes it on demand
+        try:
+            await self.refresh(key)
+        except Exception:
+            logger.warning("Background refresh of %s token failed", self.name, exc_info=True)
+
+    def _schedule_save(self, key, data):
+        if self._save is None:
+            return
+        self._pending_saves[key] = data
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._flush_saves_now()
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._flush_saves())
+
+    async def _flush_saves(self):
+        await asyncio.sleep(SAVE_DELAY)
+        await self.flush()
+
+    async def flush(self, retry=True):
+        pending, self._pending_saves = self._pending_saves, {}
+        for key, data in pending.items():
+            try:
+                await asyncio.to_thread(self._save, key, data)
+            except (OSError, sqlite3.Error):
+                # Requeued rather than dropped: it may be a refresh token the provider has just rotated
+                logger.warning("Could not persist %s token; retrying", self.name, exc_info=True)
+                self._pending_saves.setdefault(key, data)  # An update queued meanwhile is newer
+        if self._pending_saves and retry:
+            # Failed writes, and updates queued while this flush ran, get another pass
+            self._save_task = asyncio.get_running_loop().create_task(self._flush_saves())
+
+    def _flush_saves_now(self):
+        pending, self._pending_saves = self._pending_saves, {}
+        for key, data in pending.items():
+            self._save(key, data)
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import sqlite3
+import secrets
+import threading
+from fastapi import Request
+from token_manager import DEFAULT_KEY
+
+# Per-user token storage shared by every worker process on the node.
+# TokenManager keeps an in-process LRU in front of this, so the store is only read on a cache miss.
+
+TOKEN_DB = os.getenv("TOKEN_DB", "tokens.db")
+SESSION_HEADER = "X-Session-Id"
+SESSION_COOKIE = "session_id"
+DEFAULT_SESSION = DEFAULT_KEY  # Callers that send no session share this one, as before multi-tenancy
+LOGIN_STATE_TTL = int(os.getenv("LOGIN_STATE_TTL", "600"))  # Seconds a login has to come back to its callback
+
+
+def get_session_id(request: Request):
+    """ Identifies the caller: X-Session-Id header first, then the session cookie set at login. """
+    return request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE) or DEFAULT_SESSION
+
+
+def new_session_id():
+    return secrets.token_urlsafe(24)
+
+
+def login_session_id(session_id, new_session=False):
+    """ Session a login is stored under; callers without a session of their own get a fresh one, never the shared one. """
+    if new_session or not session_id or session_id == DEFAULT_SESSION:
+        return new_session_id()
+    return session_id
+
+
+class TokenStore:
+    """ SQLite backed token table keyed by (provider, session id); safe to share between processes. """
+
+    def __init__(self, path=TOKEN_DB):
+        self.path = path
+        self._local = threading.local()  # sqlite3 connections must stay on the thread that opened them
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                " provider TEXT NOT NULL, session_id TEXT NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL,"
+                " PRIMARY KEY (provider, session_id))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS login_states ("
+                " state TEXT PRIMARY KEY, provider TEXT NOT NULL, session_id TEXT NOT NULL, data TEXT,"
+                " expires_at REAL NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def load(self, provider, session_id):
+        row = self._connection().execute(
+            "SELECT data FROM tokens WHERE provider = ? AND session_id = ?", (provider, session_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, provider, session_id, data):
+        self._connection().execute(
+            "INSERT INTO tokens (provider, session_id, data, updated_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (provider, session_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (provider, session_id, json.dumps(data), time.time()),
+        )
+
+    def delete(self, provider, session_id):
+        self._connection().execute(
+            "DELETE FROM tokens WHERE provider = ? AND session_id = ?", (provider, session_id)
+        )
+
+    def begin_login(self, provider, session_id, data=None):
+        """
+        One-time OAuth state for a login of session_id, with data the callback needs (e.g. a PKCE verifier).
+        Expired states, and the data of logins that never came back, are dropped on the way.
+        """
+        state = secrets.token_urlsafe(32)
+        connection = self._connection()
+        connection.execute("DELETE FROM login_states WHERE expires_at < ?", (time.time(),))
+        connection.execute(
+            "INSERT INTO login_states (state, provider, session_id, data, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (state, provider, session_id, json.dumps(data or {}), time.time() + LOGIN_STATE_TTL),
+        )
+        return state
+
+    def finish_login(self, provider, state):
+        """ Consumes a state from begin_login: its data plus session_id, or None if unknown, used or expired. """
+        if not state:
+            return None
+        row = self._connection().execute(
+            "DELETE FROM login_states WHERE state = ? AND provider = ? RETURNING session_id, data, expires_at",
+            (state, provider),
+        ).fetchone()
+        if row is None or row[2] < time.time():
+            return None
+        return {**json.loads(row[1] or "{}"), "session_id": row[0]}
+
+    def loader(self, provider):
+        return lambda session_id: self.load(provider, session_id)
+
+    def saver(self, provider):
+        return lambda session_id, data: self.save(provider, session_id, data)
+
+
+token_store = TokenStore()
@@ -0,0 +1,269 @@
+import os
+import asyncio
+import hashlib
+import weakref
+from contextlib import asynccontextmanager
+import httpx
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from http_client import get_client
+from metrics import transfer_bytes
+from token_manager import read_json, write_json_atomic
+
+# Large file downloads shared by the connectors: parallel byte ranges written in place and
+# resumable through a progress sidecar, or a bounded-memory pass-through stream to the client.
+
+CHUNK_SIZE = 1024 * 1024
+PART_SIZE = int(os.getenv("TRANSFER_PART_SIZE", str(32 * 1024 * 1024)))  # Byte range fetched by each worker
+WORKERS = int(os.getenv("TRANSFER_WORKERS", "4"))
+MAX_PART_RETRIES = 5
+PASSTHROUGH_HEADERS = ("Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified")
+LOCK_POLL_INTERVAL = 0.2  # Seconds between attempts on a target another worker is downloading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+_target_locks = weakref.WeakValueDictionary()  # target path -> asyncio.Lock held by the download writing it
+
+
+class TransferError(Exception):
+    """ A download could not be completed or did not match the expected size or checksum. """
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_progress(progress_path, total_size, part_size):
+    """ Part offsets already on disk, if the sidecar describes the same file and layout. """
+    progress = read_json(progress_path) or {}
+    if progress.get("size") != total_size or progress.get("part_size") != part_size:
+        return set()
+    return set(progress.get("done", []))
+
+
+def write_at(f, offset, data):
+    f.seek(offset)
+    f.write(data)
+
+
+def truncate_file(path, size, keep):
+    with open(path, "r+b" if keep else "wb") as f:
+        f.truncate(size)
+
+
+def try_lock_file(f):
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def open_locked(lock_path):
+    """ Opens and locks lock_path, or returns None if another process holds it. Blocking. """
+    f = open(lock_path, "a+b")
+    if not try_lock_file(f):
+        f.close()
+        return None
+    if fcntl is not None:
+        try:
+            current = os.stat(lock_path)
+        except FileNotFoundError:
+            current = None
+        if current is None or current.st_ino != os.fstat(f.fileno()).st_ino:
+            f.close()  # The holder removed this file on release; lock the one now at lock_path instead
+            return None
+    return f
+
+
+def release_lock_file(lock_path, f):
+    if fcntl is not None:
+        os.remove(lock_path)  # Removed while still locked, so the next locker can tell its file is stale
+    f.close()
+
+
+@asynccontextmanager
+async def target_lock(path):
+    """ Lets one download at a time write path: an asyncio lock within the process, a lock file across workers. """
+    path = os.path.realpath(path)
+    lock = _target_locks.get(path)
+    if lock is None:
+        lock = _target_locks[path] = asyncio.Lock()
+    async with lock:
+        lock_path = f"{path}.lock"
+        while (f := await asyncio.to_thread(open_locked, lock_path)) is None:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(release_lock_file, lock_path, f)
+
+
+async def write_chunks(chunks, path, digest=None):
+    """ Writes an async iterable of chunks to path, doing the file calls in a thread; optionally feeds digest. """
+    f = await asyncio.to_thread(open, path, "wb")
+    try:
+        async for chunk in chunks:
+            await asyncio.to_thread(f.write, chunk)
+            if digest is not None:
+                digest.update(chunk)
+            transfer_bytes.inc("disk", amount=len(chunk))
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+async def fetch_range(url, headers, path, start, end):
+    """ Writes bytes start..end into path; returns the status code and the number of bytes written. """
+    written = 0
+    request_headers = {**headers, "Range": f"bytes={start}-{end}"}
+    async with get_client().stream("GET", url, headers=request_headers, follow_redirects=True) as response:
+        if response.status_code != 206:
+            await response.aread()
+            return response.status_code, written
+        # File calls run in a thread so a slow disk does not stall the event loop
+        f = await asyncio.to_thread(open, path, "r+b")
+        try:
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                if written + len(chunk) > end - start + 1:
+                    break  # A server ignoring the range would otherwise overwrite the next part
+                await asyncio.to_thread(write_at, f, start + written, chunk)
+                written += len(chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+    transfer_bytes.inc("disk", amount=written)
+    return 206, written
+
+
+async def download_ranges(url, path, total_size, auth, expected_sha256=None, part_size=PART_SIZE, workers=WORKERS):
+    """
+    Downloads url to path as concurrent byte ranges and returns its size and sha256.
+
+    ``auth(expired)`` returns the request headers and is awaited before every range, so long transfers
+    pick up refreshed tokens; ``expired=True`` asks for a refresh after a 401. Data goes to ``path.part``
+    and finished parts are recorded in ``path.part.json``, so calling again after a failure only fetches
+    the missing parts. The file is moved into place once every part is in and the checksum checks out.
+
+    Calls for the same path, from this process or another worker, run one after the other; file system
+    errors are raised as TransferError like every other failure.
+    """
+    try:
+        async with target_lock(path):
+            return await fetch_ranges(url, path, total_size, auth, expected_sha256, part_size, workers)
+    except OSError as e:
+        raise TransferError(f"Download to {os.path.basename(path)} failed: {e}") from e
+
+
+async def fetch_ranges(url, path, total_size, auth, expected_sha256, part_size, workers):
+    part_path = f"{path}.part"
+    progress_path = f"{part_path}.json"
+    done = load_progress(progress_path, total_size, part_size) if os.path.exists(part_path) else set()
+    await asyncio.to_thread(truncate_file, part_path, total_size, keep=bool(done))
+
+    semaphore = asyncio.Semaphore(workers)
+    progress_lock = asyncio.Lock()
+    writes = set()  # Progress writes still running; each one saves every part recorded so far
+
+    async def save_progress():
+        async with progress_lock:
+            await asyncio.to_thread(write_json_atomic, progress_path,
+                                    {"size": total_size, "part_size": part_size, "done": sorted(done)})
+
+    def record(start):
+        # The part is in done before anything can be cancelled, and its write runs to the end regardless
+        done.add(start)
+        write = asyncio.ensure_future(save_progress())
+        writes.add(write)
+        write.add_done_callback(writes.discard)
+        return write
+
+    async def fetch_part(start):
+        end = min(start + part_size, total_size) - 1
+        async with semaphore:
+            for attempt in range(MAX_PART_RETRIES + 1):
+                headers = await auth(False)
+                try:
+                    status_code, written = await fetch_range(url, headers, part_path, start, end)
+                except httpx.HTTPError as e:
+                    status_code, written = str(e), 0
+                if status_code == 206 and written == end - start + 1:
+                    break
+                if status_code == 401:
+                    await auth(True)
+                    continue
+                if attempt == MAX_PART_RETRIES:
+                    raise TransferError(f"Range {start}-{end} failed: {status_code}")
+                await asyncio.sleep(min(2 ** attempt, 32))
+
+        await asyncio.shield(record(start))
+
+    starts = range(0, total_size, part_size)
+    tasks = [asyncio.ensure_future(fetch_part(start)) for start in starts if start not in done]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()  # Stop the other parts once one has failed; finished ones are already recorded
+        # Let the parts unwind and their progress writes land before the error goes up
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if writes:
+            await asyncio.gather(*writes, return_exceptions=True)
+
+    missing = [start for start in starts if start not in done]
+    if missing:
+        raise TransferError(f"{len(missing)} of {len(starts)} parts missing")
+    sha256 = await asyncio.to_thread(file_sha256, part_path)
+    if expected_sha256 and sha256 != expected_sha256.lower():
+        os.remove(part_path)
+        remove_progress(progress_path)
+        raise TransferError(f"Checksum mismatch: expected {expected_sha256}, got {sha256}")
+
+    os.replace(part_path, path)
+    remove_progress(progress_path)
+    return {"size": total_size, "sha256": sha256}
+
+
+def remove_progress(progress_path):
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+
+
+async def counted(chunks):
+    async for chunk in chunks:
+        transfer_bytes.inc("stream", amount=len(chunk))
+        yield chunk
+
+
+async def stream_download(url, headers, range_header=None, file_name=None):
+    """ Pipes the upstream body to the client chunk by chunk, passing the Range header through. """
+    upstream_headers = dict(headers)
+    if range_header:
+        upstream_headers["Range"] = range_header
+    client = get_client()
+    response = await client.send(client.build_request("GET", url, headers=upstream_headers),
+                                 stream=True, follow_redirects=True)
+    if response.status_code not in (200, 206):
+        await response.aread()
+        await response.aclose()
+        return {"error": "File download failed", "details": response.text}
+
+    response_headers = {name: response.headers[name] for name in PASSTHROUGH_HEADERS if name in response.headers}
+    if file_name:
+        response_headers["Content-Disposition"] = f'attachment; filename="{os.path.basename(file_name)}"'
+    return StreamingResponse(
+        counted(response.aiter_bytes(CHUNK_SIZE)),
+        status_code=response.status_code,
+        media_type=response.headers.get("Content-Type", "application/octet-stream"),
+        headers=response_headers,
+        background=BackgroundTask(response.aclose),
+    )